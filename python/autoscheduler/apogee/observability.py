@@ -1,133 +1,109 @@
 from __future__ import print_function, division
 from time import time
 import numpy as np
-import astropysics.coords as coo
-import astropysics.obstools as obs
-from autoscheduler.sdssUtilities.idlasl import moonpos
+from autoscheduler import observability_kernel as kernel
+
+
+def _plate_columns(apg):
+    # Pull the per-plate values used by the observability rules into arrays
+    if hasattr(apg, 'columns'):
+        # already columnar (PlateTable)
+        return apg.columns
+    cols = dict()
+    cols['priority'] = np.array([p.priority for p in apg], dtype=float)
+    cols['manual_priority'] = np.array([p.manual_priority for p in apg], dtype=float)
+    cols['ra'] = np.array([p.ra for p in apg], dtype=float)
+    cols['dec'] = np.array([p.dec for p in apg], dtype=float)
+    cols['ha'] = np.array([p.ha for p in apg], dtype=float)
+    cols['minha'] = np.array([p.minha for p in apg], dtype=float)
+    cols['maxha'] = np.array([p.maxha for p in apg], dtype=float)
+    cols['exp_time'] = np.array([p.exp_time for p in apg], dtype=float)
+    cols['vplan'] = np.array([p.vplan for p in apg], dtype=float)
+    cols['cadence'] = np.array([p.cadence for p in apg], dtype=object)
+    return cols
+
+
+def observability_terms(apg, par, times, lengths, south=False, ephem=None, index=None):
+    '''
+    observability_terms: the parts of the observability that do not depend on plate priorities
+
+    INPUT: apg, par, times, lengths -- plates, parameters and slots, as for observability
+           south, ephem, index -- as for observability
+    OUTPUT: transit, code -- transit bonus and limit code of every plate and slot (see
+            observability_kernel.evaluate); pass them back to observability as terms to
+            score new priorities for the same plates and slots
+    '''
+    obs_site = kernel.get_site(south)
+    times = np.array(times, dtype=float)
+    lengths = np.array(lengths, dtype=float)
+    cols = _plate_columns(apg)
+
+    extra_time = np.where(cols['manual_priority'] == 10, 0.25, 0.0)  # add 15 minute buffer
+    platelst = (cols['ra'] + cols['ha']) / 15
+    minlst = (cols['ra'] + cols['minha']) / 15 - extra_time
+    maxlst = (cols['ra'] + cols['maxha']) / 15 + extra_time
+
+    # Airmass is checked at the start, middle and end of each block. Zenith avoidance is
+    # ignored in the south and for priority 10 plates in the north.
+    samples = times[:, np.newaxis] + (lengths / 2 / 24)[:, np.newaxis] * np.arange(3)[np.newaxis, :]
+    if south:
+        zenith = np.zeros(len(cols['ra']), dtype=bool)
+    else:
+        zenith = cols['manual_priority'] != 10
+    return kernel.evaluate(obs_site, cols['ra'], cols['dec'], platelst, minlst, maxlst, times, lengths,
+                           samples, par['moon_threshold'], par['maxz'], zenith, ephem=ephem, index=index)
 
 
-def observability(apg, par, times, lengths, loud=True, south=False):
+def observability(apg, par, times, lengths, loud=True, south=False, ephem=None, index=None, terms=None):
     obs_start = time()
-    if south:
-        obs_site = obs.Site(-29.0182, -70.6915)
-    else:
-        obs_site = obs.Site(32.789278, -105.820278)
+    obs_site = kernel.get_site(south)
     obsarr = np.zeros([len(apg), len(times)])
-    beglst = [obs_site.localSiderialTime(x) for x in times]
-    endlst = [obs_site.localSiderialTime(times[x] + lengths[x]/24) for x in range(len(times))]
-
-    # Determine moon coordinates
-    mpos = []
-    for t in range(len(times)):
-        mooncoords = moonpos(times[t])
-        mpos.append(coo.ICRSCoordinates(mooncoords[0], mooncoords[1]))
+    if len(apg) == 0 or len(times) == 0:
+        return obsarr
+    times = np.array(times, dtype=float)
+    lengths = np.array(lengths, dtype=float)
+
+    cols = _plate_columns(apg)
+    # Plates with no priority are never scheduled and keep an all-zero row
+    active = cols['priority'] > 0
+
+    # Compute observing constants
+    extra_time = np.where(cols['manual_priority'] == 10, 0.25, 0.0)  # add 15 minute buffer
+    minlst = (cols['ra'] + cols['minha']) / 15 - extra_time
+    maxlst = (cols['ra'] + cols['maxha']) / 15 + extra_time
+
+    if terms is None:
+        terms = observability_terms(apg, par, times, lengths, south=south, ephem=ephem, index=index)
+    transit, code = terms
+    obsarr = kernel.priority_matrix(cols['priority'], transit, code)
+    checked = (code == kernel.OK) | (code == kernel.AIRMASS_LIMIT)
+
+    # Lower the priority of long exposure plates in the last slot
+    longexp = cols['exp_time'] == 1000.0
+    obsarr[checked[:, -1] & longexp, -1] /= 3.0
+
+    # Lower priorities for all plates that aren't vplan == 1 for short slots. The priority order should be:
+    # vpan == 1, vplan > 3, vplan == 3, cadence == kep_koi or substellar, long exposure
+    short = lengths < 1.0
+    if np.any(short):
+        special = (cols['cadence'] == 'kep_koi') | (cols['cadence'] == 'substellar')
+        factor = np.ones(len(apg))
+        factor[cols['vplan'] > 3] = 1.5
+        factor[cols['vplan'] == 3] = 2.0
+        factor[special] = 2.5
+        factor[longexp] = 3.0
+        obsarr /= np.where(checked & short[np.newaxis, :], factor[:, np.newaxis], 1.0)
+
+    obsarr[~active, :] = 0
 
     if loud:
         df = open('apogeeobs.txt', 'w')
-    # Loop over all plates
-    for p in range(len(apg)):
-        # Initalize obsarr row
-        if apg[p].priority <= 0:
-            continue
-        for t in range(len(times)):
-            obsarr[p, t] = apg[p].priority
-
-
-        if apg[p].manual_priority == 10:
-            extra_time = 0.25  # add 15 minute buffer
-        else:
-            extra_time = 0
-        # Compute observing constants
-        platecoo = coo.ICRSCoordinates(apg[p].ra, apg[p].dec)
-        platelst = float(apg[p].ra + apg[p].ha) / 15
-        minlst = float(apg[p].ra + apg[p].minha) / 15 - extra_time
-        maxlst = float(apg[p].ra + apg[p].maxha) / 15 + extra_time
-
-
-        for t in range(len(times)):
-            # Adjust LSTs for 24 hour wrapping
-            usedminlst, usedmaxlst = minlst, maxlst
-            if minlst < 0 and beglst[t] > 12 and endlst[t] > 12:
-                usedminlst += 24
-                usedmaxlst += 24
-            if maxlst > 24 and beglst[t] < 12 and endlst[t] < 12:
-                usedminlst -= 24
-                usedmaxlst -= 24
-            if beglst[t] > endlst[t]:
-                if minlst < 12:
-                    usedminlst += 24
-                if maxlst > 12:
-                    usedmaxlst -= 24
-
-            # Adjust LSTs for Gaussian with 24 hour wrapping
-            if beglst[t] > endlst[t]:
-                lstsum = beglst[t]+endlst[t]-24
-                if platelst > 12:
-                    usedplatelst = platelst - 24
-                else:
-                    usedplatelst = platelst
-            else:
-                lstsum = beglst[t]+endlst[t]
-                if beglst[t] > 18 and platelst < 4:
-                    usedplatelst = platelst + 24
-                elif beglst[t] < 4 and platelst > 18:
-                    usedplatelst = platelst - 24
-                else:
-                    usedplatelst = platelst
-
-            # Gaussian prioritization on time from transit
-            obsarr[p, t] += 50.0 * float(np.exp(-(usedplatelst - lstsum/2 + lengths[t]/2)**2 / 2))
-
-            # Moon avoidance
-            moondist = mpos[t] - platecoo
-            if moondist.d < par['moon_threshold']:
-                obsarr[p, t] = -3
-                continue
-
-            # Determine whether HAs of block are within observational range
-            if beglst[t] < usedminlst or endlst[t] > usedmaxlst:
-                obsarr[p, t] = -1
-                continue
-
-            # Compute horiztonal coordinates
-            horz = obs_site.apparentCoordinates(platecoo, datetime=[times[t] + lengths[t] / 2 / 24 * x for x in range(3)])
-            secz = [1/np.cos((90.0 - horz[x].alt.d) * np.pi / 180) for x in range(len(horz))]
-            # Check whether any of the points contain a bad airmass value
-            if south:
-                badsecz = [x for x in secz if x > par['maxz']]
-            # Check again to ignore zenith avoidance for priority 10 plates in the north
-            elif apg[p].manual_priority == 10:
-                badsecz = [x for x in secz if x > par['maxz']]
-            else:
-                badsecz = [x for x in secz if x < 1.003 or x > par['maxz']]
-            if len(badsecz) > 0:
-                obsarr[p, t] = -2
-
-            # Lower the priority of long exposure plates in the last slot
-            if t == len(times) - 1:
-                if apg[p].exp_time == 1000.0:
-                    obsarr[p, t] = obsarr[p, t] / 3.0
-
-            # Lower priorities for all plates that aren't vplan == 1 for short slots. The priority order should be:
-            # vpan == 1, vplan > 3, vplan == 3, cadence == kep_koi or substellar, long exposure
-            if lengths[t] < 1.0:
-                if apg[p].exp_time == 1000.0:
-                    obsarr[p, t] = obsarr[p, t] / 3.0
-                elif apg[p].cadence == 'kep_koi' or apg[p].cadence == 'substellar':
-                    obsarr[p, t] = obsarr[p, t] / 2.5
-                elif apg[p].vplan == 3:
-                    obsarr[p, t] = obsarr[p, t] / 2.0
-                elif apg[p].vplan > 3:
-                    obsarr[p, t] = obsarr[p, t] / 1.5
-
-        if loud:
-            print(apg[p].plateid, minlst, maxlst, obs_site.localTime(minlst, utc=True), obs_site.localTime(maxlst, utc=True), obsarr[p, :], file=df)
+        for p in np.where(active)[0]:
+            print(apg[p].plateid, minlst[p], maxlst[p], obs_site.localTime(minlst[p], utc=True), obs_site.localTime(maxlst[p], utc=True), obsarr[p, :], file=df)
+        df.close()
 
     obs_end = time()
     if loud:
         print("[PY] Determined APOGEE-II observability (%.3f sec)" % (obs_end - obs_start))
 
-    if loud:
-        df.close()
-
     return obsarr
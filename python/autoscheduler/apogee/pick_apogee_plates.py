@@ -1,10 +1,33 @@
 from __future__ import print_function, division
 from time import time
 import numpy as np
+from autoscheduler.plateDBtools.apogee.cohorts import CohortIndex
 
+# scipy is only needed by the assignment solver
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
 
-def pick_plates(apg, obs, par, times, lengths, schedule, loud=True, south=False):
-    pick_start = time()
+# Most assignment problems solved for one night when stacked designs clash
+MAX_NODES = 1000
+
+
+def _objective(obs, chosen):
+    # summed priority of the main plates
+    return float(sum([obs[c, t] for t, c in enumerate(chosen[:, 0]) if c >= 0]))
+
+
+def greedy_slots(apg, obs, times, cohorts, loud=True):
+    '''
+    greedy_slots: fills slots in availability order with the best remaining plate
+
+    INPUT: apg -- list of APOGEE-II plates
+           obs -- observability matrix (nplate x nslot); picked designs are knocked out in place
+           times -- slot start times
+           cohorts -- CohortIndex of apg
+    OUTPUT: chosen -- (nslot x 3) indices of the main and backup plates, -1 where none
+    '''
     # Check how many plates are available in each slot
     nslot = np.zeros(len(times))
     for t in range(len(times)):
@@ -12,7 +35,7 @@ def pick_plates(apg, obs, par, times, lengths, schedule, loud=True, south=False)
         nslot[t] = len(wgood)
 
     # Loop through slots to choose in availability order
-    chosen = np.zeros([len(times), 3], dtype=np.int)
+    chosen = np.zeros([len(times), 3], dtype=int)
     pickorder = np.argsort(nslot)
     for t in range(len(times)):
         cslot = pickorder[t]
@@ -45,9 +68,8 @@ def pick_plates(apg, obs, par, times, lengths, schedule, loud=True, south=False)
         if chosen[cslot, 0] == -1:
             continue
 
-        # Find all plates on the same field, and similar designs (location ID + apogee version) to the chosen plate
-        chosen_field = [x for x in range(len(apg)) if apg[x].locationid == apg[chosen[cslot, 0]].locationid]
-        chosen_designs = [x for x in chosen_field if apg[x].apgver == apg[chosen[cslot, 0]].apgver]
+        # Find all plates with similar designs (location ID + apogee version) to the chosen plate
+        chosen_designs = cohorts.same_cohort(chosen[cslot, 0])
 
         # Remove chosen design, if it is not stack-able.
         if apg[chosen[cslot, 0]].stack == 0:
@@ -58,6 +80,142 @@ def pick_plates(apg, obs, par, times, lengths, schedule, loud=True, south=False)
             for x in chosen_designs:
                 obs[x, cslot-1:cslot+2] = -10
 
+    return chosen
+
+
+def _stacked_assignment(gain, rows, best, maxnodes=MAX_NODES):
+    # Branch and bound over the assignment problem: a stacked design on two adjacent slots
+    # splits the search into one branch without it in the first slot and one without it in
+    # the second. The assignment value bounds every branch below it. The weaker slot is
+    # searched first, so the first solution found is the one of dropping it outright.
+    nslot = gain.shape[1]
+    design, value = -np.ones(nslot, dtype=int), 0.0
+    branches = [gain]
+    nodes = 0
+    while len(branches) > 0 and nodes < maxnodes:
+        g = branches.pop()
+        nodes += 1
+        r, t = linear_sum_assignment(-g)
+        bound = g[r, t].sum()
+        if bound <= value:
+            continue
+        d = -np.ones(nslot, dtype=int)
+        used = g[r, t] > 0
+        d[t[used]] = rows[r[used]]
+        # stacked designs may not take adjacent slots
+        clash = np.flatnonzero((d[1:] >= 0) & (d[1:] == d[:-1]))
+        if len(clash) == 0:
+            design, value = d, bound
+            continue
+        c = clash[0]
+        weak = c if best[d[c], c] < best[d[c], c + 1] else c + 1
+        for drop in (c + c + 1 - weak, weak):
+            branch = g.copy()
+            branch[rows == d[c], drop] = 0
+            branches.append(branch)
+    return design
+
+
+def assignment_slots(apg, obs, cohorts):
+    '''
+    assignment_slots: picks the main plates of all slots at once, maximizing their summed priority
+
+    Each design (location ID + apogee version) is a row of an assignment problem against the
+    slots, valued by its best plate in each slot. Only the nslot best designs of every slot
+    can be part of an optimal assignment, so the rest are dropped (argpartition) before
+    solving. Stack-able designs may fill several slots, but not adjacent ones; such clashes
+    are settled by branch and bound, which is exact unless it gives up after MAX_NODES
+    problems. Backups are the next best plates of each slot outside the designs picked for
+    other slots. If the greedy picks are worth more (greedy_slots can stack a design on the
+    first two slots), they are returned instead.
+
+    INPUT: apg -- list of APOGEE-II plates
+           obs -- observability matrix (nplate x nslot), not modified
+           cohorts -- CohortIndex of apg
+    OUTPUT: chosen -- (nslot x 3) indices of the main and backup plates, -1 where none
+    '''
+    if linear_sum_assignment is None:
+        raise RuntimeError('scipy not installed: cannot use the assignment solver.')
+    nslot = obs.shape[1]
+    chosen = np.zeros([nslot, 3], dtype=int) - 1
+    if len(apg) == 0 or nslot == 0:
+        return chosen
+
+    # Best plate of every design in every slot
+    order = np.argsort(cohorts.cohort, kind='mergesort')
+    starts = np.searchsorted(cohorts.cohort[order], np.arange(cohorts.ncohort))
+    best = np.maximum.reduceat(obs[order], starts, axis=0)
+
+    # Keep the nslot best designs of every slot
+    k = min(nslot, cohorts.ncohort)
+    top = np.argpartition(-best, k - 1, axis=0)[:k] if k < cohorts.ncohort else np.arange(cohorts.ncohort)[:, np.newaxis]
+    cand = np.unique(top)
+    cand = cand[np.any(best[cand] > 0, axis=1)]
+    if len(cand) == 0:
+        return chosen
+
+    # Stack-able designs get one row per slot they could fill
+    stack = np.array([max([apg[x].stack for x in cohorts.cohorts[c]]) for c in cand])
+    rows = np.concatenate([np.repeat(cand[stack > 0], (nslot + 1) // 2), cand[stack == 0]])
+    design = _stacked_assignment(np.maximum(best[rows], 0), rows, best)
+
+    # Main plate: the best plate of the assigned design; backups from the remaining designs
+    for t in range(nslot):
+        if design[t] < 0:
+            continue
+        members = cohorts.cohorts[design[t]]
+        chosen[t, 0] = members[np.argmax(obs[members, t])]
+    for t in range(nslot):
+        column = np.array(obs[:, t], dtype=float)
+        for u in range(nslot):
+            if u != t and design[u] >= 0:
+                column[cohorts.cohorts[design[u]]] = -10
+        if chosen[t, 0] >= 0:
+            column[chosen[t, 0]] = -10
+        nback = min(2, len(column))
+        if nback == 0:
+            continue
+        back = np.argpartition(-column, nback - 1)[:nback]
+        back = back[np.argsort(-column[back], kind='mergesort')]
+        for i, x in enumerate(back):
+            if column[x] > 0:
+                chosen[t, i + 1] = x
+
+    greedy = greedy_slots(apg, np.array(obs, dtype=float), np.arange(nslot), cohorts, loud=False)
+    if _objective(obs, greedy) > _objective(obs, chosen):
+        return greedy
+    return chosen
+
+
+def pick_plates(apg, obs, par, times, lengths, schedule, loud=True, south=False, cohorts=None, solver='greedy',
+                stats=None):
+    '''
+    pick_plates: chooses the main and backup plate of every APOGEE-II slot
+
+    INPUT: apg, obs, par, times, lengths, schedule -- plates, observability and slots for tonight
+           cohorts -- CohortIndex of apg (optional, built if not given)
+           solver -- 'greedy' (slot by slot) or 'assignment' (all slots at once, needs scipy)
+           stats -- optional dict, filled with the solver, objective (summed priority of the main
+                    plates) and solve time (sec)
+    OUTPUT: picks -- list of dicts, one per block
+    '''
+    pick_start = time()
+    if cohorts is None:
+        cohorts = CohortIndex(apg)
+    value = np.array(obs, dtype=float)
+    if solver == 'assignment':
+        chosen = assignment_slots(apg, obs, cohorts)
+    elif solver == 'greedy':
+        chosen = greedy_slots(apg, obs, times, cohorts, loud=loud)
+    else:
+        raise ValueError("Unknown APOGEE-II solver '{}'".format(solver))
+    solve_end = time()
+    objective = _objective(value, chosen)
+    if stats is not None:
+        stats.update({'solver': solver, 'objective': objective, 'solve_time': solve_end - pick_start})
+    if loud:
+        print("[PY] APOGEE-II %s picks: objective %.1f (%.3f sec)" % (solver, objective, solve_end - pick_start))
+
     # Check for stacked fields
     for t in range(len(times)-1):
         if t+1 >= len(times):
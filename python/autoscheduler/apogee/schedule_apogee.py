@@ -2,6 +2,8 @@ from __future__ import print_function, division
 from time import time
 
 from autoscheduler.plateDBtools.apogee.get_apogee_plates import get_plates
+from autoscheduler.plateDBtools.apogee.cohorts import CohortIndex
+from autoscheduler.ephemeris import night_ephemeris
 from set_apogee_priorities import set_priorities
 from observability import observability
 from pick_apogee_plates import pick_plates
@@ -9,17 +11,22 @@ from pick_apogee_plates import pick_plates
 # SCHEDULE_APOGEE
 # DESCRIPTION: Main APOGEE-II scheduling routine.
 # INPUT: schedule -- dictionary defining important schedule times throughout the night
+#        plates -- plates to schedule from (list or PlateTable), instead of reading them from the database
+#        context -- RunContext of the scheduler run (see run_context.py)
 # OUTPUT: apogee_choices -- dictionary list containing plate choices + observing times for tonight
 
 single_AB = 15
 
-def schedule_apogee(schedule, errors, par=None, plan=False, loud=True, twilight=False, south=False):
+# Default APOGEE-II observing parameters (north)
+DEFAULT_PAR = {'exposure': 67, 'overhead': 20.0, 'ncarts': 9, 'maxz': 3, 'moon_threshold': 15, 'sn_target': 3136}
 
-    # Default params for north, south can have different params so keep them if passed in
-    if par is None:
-        par = {'exposure': 67, 'overhead': 20.0, 'ncarts': 9, 'maxz': 3, 'moon_threshold': 15, 'sn_target': 3136}
 
-    # Define APOGEE-II blocks for tonight
+# APOGEE_SLOTS
+# DESCRIPTION: Divides tonight's APOGEE-II time (and twilight, if asked) into blocks
+# INPUT: schedule -- dictionary defining important schedule times throughout the night
+# OUTPUT: times, lengths -- block start times (JD) and lengths (hours)
+
+def apogee_slots(schedule, par, twilight=False, south=False):
     nightlength = (schedule['bright_end'] - schedule['bright_start']) * 24
     nslots = min([int(round(nightlength / ((par['exposure'] + par['overhead']) / 60))), par['ncarts']])
     if nslots != 0:
@@ -73,6 +80,20 @@ def schedule_apogee(schedule, errors, par=None, plan=False, loud=True, twilight=
             lengths.append(twlength)
             nslots = nslots + 1
 
+    return times, lengths
+
+
+def schedule_apogee(schedule, errors, par=None, plan=False, loud=True, twilight=False, south=False, solver='greedy',
+                    plates=None, context=None):
+
+    # Default params for north, south can have different params so keep them if passed in
+    if par is None:
+        par = dict(DEFAULT_PAR)
+
+    # Define APOGEE-II blocks for tonight
+    times, lengths = apogee_slots(schedule, par, twilight=twilight, south=south)
+    nslots = len(times)
+
     # Return nothing if no APOGEE slots needed.
     if nslots == 0:
         return []
@@ -82,7 +103,13 @@ def schedule_apogee(schedule, errors, par=None, plan=False, loud=True, twilight=
         passed_mjd = schedule['jd'] - 2400000
     else:
         passed_mjd = None
-    apg = get_plates(errors, plan=plan, loud=loud, south=south, mjd=passed_mjd)
+    # Field and cohort membership, shared by the stages below
+    if plates is None:
+        apg, cohorts = get_plates(errors, plan=plan, loud=loud, south=south, mjd=passed_mjd, context=context,
+                                  return_cohorts=True)
+    else:
+        apg = plates
+        cohorts = CohortIndex(apg)
     if len(apg) == 0:
         errors.append('APOGEE-II PLATE ERROR: No APOGEE-II plates found. Aborting.')
         return []
@@ -90,15 +117,16 @@ def schedule_apogee(schedule, errors, par=None, plan=False, loud=True, twilight=
     # decision to include ALL plates, but de-prioritize other programs, moved to set_priorities
     # if 'programs' in schedule:
     #     apg = [p for p in apg if p.cadence in schedule['programs']]
-    
+
     # Prioritize all plates
-    set_priorities(apg, par, schedule, plan, loud=loud, twilight=twilight, south=south)
+    set_priorities(apg, par, schedule, plan, loud=loud, twilight=twilight, south=south, cohorts=cohorts)
 
     # Determine observability range of all plates
-    obs = observability(apg, par, times, lengths, loud=loud, south=south)
+    ephem = night_ephemeris('lco' if south else 'apo', schedule['jd'])
+    obs = observability(apg, par, times, lengths, loud=loud, south=south, ephem=ephem)
 
     # Pick plates for tonight
-    picks = pick_plates(apg, obs, par, times, lengths, schedule, loud=loud, south=south)
+    picks = pick_plates(apg, obs, par, times, lengths, schedule, loud=loud, south=south, cohorts=cohorts, solver=solver)
 
     # Print out all plate information (just for testing purposes)
     if loud:
@@ -110,7 +138,7 @@ def schedule_apogee(schedule, errors, par=None, plan=False, loud=True, twilight=
     return picks
 
 
-def schedule_external(schedule, errors, par=None, plan=False, loud=True, twilight=False, ):
+def schedule_external(schedule, errors, par=None, plan=False, loud=True, twilight=False, south=False, plates=None, context=None):
 
     # Default params for north, south can have different params so keep them if passed in
     if par is None:
@@ -137,7 +165,10 @@ def schedule_external(schedule, errors, par=None, plan=False, loud=True, twiligh
     # ##########################
     # change
     # ##########################
-    apg = get_plates(errors, plan=plan, loud=loud, south=south, mjd=passed_mjd)
+    if plates is None:
+        apg = get_plates(errors, plan=plan, loud=loud, south=south, mjd=passed_mjd, context=context)
+    else:
+        apg = plates
     if len(apg) == 0:
         errors.append('APOGEE-II PLATE ERROR: No APOGEE-II plates found. Aborting.')
         return []
@@ -149,7 +180,8 @@ def schedule_external(schedule, errors, par=None, plan=False, loud=True, twiligh
     set_priorities(apg, par, schedule, plan, loud=loud, twilight=twilight, south=south)
 
     # Determine observability range of all plates
-    obs = observability(apg, par, times, lengths, loud=loud, south=south)
+    ephem = night_ephemeris('lco' if south else 'apo', schedule['jd'])
+    obs = observability(apg, par, times, lengths, loud=loud, south=south, ephem=ephem)
 
     # Pick plates for tonight
     picks = pick_plates(apg, obs, par, times, lengths, schedule, loud=loud, south=south)
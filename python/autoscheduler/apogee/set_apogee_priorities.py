@@ -1,14 +1,21 @@
 from __future__ import print_function, division
 from time import time
 import numpy as np
+from autoscheduler.plateDBtools.apogee.cohorts import CohortIndex
 
 # SET_PRIORITIES
 # DESCRIPTION: Sets priority values for all available APOGEE-II plates
 # INPUT: apg -- list of objects with all APOGEE-II plate information
+#        cohorts -- CohortIndex of apg (optional, built if not given)
+#        vectorized -- use the column implementation (set_priorities_array), same results
 # OUTPUT: none
 
 
-def set_priorities(apg, par, schedule, plan=False, loud=True, twilight=False, south=False):
+def set_priorities(apg, par, schedule, plan=False, loud=True, twilight=False, south=False, cohorts=None,
+                   vectorized=False):
+    if vectorized:
+        return set_priorities_array(apg, par, schedule, plan=plan, loud=loud, twilight=twilight, south=south,
+                                    cohorts=cohorts)
     set_pri_start = time()
     # Loop through all plates and set priorities
     for p in range(len(apg)):
@@ -65,8 +72,10 @@ def set_priorities(apg, par, schedule, plan=False, loud=True, twilight=False, so
         #                 apg[p].priority = -1
 
     # In-Order Completion (needs second loop)
+    if cohorts is None:
+        cohorts = CohortIndex(apg)
     for p in range(len(apg)):
-        wfield = [x for x in range(len(apg)) if apg[x].locationid == apg[p].locationid]
+        wfield = cohorts.same_field(p)
         for f in wfield:
             if apg[p].apgver > apg[f].apgver and apg[f].priority > 1:
                 apg[p].priority /= 2
@@ -80,3 +89,100 @@ def set_priorities(apg, par, schedule, plan=False, loud=True, twilight=False, so
 
     if loud:
         print("[PY] Prioritized APOGEE-II plates (%.3f sec)" % (set_pri_end - set_pri_start))
+
+
+def _columns(apg):
+    # Per-plate inputs of the priority rules as arrays
+    if hasattr(apg, 'columns'):
+        cols = dict((k, apg.columns[k]) for k in ('manual_priority', 'plugged', 'dec', 'vplan', 'vdone', 'sn', 'cadence'))
+    else:
+        cols = dict()
+        for k in ('manual_priority', 'plugged', 'dec', 'vplan', 'vdone', 'sn'):
+            cols[k] = np.array([getattr(p, k) for p in apg], dtype=float)
+        cols['cadence'] = np.array([p.cadence for p in apg], dtype=object)
+    if hasattr(apg, 'columns'):
+        cols['maxhist'] = apg.columns['last_visit']
+    else:
+        cols['maxhist'] = np.array([p.maxhist() for p in apg], dtype=float)
+    return cols
+
+
+# SET_PRIORITIES_ARRAY
+# DESCRIPTION: Column implementation of set_priorities, giving the same priorities
+# INPUT: same as set_priorities
+# OUTPUT: none
+
+
+def set_priorities_array(apg, par, schedule, plan=False, loud=True, twilight=False, south=False, cohorts=None):
+    set_pri_start = time()
+    cols = _columns(apg)
+    mp = np.asarray(cols['manual_priority'], dtype=float)
+    vplan = np.asarray(cols['vplan'], dtype=float)
+
+    # Set base priority
+    priority = 100.0 * mp
+
+    # Already Plugged
+    if not south:
+        priority += np.where(np.asarray(cols['plugged']) > 0, 100.0, 0.0)
+
+    # Declination
+    dec = np.asarray(cols['dec'], dtype=float)
+    if south:
+        priority -= 50.0 * np.exp(-(dec + 29)**2 / (2 * (20)**2))
+    else:
+        priority -= 50.0 * np.exp(-(dec - 33)**2 / (2 * (20)**2))
+
+    # Completion
+    if plan:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct = 0.9 * np.minimum(1, np.asarray(cols['vdone']) / vplan) +\
+                0.1 * np.minimum(1, np.asarray(cols['sn']) / (3136 * vplan))
+        pct[vplan == 0] = 1
+        priority[pct >= 1] = -2
+
+    # Cadence
+    maxhist = cols['maxhist']
+    priority[(schedule['jd'] != maxhist) & (schedule['jd'] - maxhist < 3)] = -1
+
+    # Manual override
+    priority[mp == 10] = 9999.0
+    priority[mp == 1] = -1.0
+
+    # In-Order Completion. Plates are halved once for every lower version plate on their field
+    # with priority > 1; lower version plates earlier in the list count with their final
+    # priority and later ones with their priority before this step, as in the plate loop.
+    if cohorts is None:
+        cohorts = CohortIndex(apg)
+    apgver = cohorts.apgver
+    order = np.lexsort((np.arange(len(apg)), cohorts.field))
+    field = cohorts.field[order]
+    first = np.searchsorted(field, field)
+    last = np.searchsorted(field, field, side='right')
+    initial = priority[order] > 1
+    for ver in np.unique(apgver):
+        level = apgver[order] == ver
+        if not np.any(level):
+            continue
+        lower = apgver[order] < ver
+        before = np.concatenate([[0], np.cumsum(lower & (priority[order] > 1))])
+        after = np.concatenate([[0], np.cumsum(lower & initial)])
+        # lower version plates before this one (final priority) and after it (initial priority)
+        count = (before[:-1] - before[first]) + (after[last] - after[1:])
+        idx = order[level]
+        priority[idx] = priority[idx] / 2.0**count[level]
+
+    # For south, de-prioritize plates for programs not scheduled tonight
+    if 'programs' in schedule:
+        other = np.array([c not in schedule['programs'] for c in cols['cadence']], dtype=bool)
+        priority[other] /= 10
+
+    if hasattr(apg, 'columns'):
+        apg.columns['priority'][:] = priority
+    else:
+        for p, value in zip(apg, priority):
+            p.priority = float(value)
+    set_pri_end = time()
+
+    if loud:
+        print("[PY] Prioritized APOGEE-II plates (%.3f sec)" % (set_pri_end - set_pri_start))
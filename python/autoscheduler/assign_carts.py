@@ -5,11 +5,82 @@ from autoscheduler.plateDBtools.database.connections import APODatabaseUserLocal
 from autoscheduler.plateDBtools.database.apo.platedb import ModelClasses as plateDB
 from autoscheduler.plateDBtools.database.apo.mangadb import ModelClasses as mangaDB
 from Totoro.utils.utils import avoid_cart_2
+from sqlalchemy.sql import func
+from autoscheduler.run_context import RunContext
+from autoscheduler.lru import LRUCache
 import numpy as np
-import os
+
+# scipy solves the cart matching exactly; without it every pick takes its cheapest cart in turn
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+# Cost terms of the cart matching, in decreasing order of importance. A pick left
+# without a cart costs 'unassigned', reusing the cart a plate is plugged in earns
+# 'reuse', and 'bump' (taking a MaNGA cart), 'cart2' (a plate that should avoid
+# cart 2 on it), 'coobs' (a co-observing plate outside carts 1-6) and 'order'
+# (per step down the cart order, weighted so earlier picks get the earlier carts)
+# are penalties. Unlike the sequential loops this replaced, 'bump' keeps every
+# APOGEE-II plate off the MaNGA carts while other carts < 10 are free (a plate
+# without co-observing used to take the next cart in order, MaNGA's or not). The
+# matching also weighs each pick against the others, so a co-observing plate gets
+# a cart 1-6 ahead of an APOGEE-only plate picked before it, and a plate plugged in
+# a cart of the other survey leaves it when a pick of that survey needs it; without
+# scipy, picks still take their carts in turn as before.
+CART_COSTS = {'unassigned': 1e6, 'reuse': -1e5, 'bump': 1e4, 'cart2': 1e3, 'coobs': 1e2, 'order': 1.0}
+FORBIDDEN = 1e12
+
+
+# Totoro's avoid_cart_2 answers, by plate id. They depend on the plate holes only, so
+# they do not expire; the least recently used are dropped beyond AVOID_CART_2_SIZE plates.
+AVOID_CART_2_SIZE = 4096
+_avoid_cart_2 = LRUCache(AVOID_CART_2_SIZE)
+
+
+def avoid_cart_2_plates(plateIDs):
+    """Returns a boolean array, True for the plates that should not go in cart 2.
+
+    Evaluates Totoro's avoid_cart_2 for the plate ids not in the (bounded)
+    cache, and answers the rest from it.
+    """
+
+    plateIDs = np.asarray(plateIDs, dtype=int)
+    answers = dict((plateid, _avoid_cart_2.get_or_compute(int(plateid), lambda: bool(avoid_cart_2(plateid))))
+                   for plateid in np.unique(plateIDs))
+    return np.array([answers[plateid] for plateid in plateIDs], dtype=bool)
+
+
+def avoid_cart_2_cached(plateid):
+    """Cached avoid_cart_2 for a single plate."""
+
+    return bool(avoid_cart_2_plates([plateid])[0])
 
 
-def mangaBrightPriority(plateIDs):
+def mangaTransparencies(session, plateIDs):
+    """Returns a dict of plate id -> sum of the MaNGA science exposure transparencies.
+
+    One aggregated query; plates without MaNGA data are left out. As in the
+    loop this replaced (exp.mangadbExposure[0]), only the first mangadb row
+    (lowest pk) of each exposure counts.
+    """
+
+    with session.begin():
+        first = session.query(func.min(mangaDB.Exposure.pk)).join(mangaDB.Exposure.platedbExposure)\
+            .group_by(plateDB.Exposure.pk)
+        rows = session.query(plateDB.Plate.plate_id, func.sum(mangaDB.Exposure.transparency))\
+            .join(plateDB.Plate.pluggings).join(plateDB.Plugging.observations)\
+            .join(plateDB.Observation.exposures).join(plateDB.Exposure.flavor)\
+            .join(plateDB.Exposure.survey).join(plateDB.Exposure.mangadbExposure)\
+            .filter(plateDB.Plate.plate_id.in_([int(p) for p in plateIDs]))\
+            .filter(plateDB.ExposureFlavor.label == 'Science')\
+            .filter(plateDB.Survey.label == 'MaNGA')\
+            .filter(mangaDB.Exposure.pk.in_(first))\
+            .group_by(plateDB.Plate.plate_id).all()
+    return dict((int(p), float(t)) for p, t in rows if t is not None)
+
+
+def mangaBrightPriority(plateIDs, session=None):
     """Sorts APOGEE plates in order of increasing MaNGA data.
 
     Gets a list of APOGEE plateIDs and returns them in order of increasing
@@ -19,35 +90,15 @@ def mangaBrightPriority(plateIDs):
 
     plateIDs = np.sort(plateIDs)
 
-    Session = APODatabaseUserLocalConnection.Session
-    session = Session()
+    if session is None:
+        session = APODatabaseUserLocalConnection.Session()
 
-    # Retrieves the plates from the DB
-    with session.begin():
-        plates = session.query(plateDB.Plate).filter(
-            plateDB.Plate.plate_id.in_(plateIDs)).order_by(
-                plateDB.Plate.plate_id).all()
-
-    # For each plate, gets a list with the transparency of each exposure.
-    mangaTransparencies = []
-    for plate in plates:
-        plateTransparencies = []
-        for plugging in plate.pluggings:
-            scienceExposures = plugging.scienceExposures()
-            for exp in scienceExposures:
-                if exp.survey.label != 'MaNGA':
-                    continue
-                if len(exp.mangadbExposure) == 0:
-                    continue
-                plateTransparencies.append(exp.mangadbExposure[0].transparency)
-        mangaTransparencies.append(plateTransparencies)
-
-    # Calculates the sum of the transparencies for each plate
-    sumOfTransparencies = np.array([np.sum(exps)
-                                    for exps in mangaTransparencies])
-
-    plates_to_avoid_cart_2 = np.array([avoid_cart_2(plateid)
-                                       for plateid in plateIDs])
+    # Sums the transparencies of the MaNGA exposures of each plate
+    transparencies = mangaTransparencies(session, plateIDs)
+    sumOfTransparencies = np.array([transparencies.get(int(plateid), 0.0)
+                                    for plateid in plateIDs])
+
+    plates_to_avoid_cart_2 = avoid_cart_2_plates(plateIDs)
     print(plates_to_avoid_cart_2)
     tier1 = plateIDs[plates_to_avoid_cart_2][
         np.argsort(sumOfTransparencies[plates_to_avoid_cart_2])]
@@ -59,40 +110,153 @@ def mangaBrightPriority(plateIDs):
     return tier1.tolist() + tier2.tolist()
 
 
-def assign_carts(apogee_choices, manga_choices, eboss_choices, errors, manga_cart_order, loud=True):
+def _solve_matching(cost, turns=None):
+    # Minimum-cost matching of the rows of cost to distinct columns
+    if linear_sum_assignment is not None:
+        return linear_sum_assignment(cost)
+    # without scipy, rows take their cheapest free column in turn: by turns (e.g. survey),
+    # then rows with a bonus (a plugged cart to reuse) first, then in order
+    if turns is None:
+        turns = np.zeros(len(cost), dtype=int)
+    rows, cols = [], []
+    used = set()
+    for r in np.lexsort((np.arange(len(cost)), cost.min(axis=1) >= 0, turns)):
+        for c in np.argsort(cost[r], kind='mergesort'):
+            if c not in used and cost[r, c] < FORBIDDEN:
+                rows.append(r)
+                cols.append(c)
+                used.add(c)
+                break
+    order = np.argsort(rows)
+    return np.array(rows, dtype=int)[order], np.array(cols, dtype=int)[order]
+
+
+def match_carts(apogee_choices, manga_choices, eboss_choices, carts, plugged, errors, avoid=avoid_cart_2_cached,
+                costs=CART_COSTS, stats=None):
+    '''
+    match_carts: Assigns APOGEE-II and eBOSS plates to cartridges as one minimum-cost matching.
+
+    Every pick is a row and every cartridge a column of a cost matrix built from the
+    CART_COSTS terms, with one extra "no cart" column per pick. APOGEE-II plates may use
+    carts < 10 and eBOSS plates carts >= 10, except that a plate can always stay in the
+    cart it is plugged in, unless MaNGA picked that cart. Otherwise earlier picks get
+    earlier carts in the cart order. An APOGEE-II plate only takes a MaNGA cart when no
+    other cart is left for it; MaNGA plates on carts taken by APOGEE-II are removed from
+    manga_choices.
+
+    INPUT: apogee_choices -- APOGEE-II picks, in plugging priority order (dicts with plate and coobs)
+           manga_choices -- MaNGA picks (dicts with cart and plateid)
+           eboss_choices -- eBOSS picks (dicts with plate)
+           carts -- available cartridge numbers, in cart priority order
+           plugged -- dict of cartridge number -> plate id currently plugged in it
+           errors -- list of error messages, appended to
+           avoid -- function of a plate id, True if the plate should not go in cart 2
+           costs -- dict of cost terms (defaults to CART_COSTS)
+           stats -- optional dict, filled with the total cost, its breakdown by term, and the
+                    plates left without a cart
+    OUTPUT: apgpicks, manpicks, ebopicks -- picks with their cart, as returned by assign_carts
+    '''
+    manga_carts = dict((m['cart'], i) for i, m in enumerate(manga_choices))
+    picks = [('apogee', c) for c in apogee_choices] + [('eboss', c) for c in eboss_choices]
+    npick, ncart = len(picks), len(carts)
+    terms = sorted(costs.keys())
+    # parts[term][pick, cart]: how many times each cost term applies
+    parts = dict((t, np.zeros([npick, ncart])) for t in terms)
+    allowed = np.zeros([npick, ncart], dtype=bool)
+    rank = np.arange(ncart)
+    for i, (survey, choice) in enumerate(picks):
+        plate = choice['plate']
+        for j, cart in enumerate(carts):
+            reuse = plate != -1 and plugged.get(cart) == plate and cart not in manga_carts
+            if survey == 'apogee':
+                allowed[i, j] = reuse or cart < 10
+                parts['bump'][i, j] = cart in manga_carts
+                parts['cart2'][i, j] = cart == 2 and plate != -1 and avoid(plate)
+                parts['coobs'][i, j] = choice['coobs'] and not 1 <= cart <= 6
+            else:
+                allowed[i, j] = reuse or cart >= 10
+            parts['reuse'][i, j] = reuse
+        parts['order'][i] = rank * (npick - i) / npick
+    cost = np.zeros([npick, ncart])
+    for t in terms:
+        if t != 'unassigned':
+            cost += costs[t] * parts[t]
+    cost[~allowed] = FORBIDDEN
+    # "no cart" columns, dropping the latest picks first when carts run out
+    nocart = np.zeros([npick, npick]) + FORBIDDEN
+    # (each step outweighs any change of the order terms of the others)
+    nocart[range(npick), range(npick)] = costs['unassigned'] + costs['order'] * max(ncart, 1) * npick * \
+        (npick - np.arange(npick))
+    rows, cols = _solve_matching(np.concatenate([cost, nocart], axis=1),
+                                 turns=[survey == 'eboss' for survey, choice in picks])
+    assigned = dict((r, c) for r, c in zip(rows, cols) if c < ncart)
+
+    # Build the picks, carts that were already plugged first
+    apgpicks, ebopicks = [], []
+    manpicks = list(manga_choices)
+    bumped = []
+    for reused in (True, False):
+        for i, (survey, choice) in enumerate(picks):
+            if i not in assigned or bool(parts['reuse'][i, assigned[i]]) != reused:
+                continue
+            cart = carts[assigned[i]]
+            thispick = choice
+            thispick['cart'] = cart
+            if survey == 'eboss':
+                ebopicks.append(thispick)
+                continue
+            thispick.pop('coobs', None)
+            if cart in manga_carts:
+                bumped.append(manga_choices[manga_carts[cart]])
+            if parts['cart2'][i, assigned[i]]:
+                errors.append('Plate {0} in cart 2 may not be pluggable.'.format(thispick['plate']))
+            apgpicks.append(thispick)
+    for m in bumped:
+        manpicks.remove(m)
+    # Report removed MaNGA plates
+    if len(bumped) > 0:
+        errors.append('Removed {} MaNGA Plates'.format(len(bumped)))
+
+    if stats is not None:
+        breakdown = dict((t, 0.0) for t in terms)
+        for i in range(npick):
+            if i in assigned:
+                for t in terms:
+                    if t != 'unassigned':
+                        breakdown[t] += costs[t] * parts[t][i, assigned[i]]
+            else:
+                breakdown['unassigned'] += costs['unassigned']
+        stats.update({'solver': 'matching' if linear_sum_assignment is not None else 'greedy',
+                      'cost': sum(breakdown.values()), 'breakdown': breakdown,
+                      'unassigned': [picks[i][1]['plate'] for i in range(npick) if i not in assigned]})
+    return apgpicks, manpicks, ebopicks
+
+
+def assign_carts(apogee_choices, manga_choices, eboss_choices, errors, manga_cart_order, loud=True, stats=None,
+                 context=None):
     '''
     assign_carts: Assigns all survey plate choices to cartridges.
 
     INPUT: apogee_choices -- dictionary list containing all APOGEE-II plate choices for tonight
            manga_choices -- dictionary list containing all MaNGA plate choices for tonight
            eboss_choices -- dictionary list containing all eBOSS plate choices for tonight
+           stats -- optional dict, filled with the matching cost breakdown (see match_carts)
+           context -- RunContext of the scheduler run (see run_context.py)
     OUTPUT: plugplan -- dictionary list containing all plugging choices for tonight
     '''
 
     cart_start = time()
-    # Create database connection
-    if (os.path.dirname(os.path.realpath(__file__))).find('utah.edu') >= 0:
-        from autoscheduler.plateDBtools.database.connections.UtahLocalConnection import db
-    else:
-        from autoscheduler.plateDBtools.database.connections.APODatabaseUserLocalConnection import db
-    session = db.Session()
+    # Database session and reference lookups of the run
+    if context is None:
+        context = RunContext(warm=False)
 
     # Read in all available cartridges
     # allcarts = session.execute("SET SCHEMA 'platedb'; "+
     #       "SELECT crt.number FROM platedb.cartridge AS crt "+
     #       "ORDER BY crt.number").fetchall()
-    allcarts = session.query(plateDB.Cartridge.number).order_by(plateDB.Cartridge.number).all()
-
-    plugplan = []
-    for c in allcarts:
-        plugplan.append({'cart': c[0], 'cartsurveys': 0, 'oldplate': 0, 'm_picked': 0})
-        if c[0] < 10:
-            plugplan[-1]['cartsurveys'] = 1
-        if c[0] >= 10:
-            plugplan[-1]['cartsurveys'] = 2
+    allcarts = context.cartridges()
 
     # Read in all plates that are currently plugged
-    # Co-observing plates are returned twice
     # currentplug = session.execute("SET SCHEMA 'platedb'; "+
     #   "SELECT crt.number, plt.plate_id "+
     #   "FROM (((((platedb.active_plugging AS ac "+
@@ -103,38 +267,21 @@ def assign_carts(apogee_choices, manga_choices, eboss_choices, errors, manga_car
     #       "LEFT JOIN platedb.plate_pointing as pltg ON (pltg.plate_pk=plt.pk)) "+
     #   "ORDER BY crt.number").fetchall()
     # coobserved plates no longer returned twice
-    currentplug = session.query(plateDB.Cartridge.number, plateDB.Plate.plate_id)\
-                                .join(plateDB.Plugging).join(plateDB.Plate).join(plateDB.ActivePlugging)\
-                                .order_by(plateDB.Cartridge.number).all()
-    for c, p in currentplug:
-        wcart = [x for x in range(len(plugplan)) if plugplan[x]['cart'] == c][0]
-        plugplan[wcart]['oldplate'] = p
+    currentplug = context.plugged()
+    plugged = dict((c, p) for c, p in currentplug)
 
     # Save MaNGA choices to cartridges (since they are the most dependent)
     manpicks = manga_choices
 
-    # Reorder plugplan to priority order
-    sort_plugplan = []
+    # Cartridges in priority order
     # eBOSS is just in order by cart number
     cart_order = [17, 16, 15, 14, 13, 12, 11, 10]
     # APOGEE and MaNGA carts are in an order determined by Totoro
     # cart_order.extend([9, 8, 7, 6, 5, 4, 3, 2, 1])
     cart_order.extend(manga_cart_order)
 
-    for c in cart_order:
-        pidx = [x for x in range(len(plugplan)) if plugplan[x]['cart'] == c]
-        if len(pidx) == 0:
-            continue
-        sort_plugplan.append(plugplan[pidx[0]])
-    plugplan = sort_plugplan
-
-    # Mark any cartridges already chosen by manga
-    if len(manpicks) > 0:
-        for c in manpicks:
-            wcart = [x for x in range(len(plugplan)) if plugplan[x]['cart'] == c['cart']]
-            if len(wcart) == 0:
-                continue
-            plugplan[wcart[0]]['m_picked'] = 1
+    available = set(allcarts)
+    carts = [c for c in cart_order if c in available]
 
     # Sort apogee_choices, so that non-co-observing plates are plugged first
     apogee_choices = sorted(apogee_choices, key=itemgetter('coobs'))
@@ -145,7 +292,7 @@ def assign_carts(apogee_choices, manga_choices, eboss_choices, errors, manga_car
     # Only do this if we have coobs plates
     if len(coobsplt) > 0:
         # Sort coobs plates in order of manga signal
-        coobsplt = mangaBrightPriority(coobsplt)
+        coobsplt = mangaBrightPriority(coobsplt, session=context.session)
         # Combine both plate lists together
         allplate = aponlyplt+coobsplt
         sort_choices = []
@@ -162,99 +309,9 @@ def assign_carts(apogee_choices, manga_choices, eboss_choices, errors, manga_car
         # Save the results
         apogee_choices = sort_choices
 
-    # Save APOGEE-II choices to cartridges
-    apgsaved = np.zeros(len(apogee_choices))
-    apgpicks = []
-    # First loop: assign plates to carts which are already plugged
-    for i in range(len(apogee_choices)):
-        wplate = [x for x in range(len(plugplan)) if apogee_choices[i]['plate'] == plugplan[x]['oldplate']]
-        if len(wplate) == 0:
-            continue
-        if plugplan[wplate[0]]['m_picked'] == 1:
-            continue
-        # Save new values to apgpicks
-
-        thispick = apogee_choices[i]
-        thispick['cart'] = plugplan[wplate[0]]['cart']
-        thispick['plate'] = apogee_choices[i]['plate']
-        plugplan[wplate[0]]['cart'] = -1
-        apgsaved[i] = 1
-        thispick.pop('coobs', None)
-        apgpicks.append(thispick)
-
-    manga_removed_plates = []
-    # Second loop: assign plates to carts which are not plugged
-    for i in range(len(apogee_choices)):
-        if apgsaved[i] == 1:
-            continue
-        if apogee_choices[i]['coobs']:
-            # Co-observing plates prefer being on carts 1 - 6
-            carts_avail = [x for x in range(len(plugplan)) if plugplan[x]['cart'] >= 0 and plugplan[x]['cart'] <= 6 and plugplan[x]['m_picked'] == 0]
-            if len(carts_avail) == 0:
-                carts_avail = [x for x in range(len(plugplan)) if plugplan[x]['cart'] >= 0 and plugplan[x]['cartsurveys'] == 1]
-        else:
-            carts_avail = [x for x in range(len(plugplan)) if plugplan[x]['cart'] >= 0 and plugplan[x]['cartsurveys'] == 1]
-        if len(carts_avail) == 0:
-            continue
-
-        # Remove cart from MaNGA list
-        if plugplan[carts_avail[0]]['m_picked'] == 1:
-            wcart = [x for x in range(len(manpicks)) if plugplan[carts_avail[0]]['cart'] == manpicks[x]['cart']]
-            manga_removed_plates.append(manpicks[wcart[0]]['plateid'])
-            manpicks.pop(wcart[0])
-
-        # Save new values to apgpicks
-        thispick = apogee_choices[i]
-        thispick.pop('coobs', None)
-        plate_id = thispick['plate']
-
-        if plate_id == -1 or not avoid_cart_2(plate_id):
-            # If the plate holes are separated enough for cart 2.
-            selected_cart = carts_avail[0]
-        else:
-            # If the plate cannot be plugged in cart 2 loops until it gets
-            # a different cart or gets to the last cart available.
-            for cart in carts_avail:
-                if cart != 2 or cart == carts_avail[-1]:
-                    selected_cart = cart
-                    break
-            if cart == 2:
-                errors.append('Plate {0} in cart 2 may not be pluggable.'.format(plate_id))
-
-        thispick['cart'] = plugplan[selected_cart]['cart']
-        plugplan[selected_cart]['cart'] = -1
-        apgpicks.append(thispick)
-
-        # Report removed MaNGA plates
-    if len(manga_removed_plates) > 0:
-        errors.append('Removed {} MaNGA Plates'.format(len(manga_removed_plates)))
-
-        # Save eBOSS choices to cartridges
-    ebosaved = np.zeros(len(eboss_choices))
-    ebopicks = []
-    # First loop: assign plates to carts which are already plugged
-    for i in range(len(eboss_choices)):
-        wplate = [x for x in range(len(plugplan)) if eboss_choices[i]['plate'] == plugplan[x]['oldplate']]
-        if len(wplate) == 0:
-            continue
-        # Save new values to ebopicks
-        thispick = eboss_choices[i]
-        thispick['cart'] = plugplan[wplate[0]]['cart']
-        plugplan[wplate[0]]['cart'] = -1
-        ebosaved[i] = 1
-        ebopicks.append(thispick)
-    # Second loop: assign plates to carts which are not plugged
-    for i in range(len(eboss_choices)):
-        if ebosaved[i] == 1:
-            continue
-        carts_avail = [x for x in range(len(plugplan)) if plugplan[x]['cart'] >= 0 and plugplan[x]['cartsurveys'] == 2]
-        if len(carts_avail) == 0:
-            continue
-        # Save new values to ebopicks
-        thispick = eboss_choices[i]
-        thispick['cart'] = plugplan[carts_avail[0]]['cart']
-        plugplan[carts_avail[0]]['cart'] = -1
-        ebopicks.append(thispick)
+    # Match plates to cartridges
+    apgpicks, manpicks, ebopicks = match_carts(apogee_choices, manpicks, eboss_choices, carts, plugged, errors,
+                                               stats=stats)
 
     cart_end = time()
     if loud:
@@ -5,32 +5,34 @@ from operator import itemgetter
 import numpy as np
 import os
 import autoscheduler.apogee as apg
+from autoscheduler.run_context import RunContext
 
 
-def assign_carts(schedule, errors, loud=True):
+def assign_carts(schedule, errors, loud=True, context=None, plates=None):
     '''
     assign_carts: Assigns all survey plate choices to cartridges.
 
     INPUT: night schedule (NOTE: this behavior is different from the north)
+           context -- RunContext of the scheduler run (see run_context.py)
+           plates -- APOGEE-II plates to schedule from, instead of reading them from the database
     OUTPUT: plugplan -- dictionary list containing all plugging choices for tonight
     '''
 
     cart_start = time()
-    # Create database connection
-    from autoscheduler.plateDBtools.database.connections.LCODatabaseUserLocalConnection import db
-    session = db.Session()
-    from autoscheduler.plateDBtools.database.apo.platedb import ModelClasses as plateDB
+    # Database session and reference lookups of the run
+    if context is None:
+        context = RunContext(south=True, warm=False)
 
     # Read in all available cartridges
     # allcarts = session.execute("SET SCHEMA 'platedb'; "+
     #       "SELECT crt.number FROM platedb.cartridge AS crt "+
     #       "ORDER BY crt.number").fetchall()
-    allcarts = session.query(plateDB.Cartridge.number).order_by(plateDB.Cartridge.number).all()
+    allcarts = context.cartridges()
 
     plugplan = list()
 
     for c in allcarts:
-        plugplan.append({'cart': c[0], 'oldplate': 0})
+        plugplan.append({'cart': c, 'oldplate': 0})
 
     # Read in all plates that are currently plugged
 
@@ -44,9 +46,7 @@ def assign_carts(schedule, errors, loud=True):
     #       "LEFT JOIN platedb.plate_pointing as pltg ON (pltg.plate_pk=plt.pk)) "+
     #   "ORDER BY crt.number").fetchall()
 
-    currentplug = session.query(plateDB.Cartridge.number, plateDB.Plate.plate_id)\
-                                .join(plateDB.Plugging).join(plateDB.Plate).join(plateDB.ActivePlugging)\
-                                .order_by(plateDB.Cartridge.number).all()
+    currentplug = context.plugged()
 
     # add current plug plate. leave logic alone; it works
     for c, p in currentplug:
@@ -58,7 +58,8 @@ def assign_carts(schedule, errors, loud=True):
     nightLength = (schedule['bright_end'] - schedule['bright_start']) * 24
     nslots = int(round(nightLength / ((par['exposure'] + par['overhead']) / 60)))
     par['ncarts'] = nslots
-    apogee_choices = apg.schedule_apogee(schedule=schedule, errors=errors, par=par, plan=True, loud=loud, south=True)
+    apogee_choices = apg.schedule_apogee(schedule=schedule, errors=errors, par=par, plan=True, loud=loud, south=True,
+                                         plates=plates, context=context)
 
     # Save APOGEE-II choices to cartridges
     apgpicks = list()
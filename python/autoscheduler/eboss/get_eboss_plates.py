@@ -1,10 +1,10 @@
 from __future__ import print_function, division
 from time import time
-import os
 import math
 import autoscheduler.plateDBtools.database.apo.platedb.ModelClasses as plateDB
 from sqlalchemy import or_
 from sqlalchemy import desc
+from autoscheduler.run_context import site_connection
 
 # EBOPLATE OBJECT DENITION
 # DESCRIPTION: eBOSS Plate Object
@@ -37,15 +37,14 @@ class eboplate(object):
 
 # GET_PLATES
 # DESCRIPTION: Reads in eBOSS plate information from platedb
-# INPUT: none
+# INPUT: context -- RunContext of the scheduler run, for its session (optional)
 # OUTPUT: ebo -- list of dicts with all eBOSS plate information
-def get_plates(plan=False, loud=True):
-    # Create database connection
-    if (os.path.dirname(os.path.realpath(__file__))).find('utah.edu') >= 0:
-        from autoscheduler.plateDBtools.database.connections.UtahLocalConnection import db
+def get_plates(plan=False, loud=True, context=None):
+    # Database session of the run, or of the site connection
+    if context is not None:
+        session = context.session
     else:
-        from autoscheduler.plateDBtools.database.connections.APODatabaseUserLocalConnection import db
-    session = db.Session()
+        session = site_connection().Session()
 
     # Look at all plates for plugging purposes
     stage1_start = time()
@@ -3,7 +3,106 @@ from time import time
 import numpy as np
 
 
-def pick_plates(ebo, par, times, obs, loud=True):
+def place_plates(ebo, par, obs, chosen):
+    '''
+    place_plates: fills the free slots with un-plugged plates by dynamic programming
+
+    Each plate needs visleft() consecutive slots. Every window of that length (cut at the
+    end of the night) where the plate is observable and the slots are free is an interval
+    worth the summed observability over it. The DP over slots and carts still available
+    picks the set of non-overlapping intervals of highest total worth using at most ncarts
+    plates in all (already-plugged plates included); a plate picked twice keeps its better
+    window and the other one is banned before solving again.
+
+    INPUT: ebo -- list of eBOSS plates
+           par -- eBOSS parameters (ncarts and the visleft parameters)
+           obs -- observability matrix (nplate x nslot), already-placed plates set to -10
+           chosen -- plateid per slot, -1 for free slots
+    OUTPUT: chosen -- updated plateid per slot
+    '''
+    nslot = len(chosen)
+    if len(ebo) == 0 or nslot == 0:
+        return chosen
+    chosen = list(chosen)
+    ncarts = par['ncarts'] - len(set([c for c in chosen if c >= 0]))
+    if ncarts <= 0:
+        return chosen
+
+    nleft = np.array([p.visleft(par) for p in ebo])
+    # Slots a plate cannot use: not observable or already taken
+    bad = (obs < 0) | np.array([c >= 0 for c in chosen])[np.newaxis, :]
+    nbad = np.concatenate([np.zeros([len(ebo), 1]), np.cumsum(bad, axis=1)], axis=1)
+    worth = np.concatenate([np.zeros([len(ebo), 1]), np.cumsum(np.where(bad, 0, obs), axis=1)], axis=1)
+    lengths = np.unique(nleft[nleft > 0])
+    # Every plate is complete: nothing to place
+    if len(lengths) == 0:
+        return chosen
+    start = np.arange(nslot)
+    banned = np.zeros(obs.shape, dtype=bool)
+
+    while True:
+        # Best plate for every (start slot, window length)
+        best = np.zeros([nslot, len(lengths)]) - np.inf
+        bestp = np.zeros([nslot, len(lengths)], dtype=int) - 1
+        ends = np.minimum(start[:, np.newaxis] + lengths[np.newaxis, :], nslot)
+        for j, length in enumerate(lengths):
+            plates = np.flatnonzero(nleft == length)
+            end = ends[:, j]
+            ok = (nbad[plates][:, end] - nbad[plates][:, start] == 0) & ~banned[plates]
+            value = np.where(ok, worth[plates][:, end] - worth[plates][:, start], -np.inf)
+            arg = np.argmax(value, axis=0)
+            best[:, j] = value[arg, start]
+            bestp[:, j] = np.where(np.isfinite(best[:, j]), plates[arg], -1)
+
+        # total[t, k]: best worth of slots t.. with k carts left
+        total = np.zeros([nslot + 1, ncarts + 1])
+        move = np.zeros([nslot, ncarts + 1], dtype=int) - 1
+        for t in range(nslot - 1, -1, -1):
+            total[t] = total[t + 1]
+            for k in range(1, ncarts + 1):
+                gain = best[t] + total[ends[t], k - 1]
+                j = np.argmax(gain)
+                if np.isfinite(gain[j]) and gain[j] > total[t, k]:
+                    total[t, k] = gain[j]
+                    move[t, k] = j
+
+        # Walk the DP to get the chosen intervals
+        picks = []
+        t, k = 0, ncarts
+        while t < nslot:
+            if k > 0 and move[t, k] >= 0:
+                j = move[t, k]
+                picks.append((bestp[t, j], t, ends[t, j], best[t, j]))
+                t, k = ends[t, j], k - 1
+            else:
+                t += 1
+
+        # A plate placed twice keeps its best window
+        placed = dict()
+        repeat = False
+        for p, t0, t1, value in picks:
+            if p in placed:
+                repeat = True
+                other = placed[p]
+                if value > other[2]:
+                    banned[p, other[0]] = True
+                    placed[p] = (t0, t1, value)
+                else:
+                    banned[p, t0] = True
+            else:
+                placed[p] = (t0, t1, value)
+        if not repeat:
+            break
+
+    for p, (t0, t1, value) in placed.items():
+        for t in range(t0, t1):
+            chosen[t] = ebo[p].plateid
+    return chosen
+
+
+def pick_plates(ebo, par, times, obs, loud=True, solver='greedy'):
+    if solver not in ('greedy', 'dp'):
+        raise ValueError("Unknown eBOSS solver '{}'".format(solver))
     # Setup
     chosen = [-1 for x in times]
 
@@ -42,30 +141,33 @@ def pick_plates(ebo, par, times, obs, loud=True):
             
     # Loop through all un-scheduled blocks and place plates
     ebossrest_start = time()
-    t = 0
-    while t < len(chosen):
-        if chosen[t] >= 0 or len(np.unique(chosen)) > par['ncarts']:
-            t += 1
-            continue
-        # Choose the highest-priority plate for this slot
-        priorder = np.argsort(obs[:,t])
-        p = priorder[-1]
-        if obs[p,t] < 0:
-            if loud: print("[WARN] No eBOSS plates for slot %2d. Max priority = %4.1f" % (t, max(obs[:,t])))
-            t += 1
-            continue
-        nleft = ebo[p].visleft(par)
-        # Check to see whether plate can be observed for the entire necessary block
-        endblock = min([t+nleft, len(chosen)-1])
-        if obs[p,endblock] < 0:
-            # If it cannot be placed in this block, then remove it from the running and try again
-            obs[p,t] = -10
-            continue
-        # Place plate in expected number of slots
-        for i in range(nleft):
-            if t+i >= len(chosen): continue
-            chosen[t+i] = ebo[p].plateid
-        for i in range(len(times)): obs[p,i] = -10
+    if solver == 'dp':
+        chosen = place_plates(ebo, par, obs, chosen)
+    else:
+        t = 0
+        while t < len(chosen):
+            if chosen[t] >= 0 or len(np.unique(chosen)) > par['ncarts']:
+                t += 1
+                continue
+            # Choose the highest-priority plate for this slot
+            priorder = np.argsort(obs[:,t])
+            p = priorder[-1]
+            if obs[p,t] < 0:
+                if loud: print("[WARN] No eBOSS plates for slot %2d. Max priority = %4.1f" % (t, max(obs[:,t])))
+                t += 1
+                continue
+            nleft = ebo[p].visleft(par)
+            # Check to see whether plate can be observed for the entire necessary block
+            endblock = min([t+nleft, len(chosen)-1])
+            if obs[p,endblock] < 0:
+                # If it cannot be placed in this block, then remove it from the running and try again
+                obs[p,t] = -10
+                continue
+            # Place plate in expected number of slots
+            for i in range(nleft):
+                if t+i >= len(chosen): continue
+                chosen[t+i] = ebo[p].plateid
+            for i in range(len(times)): obs[p,i] = -10
     ebossrest_end = time()
     if loud: print("[PY] Placed new eBOSS plates (%.3f sec)" % (pickplug_end - pickplug_start))
 
@@ -2,6 +2,7 @@ from __future__ import print_function, division
 from time import time
 import numpy as np
 
+from autoscheduler.ephemeris import night_ephemeris
 from get_eboss_plates import get_plates
 from observability import observability
 from pick_eboss_plates import pick_plates
@@ -9,8 +10,11 @@ from pick_eboss_plates import pick_plates
 # SCHEDULE_EBOSS
 # DESCRIPTION: Main eBOSS scheduling routine.
 # INPUT: schedule -- dictionary defining important schedule times throughout the night
+#        solver -- 'greedy' (slot by slot) or 'dp' (interval DP, see pick_eboss_plates.place_plates)
+#        context -- RunContext of the scheduler run (see run_context.py)
+#        plates -- eBOSS plates to schedule from, instead of reading them from the database (not modified)
 # OUTPUT: eboss_choices -- dictionary list containing plate choices + observing times for tonight 
-def schedule_eboss(schedule, errors, plan=False, loud=True):
+def schedule_eboss(schedule, errors, plan=False, loud=True, solver='greedy', context=None, plates=None):
     # Define eBOSS observing parameters
     par = {'exposure': 16.5, 'ncarts': 8, 'maxz': 2.0, 'moon_threshold': 30, 'snr_avg':4.9, 'snb_avg': 2.2, 'snr': 22, 'snb': 10}
     
@@ -20,7 +24,10 @@ def schedule_eboss(schedule, errors, plan=False, loud=True):
     if len(times) == 0: return []
 
     # Get all plate information from the database
-    ebo = get_plates(plan=plan, loud=loud)
+    if plates is None:
+        ebo = get_plates(plan=plan, loud=loud, context=context)
+    else:
+        ebo = plates
     if len(ebo) == 0:
         errors.append('eBOSS PLATE ERROR: No eBOSS plates found. Aborting.')
         return []
@@ -33,7 +40,7 @@ def schedule_eboss(schedule, errors, plan=False, loud=True):
         return eboss_choices
     
     # Determine observability
-    obs = observability(ebo, par, times, loud=loud)
+    obs = observability(ebo, par, times, loud=loud, ephem=night_ephemeris('apo', schedule['jd']))
     
     if loud:
         of = open("eboss.txt", 'w')
@@ -44,7 +51,7 @@ def schedule_eboss(schedule, errors, plan=False, loud=True):
         of.close()
     
     # Pick plates for tonight
-    eboss_choices = pick_plates(ebo, par, times, obs, loud=loud)
+    eboss_choices = pick_plates(ebo, par, times, obs, loud=loud, solver=solver)
 
     return eboss_choices
 
@@ -0,0 +1,243 @@
+from __future__ import print_function, division
+import os
+import numpy as np
+from autoscheduler import observability_kernel as kernel
+from autoscheduler.lru import LRUCache
+from autoscheduler.sdssUtilities.idlasl import moonpos, sunpos
+
+# EPHEMERIS
+# DESCRIPTION: Per-night ephemeris (LST, moon position and phase, sun altitude) on a regular JD grid.
+#              Survey modules interpolate from it instead of recomputing for every slot boundary,
+#              and nights are memoized so repeated requests for the same MJD pay the cost once.
+#              Nights covered by a precompiled table (see build_table) are memory-mapped from disk.
+
+# Grid spacing (days) and the part of the JD a night covers, relative to the schedule JD
+DEFAULT_STEP = 10 / 60 / 24
+NIGHT_START = 0.35
+NIGHT_END = 1.15
+
+# Precompiled tables live next to the schedule files, one per site
+TABLE_DIR = '/'.join(os.path.dirname(os.path.realpath(__file__)).split('/')[0:-2]) + '/schedules/'
+TABLE_FILES = {'apo': 'Eph_APO_base.npy', 'lco': 'Eph_LCO_base.npy'}
+
+_cache = LRUCache(maxsize=32)
+_tables = dict()
+
+
+def _moon_phase(moon_ra, moon_dec, moon_dist, sun_ra, sun_dec):
+    # Illuminated fraction of the moon, as in idlasl.moonphase
+    edist = 1.49598e8
+    ram, decm = np.radians(moon_ra), np.radians(moon_dec)
+    ras, decs = np.radians(sun_ra), np.radians(sun_dec)
+    phi = np.arccos(np.sin(decs)*np.sin(decm) + np.cos(decs)*np.cos(decm)*np.cos(ras-ram))
+    inc = np.arctan2(edist * np.sin(phi), moon_dist - edist*np.cos(phi))
+    return (1 + np.cos(inc)) / 2.
+
+
+class LiveEphemeris(object):
+    """Computes every quantity directly at the requested times."""
+
+    def __init__(self, site='apo'):
+        self.site = site
+        self.obs_site = kernel.get_site(site == 'lco')
+        self.latitude = self.obs_site.latitude.d
+
+    def lst(self, jd):
+        jd = np.atleast_1d(np.asarray(jd, dtype=float))
+        return np.array([self.obs_site.localSiderialTime(x) for x in jd.ravel()]).reshape(jd.shape)
+
+    def moon(self, jd):
+        jd = np.atleast_1d(np.asarray(jd, dtype=float)).ravel()
+        return np.array([moonpos(x)[0:2] for x in jd]).reshape(-1, 2)
+
+    def moon_phase(self, jd):
+        jd = np.atleast_1d(np.asarray(jd, dtype=float)).ravel()
+        mpos = [moonpos(x) for x in jd]
+        spos = sunpos(jd)
+        return _moon_phase(np.array([m[0] for m in mpos]), np.array([m[1] for m in mpos]),
+                           np.array([m[2][0] for m in mpos]), np.ravel(spos[1]), np.ravel(spos[2]))
+
+    def sun_altitude(self, jd):
+        jd = np.atleast_1d(np.asarray(jd, dtype=float)).ravel()
+        spos = sunpos(jd)
+        ha = np.radians(self.lst(jd) * 15 - np.ravel(spos[1]))
+        dec, lat = np.radians(np.ravel(spos[2])), np.radians(self.latitude)
+        return np.degrees(np.arcsin(np.sin(dec)*np.sin(lat) + np.cos(dec)*np.cos(lat)*np.cos(ha)))
+
+
+class NightEphemeris(LiveEphemeris):
+    """Ephemeris for one site tabulated on a regular JD grid.
+
+    Each quantity is tabulated the first time it is requested and linearly
+    interpolated after that. Times outside the grid are computed directly.
+
+    Parameters
+    ----------
+    site : str
+        'apo' or 'lco'.
+
+    jd_start, jd_end : float
+        The range of the grid.
+
+    step : float
+        The grid spacing in days.
+
+    """
+
+    def __init__(self, site, jd_start, jd_end, step=DEFAULT_STEP):
+        super(NightEphemeris, self).__init__(site)
+        self.step = step
+        self.jd = jd_start + step * np.arange(int(np.ceil((jd_end - jd_start) / step - 1e-9)) + 1)
+        self._lst = None
+        self._moon = None
+        self._moon_phase = None
+        self._sun_alt = None
+
+    def _inside(self, jd):
+        return (jd >= self.jd[0]) & (jd <= self.jd[-1])
+
+    def _interp(self, jd, grid, live):
+        jd = np.atleast_1d(np.asarray(jd, dtype=float))
+        out = np.interp(jd.ravel(), self.jd, grid)
+        outside = ~self._inside(jd.ravel())
+        if np.any(outside):
+            out[outside] = live(jd.ravel()[outside])
+        return out.reshape(jd.shape)
+
+    def lst(self, jd):
+        if self._lst is None:
+            # Unwrap so the interpolation does not cross the 24 hour boundary
+            grid = super(NightEphemeris, self).lst(self.jd)
+            self._lst = np.unwrap(grid * np.pi / 12) * 12 / np.pi
+        return self._interp(jd, self._lst, super(NightEphemeris, self).lst) % 24
+
+    def moon(self, jd):
+        if self._moon is None:
+            mpos = [moonpos(x) for x in self.jd]
+            self._moon = kernel.unit_vectors(np.array([m[0] for m in mpos]), np.array([m[1] for m in mpos]))
+            spos = sunpos(self.jd)
+            self._moon_phase = _moon_phase(np.array([m[0] for m in mpos]), np.array([m[1] for m in mpos]),
+                                           np.array([m[2][0] for m in mpos]), np.ravel(spos[1]), np.ravel(spos[2]))
+        jd = np.atleast_1d(np.asarray(jd, dtype=float)).ravel()
+        xyz = np.array([np.interp(jd, self.jd, self._moon[i]) for i in range(3)])
+        ra = np.degrees(np.arctan2(xyz[1], xyz[0])) % 360
+        dec = np.degrees(np.arctan2(xyz[2], np.sqrt(xyz[0]**2 + xyz[1]**2)))
+        out = np.array([ra, dec]).T
+        outside = ~self._inside(jd)
+        if np.any(outside):
+            out[outside] = super(NightEphemeris, self).moon(jd[outside])
+        return out
+
+    def moon_phase(self, jd):
+        if self._moon_phase is None:
+            self.moon(self.jd[0])
+        return self._interp(jd, self._moon_phase, super(NightEphemeris, self).moon_phase)
+
+    def sun_altitude(self, jd):
+        if self._sun_alt is None:
+            self._sun_alt = super(NightEphemeris, self).sun_altitude(self.jd)
+        return self._interp(jd, self._sun_alt, super(NightEphemeris, self).sun_altitude)
+
+    def twilight(self, altitude=-12.0):
+        """Returns the JDs at which the sun crosses `altitude` going down and coming up
+        (0 if it does not happen within the grid)."""
+        above = self.sun_altitude(self.jd) > altitude
+        times = []
+        for rising in (False, True):
+            cross = np.where(above[1:] & ~above[:-1])[0] if rising else np.where(above[:-1] & ~above[1:])[0]
+            if len(cross) == 0:
+                times.append(0.0)
+                continue
+            i = cross[-1] if rising else cross[0]
+            alt = self._sun_alt[i:i+2]
+            times.append(float(self.jd[i] + self.step * (altitude - alt[0]) / (alt[1] - alt[0])))
+        return times
+
+    def tabulate(self):
+        # Fill every grid now instead of on first use
+        self.lst(self.jd[0])
+        self.moon(self.jd[0])
+        self.sun_altitude(self.jd[0])
+        return self
+
+    @classmethod
+    def from_table(cls, site, row):
+        # Ephemeris whose grids are views into one night of a precompiled table
+        ephem = cls.__new__(cls)
+        LiveEphemeris.__init__(ephem, site)
+        ephem.step = float(row['step'])
+        ephem.jd = row['jd'] + NIGHT_START + ephem.step * np.arange(row['lst'].shape[0])
+        ephem._lst = row['lst']
+        ephem._moon = row['moon']
+        ephem._moon_phase = row['moon_phase']
+        ephem._sun_alt = row['sun_alt']
+        return ephem
+
+
+def get_ephemeris(site, jd_start, jd_end, step=DEFAULT_STEP):
+    '''
+    get_ephemeris: returns the (memoized) ephemeris for a site and JD grid
+
+    INPUT: site -- 'apo' or 'lco'
+           jd_start, jd_end -- range to cover; snapped outwards onto the step grid
+           step -- grid spacing (days)
+    OUTPUT: NightEphemeris object
+    '''
+    first = int(np.floor(jd_start / step))
+    last = int(np.ceil(jd_end / step))
+    key = (site, first, last, step)
+    return _cache.get_or_compute(key, NightEphemeris, site, first * step, last * step, step)
+
+
+def load_table(site):
+    '''
+    load_table: memory-maps the precompiled ephemeris table for a site (read-only, shared between processes)
+
+    INPUT: site -- 'apo' or 'lco'
+    OUTPUT: structured array with one row per night, or None if no table has been built
+    '''
+    if site not in _tables:
+        path = TABLE_DIR + TABLE_FILES[site]
+        if os.path.exists(path):
+            _tables[site] = np.load(path, mmap_mode='r')
+        else:
+            _tables[site] = None
+    return _tables[site]
+
+
+def night_ephemeris(site, jd):
+    # Ephemeris covering the whole night that starts on schedule JD `jd`
+    jd = int(jd)
+    table = load_table(site)
+    if table is not None and len(table) > 0:
+        row = int(np.searchsorted(table['jd'], jd))
+        if row < len(table) and table['jd'][row] == jd and table['step'][row] == DEFAULT_STEP:
+            return _cache.get_or_compute((site, jd, 'table'), NightEphemeris.from_table, site, table[row])
+    # Outside the table, compute it live
+    return get_ephemeris(site, jd + NIGHT_START, jd + NIGHT_END)
+
+
+def build_table(site, schedule_file, output=None, step=DEFAULT_STEP, loud=True):
+    '''
+    build_table: precomputes the ephemeris for every night of a schedule file
+
+    INPUT: site -- 'apo' or 'lco'
+           schedule_file -- Sch_APO_base.dat or Sch_LCO_base.dat style file (first column is the JD)
+           output -- file to write, defaults to the table night_ephemeris looks for
+           step -- grid spacing (days)
+    OUTPUT: the table, also saved with numpy.save so it can be memory-mapped
+    '''
+    jds = [int(float(line.split()[0])) for line in open(schedule_file) if line.strip() and line[0] != '#']
+    npts = int(np.ceil((NIGHT_END - NIGHT_START) / step - 1e-9)) + 1
+    dtype = [('jd', 'f8'), ('step', 'f8'), ('lst', 'f8', npts), ('moon', 'f8', (3, npts)),
+             ('moon_phase', 'f8', npts), ('sun_alt', 'f8', npts)]
+    table = np.zeros(len(jds), dtype=dtype)
+    for i, jd in enumerate(jds):
+        ephem = NightEphemeris(site, jd + NIGHT_START, jd + NIGHT_START + step * (npts - 1), step).tabulate()
+        table[i] = (jd, step, ephem._lst, ephem._moon, ephem._moon_phase, ephem._sun_alt)
+        if loud and i % 100 == 0:
+            print("[PY] Ephemeris for JD %d (%d/%d)" % (jd, i + 1, len(jds)))
+    if output is None:
+        output = TABLE_DIR + TABLE_FILES[site]
+    np.save(output, table)
+    return table
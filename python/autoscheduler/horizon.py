@@ -0,0 +1,204 @@
+# ---- SDSS-IV AUTOSCHEDULER: ROLLING HORIZON ----
+# DESCRIPTION: Plans APOGEE-II over a range of nights, looking a few nights ahead
+# of each one so that cadence rules and limited observing windows are planned
+# for, instead of taking the best plates of every night on its own.
+
+from __future__ import print_function, division
+from time import time
+import os
+import numpy as np
+
+from autoscheduler import night_schedule
+from autoscheduler import observability_kernel as kernel
+from autoscheduler.ephemeris import night_ephemeris
+from autoscheduler.s4as import apogee_twilight, plan_output
+from autoscheduler.plateDBtools.apogee.get_apogee_plates import get_plates
+from autoscheduler.plateDBtools.apogee.cohorts import CohortIndex
+from autoscheduler.apogee.schedule_apogee import DEFAULT_PAR, apogee_slots
+from autoscheduler.apogee.set_apogee_priorities import set_priorities_array
+from autoscheduler.apogee.observability import observability, observability_terms
+from autoscheduler.apogee.pick_apogee_plates import pick_plates
+
+# scipy is only needed to look ahead (horizon > 1)
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+class Night(object):
+    """One night of the horizon: its schedule, APOGEE-II slots and the
+    priority-independent observability terms, computed once and reused
+    every time the night is scored.
+
+    """
+
+    def __init__(self, schedule, surveys, par):
+        self.schedule = night_schedule.adjust_schedule(schedule, surveys)
+        self.jd = self.schedule['jd']
+        self.twilight = apogee_twilight(self.schedule)
+        if self.twilight is None:
+            self.times, self.lengths = [], []
+        else:
+            self.times, self.lengths = apogee_slots(self.schedule, par, twilight=self.twilight)
+        self._terms = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def terms(self, apg, par, index):
+        if self._terms is None:
+            ephem = night_ephemeris('apo', self.jd)
+            self._terms = observability_terms(apg, par, self.times, self.lengths, ephem=ephem, index=index)
+        return self._terms
+
+    def score(self, apg, par, cohorts, index):
+        '''Observability matrix of the plates for this night, from their current state'''
+        set_priorities_array(apg, par, self.schedule, plan=True, loud=False, twilight=self.twilight,
+                             cohorts=cohorts)
+        return observability(apg, par, self.times, self.lengths, loud=False, index=index,
+                             terms=self.terms(apg, par, index))
+
+
+def reserve_later(scores, cohorts, discount=0.9):
+    '''
+    reserve_later: cohorts that are worth more on a later night of the horizon than tonight
+
+    Every cohort (location ID + apogee version) gets at most one visit in the horizon, as
+    the 3 day cadence allows, and is assigned to the slots of all the horizon nights at
+    once, maximizing the summed observability, discounted by discount per night ahead.
+
+    INPUT: scores -- (offset, observability matrix) pairs of tonight (offset 0) and the nights
+                     after it, offset being the number of nights ahead and the matrices nplate x nslot
+           cohorts -- CohortIndex of the plates
+           discount -- weight of the next night relative to tonight
+    OUTPUT: reserved -- indices of the plates whose cohort is assigned to a later night
+    '''
+    if len(scores) < 2 or cohorts.ncohort == 0:
+        return np.zeros(0, dtype=int)
+    if linear_sum_assignment is None:
+        raise RuntimeError('scipy not installed: cannot plan over a horizon.')
+    order = np.argsort(cohorts.cohort, kind='mergesort')
+    starts = np.searchsorted(cohorts.cohort[order], np.arange(cohorts.ncohort))
+    gain = np.concatenate([np.maximum(np.maximum.reduceat(obs[order], starts, axis=0), 0) * discount**offset
+                           for offset, obs in scores if obs.shape[1] > 0], axis=1)
+    night = np.concatenate([np.zeros(obs.shape[1], dtype=int) + offset for offset, obs in scores])
+    if gain.shape[1] == 0:
+        return np.zeros(0, dtype=int)
+    # only the best nslot cohorts of every slot can be part of the assignment
+    k = min(gain.shape[1], cohorts.ncohort)
+    cand = np.unique(np.argpartition(-gain, k - 1, axis=0)[:k]) if k < cohorts.ncohort else np.arange(cohorts.ncohort)
+    cand = cand[np.any(gain[cand] > 0, axis=1)]
+    if len(cand) == 0:
+        return np.zeros(0, dtype=int)
+    r, t = linear_sum_assignment(-gain[cand])
+    later = cand[r[(night[t] > 0) & (gain[cand[r], t] > 0)]]
+    if len(later) == 0:
+        return np.zeros(0, dtype=int)
+    return np.concatenate([cohorts.cohorts[c] for c in later])
+
+
+def simulate_visits(apg, cohorts, plates, jd, par):
+    '''
+    simulate_visits: records a visit on jd for the cohorts of the given plates
+
+    INPUT: apg -- PlateTable
+           cohorts -- CohortIndex of apg
+           plates -- indices of the observed plates
+           jd -- JD of the night
+           par -- APOGEE-II parameters (sn_target is the S/N^2 a visit adds)
+    OUTPUT: none, updates visits, visit_sn, visit_reduced, first_visit, last_visit, vdone and sn
+    '''
+    cols = apg.columns
+    done = set()
+    for p in plates:
+        if cohorts.cohort[p] in done:
+            continue
+        done.add(cohorts.cohort[p])
+        members = cohorts.same_cohort(p)
+        cols['first_visit'][members[cols['vdone'][members] == 0]] = jd
+        cols['last_visit'][members] = jd
+        cols['vdone'][members] += 1
+        cols['sn'][members] += par['sn_target']
+        for m in members:
+            cols['visits'][m] = np.append(cols['visits'][m], jd)
+            cols['visit_sn'][m] = np.append(cols['visit_sn'][m], par['sn_target'])
+            cols['visit_reduced'][m] = np.append(cols['visit_reduced'][m], False)
+
+
+def plan_horizon(mjd_start, mjd_end, horizon=3, surveys=['apogee', 'eboss', 'manga'], par=None, discount=0.9,
+                 solver='greedy', apg=None, loud=True):
+    '''
+    plan_horizon: plans APOGEE-II for every night from mjd_start to mjd_end (inclusive)
+
+    Schedule lines, plates and their exposure history are read once. For every night, the
+    night and the horizon - 1 nights after it are scored from the current (simulated) plate
+    state, the cohorts worth more on a later night are held back, and tonight's plates are
+    picked from the rest as schedule_apogee would. The picked plates then get a simulated
+    visit before the next night is planned. The observability terms of every night are
+    computed once and reused for all the windows the night is part of.
+
+    MaNGA and eBOSS picks and cartridges depend on what is plugged on the day, so the plans
+    carry the APOGEE-II picks only, without carts.
+
+    INPUT: mjd_start, mjd_end -- first and last MJD to plan (APO)
+           horizon -- number of nights looked at for each night (1 = plan nights one by one)
+           surveys -- surveys running, as for run_scheduler
+           par -- APOGEE-II parameters (default DEFAULT_PAR)
+           discount -- weight of each night ahead relative to the one before it
+           solver -- APOGEE-II solver for the nightly picks (see pick_apogee_plates.pick_plates)
+           apg -- PlateTable to plan with (default: read from the database); it is updated
+                  with the simulated visits
+    OUTPUT: plans -- one plan per night, in run_scheduler format
+    '''
+    horizon_start = time()
+    if par is None:
+        par = dict(DEFAULT_PAR)
+    errors = []
+
+    # Schedule lines for the whole range, plus the look-ahead nights
+    pwd = os.path.dirname(os.path.realpath(__file__))
+    table = night_schedule.load_schedule(night_schedule.schedule_file(pwd))
+    rows = table.between(2400000 + mjd_start, 2400000 + mjd_end + horizon)
+    nights = [Night(rows.row(i), surveys, par) for i in range(len(rows))]
+    nplan = len([n for n in nights if n.jd <= 2400000 + mjd_end])
+    if nplan < mjd_end - mjd_start + 1:
+        errors.append('MJD ERROR: only %d of the nights from MJD %d to %d are in the schedule file.'
+                      % (nplan, mjd_start, mjd_end))
+
+    # Plates and their history, once
+    if apg is None:
+        apg, cohorts = get_plates(errors, plan=True, loud=loud, columnar=True, return_cohorts=True)
+    else:
+        cohorts = CohortIndex(apg)
+    index = kernel.SkyIndex(apg.columns['ra'], apg.columns['dec'])
+    plate_index = dict((int(p), i) for i, p in enumerate(apg.columns['plateid']))
+    if loud:
+        print("[PY] Horizon setup: %d nights, %d plates (%.3f sec)" % (len(nights), len(apg), time() - horizon_start))
+
+    plans = []
+    for d in range(nplan):
+        night_start = time()
+        tonight = nights[d]
+        night_errors = list(errors) if d == 0 else []
+        picks = []
+        if len(tonight) > 0 and len(apg) > 0:
+            # Hold back the cohorts the look-ahead wants on a later night (nights without
+            # slots are skipped, but still count for the discount)
+            ahead = [(k + 1, n) for k, n in enumerate(nights[d + 1:d + horizon]) if len(n) > 0]
+            scores = [(k, n.score(apg, par, cohorts, index)) for k, n in ahead]
+            obs = tonight.score(apg, par, cohorts, index)
+            reserved = reserve_later([(0, obs)] + scores, cohorts, discount=discount)
+            obs[reserved, :] = np.minimum(obs[reserved, :], 0)
+            picks = pick_plates(apg, obs, par, tonight.times, tonight.lengths, tonight.schedule, loud=False,
+                                cohorts=cohorts, solver=solver)
+            observed = [plate_index[int(p['plate'])] for p in picks if p['plate'] in plate_index]
+            simulate_visits(apg, cohorts, observed, tonight.jd, par)
+        plans.append(plan_output(tonight.schedule, picks, [], [], night_errors))
+        if loud:
+            print("[PY] Planned MJD %5d: %d APOGEE-II blocks (%.3f sec)"
+                  % (tonight.jd - 2400000, len(picks), time() - night_start))
+
+    if loud:
+        print("[PY] Horizon planning complete (%.3f sec)" % (time() - horizon_start))
+    return plans
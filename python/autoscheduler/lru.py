@@ -0,0 +1,58 @@
+from __future__ import print_function, division
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A size-bounded, thread-safe mapping that evicts the least recently used entry.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of entries kept in the cache.
+
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            value = self._data.pop(key)
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """Returns the cached value for `key`, calling `func` to create it on a miss."""
+        value = self.get(key, self)
+        if value is self:
+            value = func(*args, **kwargs)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
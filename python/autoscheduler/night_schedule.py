@@ -1,7 +1,28 @@
 from __future__ import print_function, division
 import datetime
+import hashlib
+import os
+import threading
 import numpy as np
 
+# Schedule file columns: (key, type, column in the file)
+APO_COLUMNS = [('jd', float, 0), ('eboss', int, 1), ('manga', int, 2),
+               ('bright_start', float, 4), ('bright_end', float, 5),
+               ('dark_start', float, 6), ('dark_end', float, 7),
+               ('eboss_start', float, 8), ('eboss_end', float, 9),
+               ('manga_start', float, 10), ('manga_end', float, 11),
+               ('dark_order', int, 12), ('eng', int, 13), ('eng_type', int, 14),
+               ('RM_flag', int, 15),
+               ('mastar_start', float, 16), ('mastar_end', float, 17),
+               ('rm_start', float, 18), ('rm_end', float, 19),
+               ('sdss5_start', float, 20), ('sdss5_end', float, 21)]
+LCO_COLUMNS = [('jd', float, 0), ('survey', int, 1), ('survey2', int, 2),
+               ('bright_start', float, 4), ('bright_end', float, 5),
+               ('lead_survey', int, 12), ('eng_flag', int, 13), ('eng_type', int, 14)]
+# List valued key of each format and the separator it is stored with in a compiled schedule
+APO_EXTRA = ('comment', ' ')
+LCO_EXTRA = ('programs', ',')
+
 
 def get_juldate():
     dt = datetime.datetime.utcnow()
@@ -11,119 +32,293 @@ def get_juldate():
     return julian
 
 
-def read_schedule(pwd, errors, mjd=-1, surveys=['apogee', 'eboss', 'manga'], loud=True, plan=False, south=False):
+class ScheduleTable(object):
+    """A parsed schedule file, stored as one NumPy column per schedule key.
+
+    Nights are looked up by JD with `searchsorted`, and `row` builds a new
+    dict for a night, so callers can change it without touching the table.
+
+    Parameters
+    ----------
+    columns : dict
+        Schedule key -> array, one entry per night in file order. The list
+        valued keys ('comment' for APO, 'programs' for LCO) are object arrays.
+
+    encoded : tuple, optional
+        (key, separator) of a list valued key stored as joined strings, as in
+        a compiled schedule; rows split them on request.
+
+    """
+
+    def __init__(self, columns, encoded=None):
+        self.columns = columns
+        self.encoded = encoded
+        self.keys = sorted(columns.keys())
+        self._order = np.argsort(columns['jd'], kind='mergesort')
+        self._jd = columns['jd'][self._order]
+        self._sorted = bool(np.all(self._order == np.arange(len(self._order))))
+
+    def __len__(self):
+        return len(self.columns['jd'])
+
+    def find(self, jd):
+        '''Index of the night with this JD, or None'''
+        i = np.searchsorted(self._jd, jd)
+        if i < len(self._jd) and self._jd[i] == jd:
+            return int(self._order[i])
+        return None
+
+    def closest(self, jd):
+        '''Index of the night with the JD closest to jd (the earlier one on ties)'''
+        i = np.searchsorted(self._jd, jd)
+        if i == 0:
+            return int(self._order[0])
+        if i == len(self._jd) or jd - self._jd[i - 1] <= self._jd[i] - jd:
+            i -= 1
+        return int(self._order[i])
+
+    def between(self, jd_start, jd_end):
+        '''The nights with jd_start <= JD < jd_end, as a ScheduleTable (array slices for a JD ordered file)'''
+        i0, i1 = np.searchsorted(self._jd, [jd_start, jd_end])
+        index = slice(i0, i1) if self._sorted else self._order[i0:i1]
+        return ScheduleTable(dict((key, column[index]) for key, column in self.columns.items()), encoded=self.encoded)
+
+    def row(self, i):
+        '''The schedule dict of night i, as a new dict'''
+        night = dict()
+        for key in self.keys:
+            value = self.columns[key][i]
+            if self.encoded is not None and key == self.encoded[0]:
+                value = value if isinstance(value, str) else value.decode('ascii')
+                night[key] = value.split() if self.encoded[1] == ' ' else value.split(self.encoded[1])
+            else:
+                night[key] = list(value) if isinstance(value, list) else value.item()
+        return night
+
+
+def parse_schedule(filename, south=False):
     '''
-    read_schedule: reads in scheduler formatted nightly schedule
+    parse_schedule: reads a Sch_APO_base.dat or Sch_LCO_base.dat style file
 
-    INPUT: filename -- name of the base schedule file supplied by survey coordinator
-    OUTPUT: schedule -- list of dicts that contain the relevant survey times for each night.
+    INPUT: filename -- schedule file
+           south -- LCO file format
+    OUTPUT: table -- ScheduleTable with one entry per night
     '''
-    # Read in SDSS-III schedule
-    schdir = '/'.join(pwd.split('/')[0:-2]) + "/schedules/"
+    columns = LCO_COLUMNS if south else APO_COLUMNS
+    extra = (LCO_EXTRA if south else APO_EXTRA)[0]
+    values = dict((key, []) for key, kind, col in columns)
+    values[extra] = []
+    schf = open(filename, 'r')
+    schlines = schf.read().splitlines()
+    schf.close()
+    for line in schlines:
+        if not line.strip() or line[0] == '#':
+            continue
+        tmp = line.split()
+        for key, kind, col in columns:
+            values[key].append(kind(tmp[col]))
+        values[extra].append(tmp[-1].split(',') if south else tmp[22:])
+    table = dict()
+    for key, kind, col in columns:
+        table[key] = np.array(values[key], dtype=np.float64 if kind is float else np.int64)
+    table[extra] = np.empty(len(values[extra]), dtype=object)
+    for i, value in enumerate(values[extra]):
+        table[extra][i] = value
+    return ScheduleTable(table)
 
-    # the following lines appear to do be duplicated below. commented out as a test. if no crashes, delete them
-    # schf = open(schdir+'Sch_base.6yrs.txt.frm.dat', 'r')
-    # schlines = schf.read().splitlines()
-    # schf.close()
-    # # Assign values to schedule dict list
-    schedule = []
-    # for i in range(len(schlines)):
-    #     tmp = schlines[i].split()
-    #     # Assign already-computed values to dict
-    #     schedule.append({'jd': float(tmp[0]), 'eboss': int(tmp[1]), 'manga': int(tmp[2]), 'bright_start': float(tmp[4]),
-    #                      'bright_end': float(tmp[5]), 'dark_start': float(tmp[6]), 'dark_end': float(tmp[7]),
-    #                      'eboss_start': float(tmp[8]), 'eboss_end': float(tmp[9]), 'manga_start': float(tmp[10]), 'manga_end': float(tmp[11])})
-    # Read in SDSS-IV schedule
-    if south:
-        schf = open(schdir+'Sch_LCO_base.dat', 'r')
-        schlines = schf.read().splitlines()
-        schf.close()
-        # Assign values to schedule dict list
-        for line in schlines:
-            if line[0] == '#':
-                continue
-            tmp = line.split()
-            programs = tmp[-1].split(',')
-            # Assign already-computed values to dict
-            schedule.append({'jd': float(tmp[0]), 'survey': int(tmp[1]), 'survey2': int(tmp[2]), 'bright_start': float(tmp[4]),
-                             'bright_end': float(tmp[5]), 'lead_survey': int(tmp[12]), 'eng_flag': int(tmp[13]), 'eng_type': int(tmp[14]),
-                             'programs': programs})
-    else:
-        schf = open(schdir+'Sch_APO_base.dat', 'r')
-        schlines = schf.read().splitlines()
-        schf.close()
-        # Assign values to schedule dict list
-        for line in schlines:
-            if line[0] == '#':
-                continue
-            tmp = line.split()
-            # Assign already-computed values to dict
-            schedule.append({'jd': float(tmp[0]), 'eboss': int(tmp[1]), 'manga': int(tmp[2]),
-                             'bright_start': float(tmp[4]), 'bright_end': float(tmp[5]),
-                             'dark_start': float(tmp[6]), 'dark_end': float(tmp[7]),
-                             'eboss_start': float(tmp[8]), 'eboss_end': float(tmp[9]),
-                             'manga_start': float(tmp[10]), 'manga_end': float(tmp[11]),
-                             'dark_order': int(tmp[12]), 'eng': int(tmp[13]), 'eng_type': int(tmp[14]),
-                             'RM_flag': int(tmp[15]),
-                             'mastar_start': float(tmp[16]), 'mastar_end': float(tmp[17]),
-                             'rm_start': float(tmp[18]), 'rm_end': float(tmp[19]),
-                             'sdss5_start': float(tmp[20]), 'sdss5_end': float(tmp[21]),
-                             'comment': tmp[22:] })
 
-    # Determine what line in the schedule to use for tonight
-    if mjd < 0:
-        jd_now = get_juldate()
-        utc_hr = (((jd_now - int(jd_now))+0.5)*24+19) % 24
-        # For plugging, we want the next day after 9PM
-        if plan:
-            if utc_hr > 21 or utc_hr <= 7:
-                tonight = int(jd_now)+1
-            else:
-                tonight = int(jd_now)
-        # For observing, we want the current date until 9AM
-        else:
-            tonight = int(jd_now-0.1)
-    else:
-        tonight = 2400000 + int(mjd)
+def checksum(filename):
+    '''MD5 hex digest of a file'''
+    md5 = hashlib.md5()
+    schf = open(filename, 'rb')
+    md5.update(schf.read())
+    schf.close()
+    return md5.hexdigest()
+
+
+def compiled_name(filename):
+    '''Compiled schedule file kept next to a text schedule: Sch_APO_base.dat -> Sch_APO_base.npz'''
+    return os.path.splitext(filename)[0] + '.npz'
+
+
+def compile_schedule(filename, output=None, south=False, loud=True):
+    '''
+    compile_schedule: writes a schedule file as a binary table (.npz)
+
+    Nights are stored as records of float64/int64 fields plus the comment/programs list
+    as a fixed-width string, together with the MD5 checksum of the text file so that
+    load_schedule only uses the table while it matches the text.
+
+    INPUT: filename -- Sch_APO_base.dat or Sch_LCO_base.dat style file
+           output -- compiled file name (default: next to filename, see compiled_name)
+           south -- LCO file format
+    OUTPUT: output -- name of the compiled file
+    '''
+    if output is None:
+        output = compiled_name(filename)
+    table = parse_schedule(filename, south=south)
+    extra, sep = LCO_EXTRA if south else APO_EXTRA
+    encoded = np.array([sep.join(value) for value in table.columns[extra]], dtype=np.bytes_)
+    # one record per night, so the table loads in a single read
+    names = [key for key, kind, col in (LCO_COLUMNS if south else APO_COLUMNS)]
+    records = np.zeros(len(table), dtype=[(key, table.columns[key].dtype) for key in names] + [(extra, encoded.dtype)])
+    for key in names:
+        records[key] = table.columns[key]
+    records[extra] = encoded
+    arrays = {'table': records, 'checksum': np.array(checksum(filename)), 'south': np.array(south)}
+    # write to a temporary file first, so readers never see a partial table
+    tmpname = output + '.tmp.npz'
+    np.savez(tmpname, **arrays)
+    os.rename(tmpname, output)
     if loud:
-        print("[PY] Scheduling MJD %5d" % (tonight - 2400000))
+        print("[PY] Compiled %d nights of %s into %s" % (len(table), filename, output))
+    return output
 
-    # Find line to use in the schedule file
-    currjd = [x for x in range(len(schedule)) if schedule[x]['jd'] == tonight]
-    # If this line doesn't exist, find the closest day
-    if not len(currjd) > 0:
-        currjd = np.argsort([np.abs(schedule[x]['jd']-tonight) for x in range(len(schedule))])
-        errors.append('MJD ERROR: JD %d not present in schedule file. Using JD = %d instead.' % (tonight, schedule[currjd[0]]['jd']))
 
-    if south:
-        return schedule[currjd[0]]
+def load_compiled(filename, source_checksum, south=False):
+    '''
+    load_compiled: reads a compiled schedule, if it was compiled from the current text file
+
+    INPUT: filename -- compiled schedule file
+           source_checksum -- checksum of the text schedule file
+           south -- LCO file format
+    OUTPUT: table -- ScheduleTable, or None if the file is missing, unreadable or out of date
+    '''
+    if not os.path.isfile(filename):
+        return None
+    try:
+        data = np.load(filename)
+        records, compiled_checksum, compiled_south = data['table'], data['checksum'], data['south']
+        data.close()
+    except (IOError, KeyError, ValueError):
+        return None
+    if str(compiled_checksum) != source_checksum or bool(compiled_south) != south:
+        return None
+    extra, sep = LCO_EXTRA if south else APO_EXTRA
+    return ScheduleTable(dict((key, records[key]) for key in records.dtype.names), encoded=(extra, sep))
+
 
+# Parsed schedule files, by path: (mtime, ScheduleTable)
+_schedules = dict()
+_schedules_lock = threading.Lock()
+
+
+def load_schedule(filename, south=False):
+    '''
+    load_schedule: parsed schedule file, parsed again only when the file changes
+
+    A compiled schedule next to the file (see compile_schedule) is used instead of
+    parsing the text, as long as its checksum matches the text file.
+
+    INPUT: filename -- schedule file
+           south -- LCO file format
+    OUTPUT: table -- ScheduleTable, shared between callers (use its rows, not its columns)
+    '''
+    mtime = os.path.getmtime(filename)
+    key = (os.path.realpath(filename), south)
+    with _schedules_lock:
+        cached = _schedules.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    table = load_compiled(compiled_name(filename), checksum(filename), south=south)
+    if table is None:
+        table = parse_schedule(filename, south=south)
+    with _schedules_lock:
+        _schedules[key] = (mtime, table)
+    return table
+
+
+def schedule_file(pwd, south=False):
+    '''Base schedule file of a site, pwd being the autoscheduler package directory'''
+    schdir = '/'.join(pwd.split('/')[0:-2]) + "/schedules/"
+    return schdir + ('Sch_LCO_base.dat' if south else 'Sch_APO_base.dat')
+
+
+def adjust_schedule(night, surveys):
+    '''
+    adjust_schedule: hands the time of offline surveys to the others
+
+    INPUT: night -- schedule dict of one night (APO format), changed in place
+           surveys -- surveys running tonight
+    OUTPUT: night
+    '''
     # See if schedule needs to be adjusted based on what surveys are being run tonight
     # Is eBOSS offline, but MaNGA isn't? MaNGA gets all of dark time.
     if 'manga' in surveys and not 'eboss' in surveys:
-        schedule[currjd[0]]['manga_start'] = schedule[currjd[0]]['dark_start']
-        schedule[currjd[0]]['manga_end'] = schedule[currjd[0]]['dark_end']
-        schedule[currjd[0]]['eboss_start'] = 0
-        schedule[currjd[0]]['eboss_end'] = 0
-        schedule[currjd[0]]['eboss'] = 0
+        night['manga_start'] = night['dark_start']
+        night['manga_end'] = night['dark_end']
+        night['eboss_start'] = 0
+        night['eboss_end'] = 0
+        night['eboss'] = 0
     # Is MaNGA offline, but eBOSS isn't? eBOSS gets all of dark time.
     if 'eboss' in surveys and not 'manga' in surveys:
-        schedule[currjd[0]]['eboss_start'] = schedule[currjd[0]]['dark_start']
-        schedule[currjd[0]]['eboss_end'] = schedule[currjd[0]]['dark_end']
-        schedule[currjd[0]]['manga_start'] = 0
-        schedule[currjd[0]]['manga_end'] = 0
-        schedule[currjd[0]]['manga'] = 0
+        night['eboss_start'] = night['dark_start']
+        night['eboss_end'] = night['dark_end']
+        night['manga_start'] = 0
+        night['manga_end'] = 0
+        night['manga'] = 0
     # Are both dark-time surveys offline? APOGEE-II gets everything.
     if not 'eboss' in surveys and not 'manga' in surveys:
-        schedule[currjd[0]]['bright_start'] = min([x for x in [schedule[currjd[0]]['bright_start'], schedule[currjd[0]]['dark_start']] if x > 0])
-        schedule[currjd[0]]['bright_end'] = max([x for x in [schedule[currjd[0]]['bright_end'], schedule[currjd[0]]['dark_end']] if x > 0])
-        schedule[currjd[0]]['eboss_start'] = 0
-        schedule[currjd[0]]['eboss_end'] = 0
-        schedule[currjd[0]]['eboss'] = 0
-        schedule[currjd[0]]['manga_start'] = 0
-        schedule[currjd[0]]['manga_end'] = 0
-        schedule[currjd[0]]['manga'] = 0
+        night['bright_start'] = min([x for x in [night['bright_start'], night['dark_start']] if x > 0])
+        night['bright_end'] = max([x for x in [night['bright_end'], night['dark_end']] if x > 0])
+        night['eboss_start'] = 0
+        night['eboss_end'] = 0
+        night['eboss'] = 0
+        night['manga_start'] = 0
+        night['manga_end'] = 0
+        night['manga'] = 0
     # APOGEE-II is offline. What happens?
     # TO-DO
 
-    return schedule[currjd[0]]
+    return night
+
+
+def tonight_jd(mjd=-1, plan=False):
+    '''
+    tonight_jd: JD of the schedule line for mjd, or for tonight if mjd < 0
+
+    INPUT: mjd -- MJD to schedule, -1 for tonight
+           plan -- plugging (the next night after 9PM) instead of observing (tonight until 9AM)
+    OUTPUT: tonight -- integer JD
+    '''
+    if mjd >= 0:
+        return 2400000 + int(mjd)
+    jd_now = get_juldate()
+    utc_hr = (((jd_now - int(jd_now))+0.5)*24+19) % 24
+    # For plugging, we want the next day after 9PM
+    if plan:
+        if utc_hr > 21 or utc_hr <= 7:
+            return int(jd_now)+1
+        return int(jd_now)
+    # For observing, we want the current date until 9AM
+    return int(jd_now-0.1)
+
+
+def read_schedule(pwd, errors, mjd=-1, surveys=['apogee', 'eboss', 'manga'], loud=True, plan=False, south=False):
+    '''
+    read_schedule: reads in scheduler formatted nightly schedule
+
+    INPUT: filename -- name of the base schedule file supplied by survey coordinator
+    OUTPUT: schedule -- dict that contains the relevant survey times for tonight (a copy, safe to change)
+    '''
+    # Read in SDSS-IV schedule
+    schedule = load_schedule(schedule_file(pwd, south=south), south=south)
+
+    # Determine what line in the schedule to use for tonight
+    tonight = tonight_jd(mjd, plan=plan)
+    if loud:
+        print("[PY] Scheduling MJD %5d" % (tonight - 2400000))
+
+    # Find line to use in the schedule file
+    currjd = schedule.find(tonight)
+    # If this line doesn't exist, find the closest day
+    if currjd is None:
+        currjd = schedule.closest(tonight)
+        errors.append('MJD ERROR: JD %d not present in schedule file. Using JD = %d instead.' % (tonight, schedule.columns['jd'][currjd]))
+    # Tonight's line, as a dict of its own
+    tonight_schedule = schedule.row(currjd)
+
+    if south:
+        return tonight_schedule
+
+    return adjust_schedule(tonight_schedule, surveys)
@@ -0,0 +1,238 @@
+from __future__ import print_function, division
+import numpy as np
+import astropysics.obstools as obs
+from autoscheduler.sdssUtilities.idlasl import moonpos
+from autoscheduler.sdssUtilities.Site import Site
+
+# OBSERVABILITY_KERNEL
+# DESCRIPTION: Array implementation of the observability rules shared by the APOGEE-II and eBOSS
+#              schedulers. Every plate quantity is a column of length nplate and every slot quantity
+#              an array of length nslot, so each rule is evaluated for the whole (plate, slot) matrix at once.
+
+# Codes written into the observability matrix
+OK = 0
+HA_LIMIT = -1
+AIRMASS_LIMIT = -2
+MOON_LIMIT = -3
+
+# Site coordinates (latitude, longitude)
+APO = (32.789278, -105.820278)
+LCO = (-29.0182, -70.6915)
+
+
+def get_site(south=False):
+    if south:
+        return obs.Site(*LCO)
+    return obs.Site(*APO)
+
+
+def horizontal_site(site):
+    # sdssUtilities Site at the same location, for the batched alt/az/airmass conversions
+    return Site(longitude=site.longitude.d % 360, latitude=site.latitude.d)
+
+
+def slot_lsts(site, times, lengths, ephem=None):
+    # LST at the start and end of every slot (lengths in hours)
+    ends = np.asarray(times, dtype=float) + np.asarray(lengths, dtype=float)/24
+    if ephem is not None:
+        return ephem.lst(times), ephem.lst(ends)
+    beglst = np.array([site.localSiderialTime(x) for x in times])
+    endlst = np.array([site.localSiderialTime(x) for x in ends])
+    return beglst, endlst
+
+
+def moon_positions(times, ephem=None):
+    # Moon RA/Dec (degrees) at every time, shape (ntime, 2)
+    if ephem is not None:
+        return ephem.moon(times)
+    return np.array([moonpos(x)[0:2] for x in times]).reshape(-1, 2)
+
+
+def unit_vectors(ra, dec):
+    # Cartesian direction cosines for RA/Dec in degrees, shape (3,) + ra.shape
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def lst_window(minlst, maxlst, beglst, endlst):
+    '''
+    lst_window: adjusts plate LST limits for 24 hour wrapping against every slot
+
+    INPUT: minlst, maxlst -- plate LST limits (hours), shape (nplate,)
+           beglst, endlst -- slot LST limits (hours), shape (nslot,)
+    OUTPUT: usedminlst, usedmaxlst -- adjusted limits, shape (nplate, nslot)
+    '''
+    minlst, maxlst = minlst[:, np.newaxis], maxlst[:, np.newaxis]
+    beg, end = beglst[np.newaxis, :], endlst[np.newaxis, :]
+    wrapped = beg > end
+    shift = 24 * ((minlst < 0) & (beg > 12) & (end > 12)) - 24 * ((maxlst > 24) & (beg < 12) & (end < 12))
+    usedminlst = minlst + shift + 24 * (wrapped & (minlst < 12))
+    usedmaxlst = maxlst + shift - 24 * (wrapped & (maxlst > 12))
+    return usedminlst, usedmaxlst
+
+
+def transit_priority(platelst, beglst, endlst, lengths):
+    '''
+    transit_priority: Gaussian priority bonus on time from transit
+
+    INPUT: platelst -- plate transit LST (hours), shape (nplate,)
+           beglst, endlst -- slot LST limits (hours), shape (nslot,)
+           lengths -- slot lengths (hours), shape (nslot,)
+    OUTPUT: bonus -- array of shape (nplate, nslot)
+    '''
+    platelst = platelst[:, np.newaxis]
+    beg, end = beglst[np.newaxis, :], endlst[np.newaxis, :]
+    wrapped = beg > end
+    # Adjust LSTs for Gaussian with 24 hour wrapping
+    lstsum = np.where(wrapped, beg + end - 24, beg + end)
+    usedplatelst = np.where(wrapped, np.where(platelst > 12, platelst - 24, platelst),
+                            np.where((beg > 18) & (platelst < 4), platelst + 24,
+                                     np.where((beg < 4) & (platelst > 18), platelst - 24, platelst)))
+    return 50.0 * np.exp(-(usedplatelst - lstsum/2 + np.asarray(lengths)[np.newaxis, :]/2)**2 / 2)
+
+
+def moon_separation(ra, dec, moon):
+    # Angular distance (degrees) of every plate from the moon in every slot, shape (nplate, nslot)
+    cosdist = np.dot(unit_vectors(ra, dec).T, unit_vectors(moon[:, 0], moon[:, 1]))
+    return np.degrees(np.arccos(np.clip(cosdist, -1, 1)))
+
+
+class SkyIndex(object):
+    """Plate centres binned on a regular RA/Dec grid.
+
+    Lets a cone search touch only the bins that overlap the cone instead of
+    every plate, so flagging the plates near the moon scales with the number
+    of plates close to it rather than with the size of the pool.
+
+    Parameters
+    ----------
+    ra, dec : array
+        Plate centres (degrees).
+
+    binsize : float
+        Size of the bins (degrees).
+
+    """
+
+    def __init__(self, ra, dec, binsize=5.0):
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.binsize = binsize
+        self.nra = int(np.ceil(360 / binsize))
+        self.ndec = int(np.ceil(180 / binsize))
+        rbin = np.floor((self.ra % 360) / binsize).astype(int) % self.nra
+        dbin = np.clip(np.floor((self.dec + 90) / binsize).astype(int), 0, self.ndec - 1)
+        key = dbin * self.nra + rbin
+        # Plates sorted by bin, with the start of every bin in the sorted list
+        self.order = np.argsort(key, kind='mergesort')
+        self.start = np.searchsorted(key[self.order], np.arange(self.nra * self.ndec + 1))
+
+    def __len__(self):
+        return len(self.ra)
+
+    def candidates(self, ra, dec, radius):
+        # Plates in the bins overlapping a cone (a superset of the plates inside it)
+        radius = radius + 1e-6
+        dlo = max(int(np.floor((dec - radius + 90) / self.binsize)), 0)
+        dhi = min(int(np.floor((dec + radius + 90) / self.binsize)), self.ndec - 1)
+        maxdec = min(abs(dec) + radius, 90.0)
+        width = np.sin(np.radians(radius)) / max(np.cos(np.radians(maxdec)), 1e-12)
+        if radius >= 90 or width >= 1:
+            rbins = np.arange(self.nra)
+        else:
+            half = np.degrees(np.arcsin(width))
+            first = int(np.floor((ra - half) / self.binsize))
+            last = int(np.floor((ra + half) / self.binsize))
+            rbins = np.unique(np.arange(first, last + 1) % self.nra)
+        keys = (np.arange(dlo, dhi + 1)[:, np.newaxis] * self.nra + rbins[np.newaxis, :]).ravel()
+        if len(keys) == 0:
+            return np.zeros(0, dtype=int)
+        return np.concatenate([self.order[self.start[k]:self.start[k + 1]] for k in keys])
+
+    def within(self, ra, dec, radius):
+        # Plates strictly closer than radius (degrees) to (ra, dec)
+        idx = self.candidates(ra, dec, radius)
+        dist = moon_separation(self.ra[idx], self.dec[idx], np.array([[ra, dec]]))[:, 0]
+        return idx[dist < radius]
+
+
+def moon_cells(index, moon, moon_threshold):
+    '''
+    moon_cells: (plate, slot) cells that fail moon avoidance
+
+    INPUT: index -- SkyIndex of the plate centres
+           moon -- moon RA/Dec (degrees) in every slot, shape (nslot, 2)
+           moon_threshold -- minimum moon distance (degrees)
+    OUTPUT: plates, slots -- index arrays of the cells closer than moon_threshold to the moon
+    '''
+    plates = [index.within(moon[t, 0], moon[t, 1], moon_threshold) for t in range(len(moon))]
+    slots = [np.zeros(len(p), dtype=int) + t for t, p in enumerate(plates)]
+    if len(plates) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    return np.concatenate(plates), np.concatenate(slots)
+
+
+def secz(site, ra, dec, samples, ephem=None):
+    '''
+    secz: airmass of every plate at a set of sample times within each slot
+
+    INPUT: site -- observing site
+           ra, dec -- plate coordinates (J2000, degrees), shape (nplate,)
+           samples -- sample times (JD), shape (nslot, nsample). Positions are
+                      precessed to the epoch of the first sample in each slot.
+           ephem -- optional ephemeris to interpolate the LSTs from
+    OUTPUT: secz -- array of shape (nplate, nslot, nsample)
+    '''
+    samples = np.atleast_2d(samples)
+    if ephem is not None:
+        lsts = ephem.lst(samples)
+    else:
+        lsts = np.array([[site.localSiderialTime(x) for x in row] for row in samples])
+    epochs = np.atleast_1d(obs.jd_to_epoch(samples[:, 0]))[:, np.newaxis] + np.zeros(samples.shape)
+    return horizontal_site(site).getAirmass(samples, ra, dec, lst=lsts, epoch=epochs, refraction=True)
+
+
+def evaluate(site, ra, dec, platelst, minlst, maxlst, times, lengths, samples, moon_threshold, maxz, zenith,
+             ephem=None, index=None):
+    '''
+    evaluate: applies the shared observability rules to all plates and slots
+
+    INPUT: site -- observing site
+           ra, dec, platelst, minlst, maxlst -- plate columns, shape (nplate,)
+           times, lengths -- slot start (JD) and length (hours), shape (nslot,)
+           samples -- airmass sample times (JD), shape (nslot, nsample)
+           moon_threshold -- minimum moon distance (degrees)
+           maxz -- maximum airmass
+           zenith -- boolean column, True where zenith avoidance (secz < 1.003) applies
+           ephem -- optional ephemeris (see autoscheduler.ephemeris) for LST and moon positions
+           index -- optional SkyIndex of (ra, dec), built here if not given
+    OUTPUT: transit -- Gaussian transit bonus, shape (nplate, nslot)
+            code -- OK, MOON_LIMIT, HA_LIMIT or AIRMASS_LIMIT for every cell
+    '''
+    times = np.asarray(times, dtype=float)
+    lengths = np.asarray(lengths, dtype=float)
+    beglst, endlst = slot_lsts(site, times, lengths, ephem=ephem)
+    transit = transit_priority(platelst, beglst, endlst, lengths)
+
+    code = np.zeros([len(ra), len(times)], dtype=np.int8)
+    # Determine whether HAs of block are within observational range
+    usedminlst, usedmaxlst = lst_window(minlst, maxlst, beglst, endlst)
+    habad = (beglst[np.newaxis, :] < usedminlst) | (endlst[np.newaxis, :] > usedmaxlst)
+    # Check whether any of the sample points contain a bad airmass value
+    airmass = secz(site, ra, dec, samples, ephem=ephem)
+    airbad = np.any((airmass > maxz) | (zenith[:, np.newaxis, np.newaxis] & (airmass < 1.003)), axis=2)
+    code[airbad] = AIRMASS_LIMIT
+    code[habad] = HA_LIMIT
+    # Moon avoidance takes precedence over everything else
+    if index is None:
+        index = SkyIndex(ra, dec)
+    code[moon_cells(index, moon_positions(times, ephem=ephem), moon_threshold)] = MOON_LIMIT
+    return transit, code
+
+
+def priority_matrix(priority, transit, code):
+    # Combine plate priorities with the transit bonus and write the limit codes over it
+    obsarr = np.asarray(priority, dtype=float)[:, np.newaxis] + transit
+    for limit in (AIRMASS_LIMIT, HA_LIMIT, MOON_LIMIT):
+        obsarr[code == limit] = limit
+    return obsarr
@@ -0,0 +1,213 @@
+from __future__ import print_function, division
+from time import time
+import os
+import copy
+import json
+import hashlib
+import threading
+import sqlalchemy
+
+from autoscheduler import night_schedule, s4as
+from autoscheduler.lru import LRUCache
+from autoscheduler.plateDBtools.apogee.get_apogee_plates import apogee_session
+
+
+# DESCRIPTION: Cache of run_scheduler plans. A plan only changes when its inputs (night,
+# surveys, mode, site), the schedule file or the database state change, so plans are kept
+# under a key made of the inputs and a cheap fingerprint of the database: the highest
+# exposure, plugging and reduction pks and counters of the plates (location, survey mode
+# and surveys), active pluggings, plate statuses and plate priorities. The fingerprint
+# takes one query; a hit returns a copy of the stored plan. Plans are kept in memory (LRU) and, if a directory is given, in
+# JSON files shared by all processes using it (e.g. uWSGI workers). The oldest files are
+# removed once there are too many or they are too old. The fingerprint does not cover
+# Totoro's MaNGA plugger state, so the web endpoint only uses the cache when asked (cache=1).
+
+PLAN_CACHE_DIR = os.environ.get('AUTOSCHEDULER_PLAN_CACHE_DIR')
+
+# plans kept in memory per process
+PLAN_CACHE_SIZE = 64
+
+# plan files kept in the directory, and their maximum age (sec)
+PLAN_CACHE_FILES = 512
+PLAN_CACHE_AGE = 7 * 86400
+
+_caches = dict()
+_lock = threading.Lock()
+
+
+def db_fingerprint(session, south=False):
+    '''
+    db_fingerprint: summary of the database state that plans depend on, in one query
+
+    INPUT: session -- DB session
+           south -- LCO database (no MaNGA tables)
+    OUTPUT: fingerprint -- tuple of integers; it changes when exposures, reductions,
+            pluggings, plate statuses or plate priorities change, and when plates are
+            added, shipped (location), or change survey or survey mode
+    '''
+    from autoscheduler.plateDBtools.database.apo.platedb import ModelClasses as pdb
+    from autoscheduler.plateDBtools.database.apo.apogeeqldb import ModelClasses as qldb
+    func = sqlalchemy.func
+
+    def scalar(*columns):
+        return [session.query(c).as_scalar() for c in columns]
+
+    # plate pk times location or survey (mode) pk, so two plates swapping them count too
+    terms = scalar(func.max(pdb.Plate.pk), func.count(pdb.Plate.pk),
+                   func.sum(pdb.Plate.pk * pdb.Plate.plate_location_pk),
+                   func.sum(pdb.Plate.pk * pdb.Plate.current_survey_mode_pk),
+                   func.count(pdb.PlateToSurvey.plate_pk),
+                   func.sum(pdb.PlateToSurvey.plate_pk * pdb.PlateToSurvey.survey_pk),
+                   func.max(pdb.Exposure.pk), func.max(pdb.Plugging.pk),
+                   func.count(pdb.ActivePlugging.pk), func.sum(pdb.ActivePlugging.plugging_pk),
+                   func.count(pdb.PlateToPlateStatus.plate_pk), func.sum(pdb.PlateToPlateStatus.plate_status_pk),
+                   func.sum(pdb.PlatePointing.priority),
+                   func.max(qldb.Quickred.pk), func.max(qldb.Reduction.pk))
+    if not south:
+        from autoscheduler.plateDBtools.database.apo.mangadb import ModelClasses as mangaDB
+        terms += scalar(func.max(mangaDB.SN2Values.pk))
+    with session.begin():
+        row = session.query(*terms).one()
+    return tuple(int(v or 0) for v in row)
+
+
+def schedule_version(south=False):
+    '''Modification time and size of the schedule file of the site'''
+    pwd = os.path.dirname(os.path.realpath(__file__))
+    info = os.stat(night_schedule.schedule_file(pwd, south=south))
+    return (int(info.st_mtime), int(info.st_size))
+
+
+def plan_key(mjd, surveys, plan, fingerprint):
+    '''
+    plan_key: cache key of a run_scheduler call
+
+    INPUT: mjd, surveys, plan -- as for run_scheduler (mjd < 0 is resolved to tonight)
+           fingerprint -- db_fingerprint of the site database
+    OUTPUT: key -- string, also used as the file name of the disk tier
+    '''
+    south = surveys == ['south'] or surveys == ['override']
+    inputs = [night_schedule.tonight_jd(mjd, plan=plan or south), sorted(surveys), bool(plan),
+              'lco' if south else 'apo', list(schedule_version(south)), list(fingerprint)]
+    return hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+
+class PlanCache(object):
+    """Plans by key, in a size-bounded LRU and optionally in a directory.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of plans kept in memory.
+    directory : str or None
+        Where plans are written as <key>.json for other processes to find,
+        or None to keep them in memory only.
+    maxfiles : int
+        The maximum number of plan files kept in the directory; the oldest
+        are removed first.
+    maxage : float
+        Plan files older than this (sec) are removed.
+
+    """
+
+    def __init__(self, maxsize=PLAN_CACHE_SIZE, directory=None, maxfiles=PLAN_CACHE_FILES, maxage=PLAN_CACHE_AGE):
+        self.memory = LRUCache(maxsize)
+        self.directory = directory
+        self.maxfiles = maxfiles
+        self.maxage = maxage
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        '''Returns a copy of the plan stored under key, or None'''
+        plan = self.memory.get(key)
+        if plan is None and self.directory is not None:
+            try:
+                with open(self._path(key)) as f:
+                    plan = json.load(f)
+            except (IOError, OSError, ValueError):
+                return None
+            self.memory.put(key, plan)
+        return copy.deepcopy(plan)
+
+    def put(self, key, plan):
+        plan = copy.deepcopy(plan)
+        self.memory.put(key, plan)
+        if self.directory is None:
+            return
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # made by another process meanwhile
+                pass
+        # write next to the final file and rename, so readers never see half a plan
+        tmp = '{}.{}.tmp'.format(self._path(key), os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(plan, f, default=_json_value)
+        os.rename(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        '''Removes the plan files beyond maxfiles, oldest first, and those older than maxage'''
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                # removed by another process meanwhile
+                pass
+        files.sort(reverse=True)
+        oldest = time() - self.maxage
+        for n, (mtime, path) in enumerate(files):
+            if n >= self.maxfiles or mtime < oldest:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        self.memory.clear()
+
+
+def _json_value(value):
+    # numpy scalars in the picks
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def plan_cache(directory=PLAN_CACHE_DIR):
+    '''Returns the (process-wide) plan cache for directory (None: memory only)'''
+    with _lock:
+        if directory not in _caches:
+            _caches[directory] = PlanCache(directory=directory)
+        return _caches[directory]
+
+
+def cached_run_scheduler(plan=False, mjd=-1, surveys=['apogee', 'eboss', 'manga'], loud=True, cache=None):
+    '''
+    cached_run_scheduler: run_scheduler, returning the stored plan when neither the inputs nor
+                          the database state changed since it was made
+
+    INPUT: plan, mjd, surveys, loud -- as for run_scheduler
+           cache -- PlanCache to use (default: plan_cache())
+    OUTPUT: plan -- dictionary in run_scheduler format
+    '''
+    start_time = time()
+    if cache is None:
+        cache = plan_cache()
+    south = surveys == ['south'] or surveys == ['override']
+    key = plan_key(mjd, surveys, plan, db_fingerprint(apogee_session(south), south=south))
+    result = cache.get(key)
+    if result is not None:
+        if loud:
+            print("[PY] Plan cache hit (%.3f sec)" % (time() - start_time))
+        return result
+    result = s4as.run_scheduler(plan=plan, mjd=mjd, surveys=surveys, loud=loud)
+    cache.put(key, result)
+    return result
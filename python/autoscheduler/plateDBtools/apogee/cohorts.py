@@ -0,0 +1,68 @@
+from __future__ import print_function, division
+import numpy as np
+
+
+# DESCRIPTION: Index of APOGEE plates by field (locationid) and by cohort (locationid, apgver).
+# Plates in a cohort share their visit history, plates on a field are completed in
+# apgver order, and a picked design knocks out the rest of its cohort; this index
+# answers all three lookups without rescanning the plate list.
+
+def _groups(ids):
+    # index arrays (ascending) of the entries sharing each id
+    order = np.argsort(ids, kind='mergesort')
+    bounds = np.searchsorted(ids[order], np.arange(ids.max() + 2)) if len(ids) > 0 else [0]
+    return [order[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+
+
+class CohortIndex(object):
+    """Field and cohort membership of a list of APOGEE plates.
+
+    Parameters
+    ----------
+    apg : list
+        ApogeePlate objects (or a PlateTable). Indices refer to positions in it.
+
+    Attributes
+    ----------
+    cohort, field : `numpy.ndarray`
+        Integer cohort and field id of every plate.
+
+    by_cohort, by_location : dict
+        (locationid, apgver) and locationid -> index array of the member plates.
+
+    """
+
+    def __init__(self, apg):
+        if hasattr(apg, 'columns'):
+            locationid = np.asarray(apg.columns['locationid'], dtype=np.int64)
+            apgver = np.asarray(apg.columns['apgver'], dtype=np.int64)
+        else:
+            locationid = np.array([p.locationid for p in apg], dtype=np.int64)
+            apgver = np.array([p.apgver for p in apg], dtype=np.int64)
+        self.locationid = locationid
+        self.apgver = apgver
+
+        if len(locationid) > 0:
+            keys, self.cohort = np.unique(np.array([locationid, apgver]).T, axis=0, return_inverse=True)
+            locations, self.field = np.unique(locationid, return_inverse=True)
+        else:
+            keys, self.cohort = np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.int64)
+            locations, self.field = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        self.ncohort = len(keys)
+        self.nfield = len(locations)
+
+        self.cohorts = _groups(self.cohort)
+        self.fields = _groups(self.field)
+        self.by_cohort = dict(((int(k[0]), int(k[1])), self.cohorts[i]) for i, k in enumerate(keys))
+        self.by_location = dict((int(k), self.fields[i]) for i, k in enumerate(locations))
+
+    def __len__(self):
+        return len(self.cohort)
+
+    def same_cohort(self, i):
+        '''Indices of the plates in the cohort of plate i (including i)'''
+        return self.cohorts[self.cohort[i]]
+
+    def same_field(self, i):
+        '''Indices of the plates on the field of plate i (including i)'''
+        return self.fields[self.field[i]]
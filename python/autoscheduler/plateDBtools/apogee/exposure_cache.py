@@ -0,0 +1,136 @@
+from __future__ import print_function, division
+from time import time
+import os
+import threading
+import sqlalchemy
+from sqlalchemy import or_
+import numpy as np
+
+
+# DESCRIPTION: Persistent local copy of the APOGEE exposure rows that get_plates aggregates
+# into visit histories. Each refresh only asks the database for exposures of the cached plates
+# newer than the high-water mark (exposure pk), exposures of plates not seen before, and recent
+# exposures still waiting for a full reduction, and merges them into the stored rows. The
+# cached plates are all refreshed on every call, including those not asked for, so the
+# high-water mark holds for each of them.
+# Exposures edited or removed in the database are not noticed; delete the file to rebuild it.
+
+CACHE_DIR = os.environ.get('AUTOSCHEDULER_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.autoscheduler'))
+
+# columns of the stored rows; the first seven are what get_plates expects
+COLUMNS = ('mjd', 'plateid', 'qr_snr', 'red_snr', 'exp_time', 'start_time', 'exp_no', 'pk')
+
+# exposures younger than this (days) are re-queried until their reduction shows up
+RECHECK_DAYS = 30
+
+_caches = dict()
+_lock = threading.Lock()
+
+
+class ExposureCache(object):
+    """Exposure rows for a set of plates, with the exposure pk high-water mark.
+
+    Parameters
+    ----------
+    path : str
+        The file the rows are kept in (numpy .npz). Created on the first save.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = np.zeros((0, len(COLUMNS)))
+        self.plates = set()
+        self.hwm = -1
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            data = np.load(path)
+            self.rows = data['rows']
+            self.plates = set(int(p) for p in data['plates'])
+            self.hwm = int(data['hwm'])
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+        # write next to the old file and rename, so readers never see half a file
+        tmp = '{}.{}.tmp.npz'.format(self.path, os.getpid())
+        np.savez(tmp, rows=self.rows, plates=np.array(sorted(self.plates), dtype=np.int64), hwm=self.hwm)
+        os.rename(tmp, self.path)
+
+    def pending(self):
+        # pks of recent exposures without a full reduction S/N yet
+        if len(self.rows) == 0:
+            return []
+        recent = self.rows[:, 0] > self.rows[:, 0].max() - RECHECK_DAYS
+        return [int(pk) for pk in self.rows[recent & np.isnan(self.rows[:, 3]), 7]]
+
+    def merge(self, rows, plateids):
+        '''Adds new or updated rows (matched on exposure pk) and marks plateids as covered'''
+        rows = np.asarray(rows, dtype=np.float).reshape(-1, len(COLUMNS))
+        keep = ~np.in1d(self.rows[:, 7], rows[:, 7])
+        self.rows = np.concatenate([self.rows[keep], rows])
+        self.plates.update(int(p) for p in plateids)
+        if len(self.rows) > 0:
+            self.hwm = max(self.hwm, int(self.rows[:, 7].max()))
+
+    def exposures(self, session, plateids, loud=True):
+        '''
+        exposures: refreshes the cache from the database and returns the rows for plateids
+
+        New exposures are read for every cached plate, not only for plateids, so a plate
+        left out of one call still gets the exposures it had meanwhile on the next.
+
+        INPUT: session -- DB session
+               plateids -- plates to return exposures for
+               loud -- print timing info to std out
+        OUTPUT: array with one row per exposure, columns (mjd, plateid, qrRed, fullRed,
+                exp.time, exp.start_time, exp_num) as in get_plates
+        '''
+        from autoscheduler.plateDBtools.database.apo.platedb import ModelClasses as pdb
+        from autoscheduler.plateDBtools.database.apo.apogeeqldb import ModelClasses as qldb
+        start_time = time()
+
+        with self._lock:
+            plateids = [int(p) for p in plateids]
+            new = sorted(set(p for p in plateids if p not in self.plates))
+            conditions = list()
+            if len(new) > 0:
+                conditions.append(pdb.Plate.plate_id.in_(new))
+            if len(self.plates) > 0:
+                # every cached plate, asked for or not: hwm is one mark for all of them
+                conditions.append(sqlalchemy.and_(pdb.Plate.plate_id.in_(sorted(self.plates)),
+                                                  pdb.Exposure.pk > self.hwm))
+                pending = self.pending()
+                if len(pending) > 0:
+                    conditions.append(pdb.Exposure.pk.in_(pending))
+
+            nrows = 0
+            if len(conditions) > 0:
+                with session.begin():
+                    rows = session.query(sqlalchemy.func.floor(pdb.Exposure.start_time/86400+.3), pdb.Plate.plate_id,\
+                                qldb.Quickred.snr_standard, qldb.Reduction.snr, pdb.Exposure.exposure_time,\
+                                pdb.Exposure.start_time, pdb.Exposure.exposure_no, pdb.Exposure.pk)\
+                                .join(pdb.Survey).join(pdb.ExposureFlavor)\
+                                .join(pdb.Observation).join(pdb.PlatePointing).join(pdb.Plate)\
+                                .outerjoin(qldb.Quickred).outerjoin(qldb.Reduction)\
+                                .filter(pdb.ExposureFlavor.label == 'Object')\
+                                .filter(or_(*conditions)).all()
+                nrows = len(rows)
+                self.merge(np.array(rows, dtype=np.float) if nrows > 0 else [], new)
+                self.save()
+
+            out = self.rows[np.in1d(self.rows[:, 1], plateids), 0:7]
+
+        if loud:
+            print('[SQL]: exposure cache refreshed with {} new rows ({} cached) in {} s'.format(nrows, len(self.rows), time()-start_time))
+        return out
+
+
+def exposure_cache(south=False):
+    '''Returns the (process-wide) exposure cache for APO or LCO'''
+    name = 'apogee_exposures_{}.npz'.format('lco' if south else 'apo')
+    with _lock:
+        if name not in _caches:
+            _caches[name] = ExposureCache(os.path.join(CACHE_DIR, name))
+        return _caches[name]
@@ -1,17 +1,17 @@
 from __future__ import print_function, division
 from time import time
-import os
 import sys
 import sqlalchemy
-from sqlalchemy import or_
 import numpy as np
+from autoscheduler.plateDBtools.apogee.cohorts import CohortIndex
+from autoscheduler.run_context import RunContext, site_connection
 # from sdss.apogee.plate_completion import completion
 
 
 # DESCRIPTION: APOGEE Plate Object
 class ApogeePlate(object):
     # Identifying plate information
-    def __init__(self, plate=None):
+    def __init__(self, plate=None, info=None):
         if plate is None:
             raise Exception("Somehow tried to make plate object without a plate")
         # properties we get from plate object
@@ -20,9 +20,6 @@ class ApogeePlate(object):
         self.locationid = plate.location_id
         self.plateid = plate.plate_id
         self.platepk = plate.pk
-        self.ddict = plate.design.designDictionary
-        # plate_loc is physical location
-        self.plate_loc = plate.location.label
 
         # NOTE FROM JOHN: ddict contains RA, DEC, and survey info
         # if this runs slowly, use ddict to set these
@@ -41,6 +38,23 @@ class ApogeePlate(object):
         # only applicable to LCO
         self._apogee_survey_mode = None
 
+        if info is None:
+            self.ddict = plate.design.designDictionary
+            # plate_loc is physical location
+            self.plate_loc = plate.location.label
+        else:
+            # values already fetched by load_plate_info
+            self.ddict = info['ddict']
+            self.plate_loc = info['plate_loc']
+            self._ra = info['ra']
+            self._dec = info['dec']
+            self._ha = info['ha']
+            self._maxha = info['maxha']
+            self._minha = info['minha']
+            self._manual_priority = info['manual_priority']
+            self._plugged = info['plugged']
+            self._lead_survey = info['lead_survey']
+
         # catch values not set properly
         if 'apogee_design_type' in self.ddict:
             self.cadence = self.ddict['apogee_design_type']
@@ -58,10 +72,12 @@ class ApogeePlate(object):
         # properties requiring exposure info
         self.vdone = 0
         self.sn = 0.0
-        self.hist = ''
         self.snql = 0.0
         self.snred = 0.0
-        self.reduction = ''
+        # visit history: JD, S/N^2 and full reduction flag of every visit, in date order
+        self.visits = np.zeros(0)
+        self.visit_sn = np.zeros(0)
+        self.visit_reduced = np.zeros(0, dtype=bool)
         # exposures returns a list of dicts for each exposure
         # keys: exp_no, mjd, quality, start_time, exp_time, qr_sn2, apr_sn2
         # apr_sn2 may be nan if not processed yet. 
@@ -151,6 +167,22 @@ class ApogeePlate(object):
                 self._coobs = False
         return self._coobs
 
+    @property
+    def hist(self):
+        # comma-terminated visit JDs, for output and debug files
+        return ''.join(['{},'.format(int(d)) for d in self.visits])
+
+    @hist.setter
+    def hist(self, value):
+        self.visits = np.array([float(x) for x in value.split(',') if x != ''])
+        self.visit_sn = np.zeros(len(self.visits))
+        self.visit_reduced = np.zeros(len(self.visits), dtype=bool)
+
+    @property
+    def reduction(self):
+        # comma-terminated full reduction flags of the visits
+        return ''.join(['1,' if r else '0,' for r in self.visit_reduced])
+
     @property
     def apogee_survey_mode(self):
         if self._apogee_survey_mode is None:
@@ -166,19 +198,15 @@ class ApogeePlate(object):
 # ----------------------------
     # Determine most recent observation time
     def maxhist(self):
-        obsstr = self.hist.split(',')
-        if len(obsstr) == 0 or obsstr[0] == '':
+        if len(self.visits) == 0:
             return float(0.0)
-        obshist = [float(x) for x in obsstr if x != '']
-        return max(obshist)
+        return float(self.visits.max())
 
     # Determine first observation time
     def minhist(self):
-        obsstr = self.hist.split(',')
-        if len(obsstr) == 0 or obsstr[0] == '':
+        if len(self.visits) == 0:
             return float(0.0)
-        obshist = [float(x) for x in obsstr if x != '']
-        return min(obshist)
+        return float(self.visits.min())
 
     # Determine plate completion percentage
     def pct(self):
@@ -214,8 +242,179 @@ def getPlateid(item):
         return item.plateid
 
 
+def _as_output(apg, columnar):
+    if columnar:
+        from autoscheduler.plateDBtools.apogee.plate_table import PlateTable
+        return PlateTable.from_plates(apg)
+    return apg
+
+
+def load_plate_info(session, plates, loud=True):
+    '''DESCRIPTION: Fetches the values ApogeePlate otherwise loads lazily, one plate at a time,
+    for a whole list of plates with a fixed number of set-based queries
+    INPUT:
+        session: DB session
+        plates: list of platedb Plate objects
+        loud: print timing info to std out
+    OUTPUT: info -- dict keyed by plate pk of dicts to pass to ApogeePlate(plate, info=...)
+            nqueries -- the number of queries issued'''
+    from autoscheduler.plateDBtools.database.apo.platedb import ModelClasses as pdb
+    start_time = time()
+
+    pks = [p.pk for p in plates]
+    info = dict()
+    for p in plates:
+        info[p.pk] = {'ddict': dict(), 'plate_loc': None, 'ra': None, 'dec': None, 'ha': None,
+                      'maxha': None, 'minha': None, 'manual_priority': None, 'plugged': 0,
+                      'lead_survey': 'apg'}
+    if len(pks) == 0:
+        return info, 0
+
+    with session.begin():
+        # design values (the design dictionary)
+        values = session.query(pdb.Plate.pk, pdb.DesignField.label, pdb.DesignValue.value)\
+                        .join(pdb.Design, pdb.Plate.design)\
+                        .join(pdb.DesignValue, pdb.Design.values)\
+                        .join(pdb.DesignField, pdb.DesignValue.field)\
+                        .filter(pdb.Plate.pk.in_(pks)).all()
+
+        # plate location and current survey mode
+        modes = session.query(pdb.Plate.pk, pdb.PlateLocation.label, pdb.SurveyMode.label)\
+                       .join(pdb.PlateLocation, pdb.Plate.location)\
+                       .outerjoin(pdb.SurveyMode, pdb.Plate.currentSurveyMode)\
+                       .filter(pdb.Plate.pk.in_(pks)).all()
+
+        # pointing and plate_pointing of the first pointing of each design
+        pointings = session.query(pdb.Plate.pk, pdb.Pointing.center_ra, pdb.Pointing.center_dec,
+                                  pdb.PlatePointing.hour_angle, pdb.PlatePointing.ha_observable_max,
+                                  pdb.PlatePointing.ha_observable_min, pdb.PlatePointing.priority)\
+                           .join(pdb.PlatePointing, pdb.Plate.plate_pointings)\
+                           .join(pdb.Pointing, pdb.PlatePointing.pointing)\
+                           .filter(pdb.Plate.pk.in_(pks))\
+                           .order_by(pdb.Plate.pk, pdb.Pointing.pk).all()
+
+        # cartridges of the active pluggings
+        plugged = session.query(pdb.Plate.pk, pdb.Cartridge.number)\
+                         .join(pdb.Plugging, pdb.Plate.pluggings)\
+                         .join(pdb.Cartridge, pdb.Plugging.cartridge)\
+                         .join(pdb.ActivePlugging, pdb.Plugging.activePlugging)\
+                         .filter(pdb.Plate.pk.in_(pks))\
+                         .order_by(pdb.Plugging.fscan_mjd).all()
+    nqueries = 4
+
+    for pk, label, value in values:
+        info[pk]['ddict'][label.lower()] = value
+    for pk, loc, mode in modes:
+        info[pk]['plate_loc'] = loc
+        if mode is not None and mode != 'APOGEE lead':
+            info[pk]['lead_survey'] = 'man'
+    for pk, ra, dec, ha, maxha, minha, priority in reversed(pointings):
+        # rows are ordered by pointing, so the first pointing is written last
+        info[pk]['ra'] = float(ra)
+        info[pk]['dec'] = float(dec)
+        info[pk]['ha'] = float(ha)
+        info[pk]['maxha'] = float(maxha) + 7.5
+        info[pk]['minha'] = float(minha) - 7.5
+        info[pk]['manual_priority'] = int(priority)
+    for pk, cart in plugged:
+        # pluggings are ordered by fscan_mjd, the last active one wins
+        info[pk]['plugged'] = cart
+
+    if loud:
+        print('[SQL]: plate attributes loaded with {} queries in {} s'.format(nqueries, time()-start_time))
+    return info, nqueries
+
+
+def add_history(apg, exposures_tab, mjd=None, cohorts=None):
+    '''DESCRIPTION: Fills the exposure list and visit history of every plate from its exposures.
+    Plates that share location and cohort (apgver) share their visits.
+    INPUT:
+        apg: list of ApogeePlate objects
+        exposures_tab: array of exposures, one row per exposure with columns
+                       (mjd, plateid, qrRed, fullRed, exp.time, exp.start_time, exp_num)
+        mjd: exposures taken on mjd are not counted as visits
+        cohorts: CohortIndex of apg, built here if not given
+    OUTPUT: none, sets exposureList, visits, visit_sn, visit_reduced, vdone, sn, snql and snred
+    NOTE: per-day S/N sums are accumulated in exposure order, so sn, snql and snred can
+          differ from a plain np.sum in the last bit'''
+    if len(apg) == 0 or len(exposures_tab) == 0:
+        return
+
+    plateids = np.array([p.plateid for p in apg])
+    porder = np.argsort(plateids, kind='mergesort')
+    # index into apg of the plate of every exposure
+    expPlate = porder[np.searchsorted(plateids[porder], exposures_tab[:, 1])]
+
+    # exposure lists, grouped by plate
+    eorder = np.argsort(expPlate, kind='mergesort')
+    for exp, i in zip(exposures_tab[eorder], expPlate[eorder]):
+        apg[i].exposureList.append({'exp_no': exp[6], 'mjd': exp[0],\
+                                    'quality': exp[2] > 10 or exp[3] > 10,\
+                                    'start_time': exp[5], 'exp_time': exp[4],\
+                                    'qr_sn2': exp[2]**2, 'apr_sn2': exp[3]**2})
+
+    # use the full reduction S/N where available, quicked otherwise; convert nones in SNR to zeros
+    qr = np.nan_to_num(exposures_tab[:, 2])
+    red = np.nan_to_num(exposures_tab[:, 3])
+    full = np.where(np.isnan(exposures_tab[:, 3]), qr, red)
+    good = full > 10
+    if mjd is not None:
+        good &= exposures_tab[:, 0] != mjd
+
+    # cohort (location, apogee version) of every plate and every good exposure
+    if cohorts is None:
+        cohorts = CohortIndex(apg)
+    cohort = cohorts.cohort
+    ncohort = cohorts.ncohort
+    expCohort = cohort[expPlate[good]]
+    dates = exposures_tab[good, 0]
+    qr, red, full = qr[good], red[good], full[good]
+
+    # group good exposures by (cohort, mjd); a visit is a day with at least two of them
+    order = np.lexsort((dates, expCohort))
+    expCohort, dates = expCohort[order], dates[order]
+    qr, red, full = qr[order], red[order], full[order]
+    if len(order) == 0:
+        return
+    starts = np.flatnonzero(np.concatenate([[True], (np.diff(expCohort) != 0) | (np.diff(dates) != 0)]))
+    nexp = np.diff(np.append(starts, len(order)))
+    visit = nexp >= 2
+    vCohort = expCohort[starts][visit]
+    vDates = dates[starts][visit]
+    vSn = np.add.reduceat(full**2, starts)[visit]
+    vSnql = np.add.reduceat(qr**2, starts)[visit]
+    vSnred = np.add.reduceat(red**2, starts)[visit]
+    vReduced = (np.add.reduceat(full, starts) == np.add.reduceat(red, starts))[visit]
+
+    # totals per cohort (visits are in date order within each cohort)
+    vdone = np.bincount(vCohort, minlength=ncohort)
+    sn = np.bincount(vCohort, weights=vSn, minlength=ncohort)
+    snql = np.bincount(vCohort, weights=vSnql, minlength=ncohort)
+    snred = np.bincount(vCohort, weights=vSnred, minlength=ncohort)
+    vstarts = np.searchsorted(vCohort, np.arange(ncohort + 1))
+
+    for p, c in zip(apg, cohort):
+        if vdone[c] == 0:
+            continue
+        days = slice(vstarts[c], vstarts[c + 1])
+        p.visits = np.concatenate([p.visits, vDates[days] + 2400000])
+        p.visit_sn = np.concatenate([p.visit_sn, vSn[days]])
+        p.visit_reduced = np.concatenate([p.visit_reduced, vReduced[days]])
+        p.vdone += int(vdone[c])
+        p.sn += float(sn[c])
+        p.snql += float(snql[c])
+        p.snred += float(snred[c])
+
+
+def apogee_session(south=False, connection=None):
+    '''Returns a session on the plate database of the site, or on connection (see
+    run_context.site_connection, e.g. MyLocalConnection for a local stand-in database)'''
+    return site_connection(south, connection).Session()
+
+
 def get_plates(errors=None, plan=False, loud=True, session=None, atapo=True, allPlates=False, 
-               plateList=None, south=False, mjd=None):
+               plateList=None, south=False, mjd=None, bulk=True, columnar=False, cache=False, context=None,
+               return_cohorts=False):
     '''DESCRIPTION: Reads in APOGEE-II plate information from platedb
     INPUT: 
         plan: grabs everything that can be observed tonight (i.e. on the mountain, marked accepted)
@@ -226,25 +425,27 @@ def get_plates(errors=None, plan=False, loud=True, session=None, atapo=True, all
         plateList: a list of integers corresponding to plates; must be iterable.
         south: pull from lco-db (works at LCO)
         mjd: only used at lco; excludes exposures taken on mjd to keep schedule consistent through night
-    OUTPUT: apg -- list of objects with all APOGEE-II plate information'''
+        bulk: load pointing, design, survey mode and plugging info for all plates up front
+              (see load_plate_info) instead of lazily per plate
+        columnar: return a PlateTable (see plate_table.py) instead of a list
+        cache: read exposures through the incremental local cache (see exposure_cache.py)
+        context: RunContext of the scheduler run, for its session and reference lookups
+        return_cohorts: also return the CohortIndex of the plates (see cohorts.py)
+    OUTPUT: apg -- list of objects with all APOGEE-II plate information, by plate id, and
+            cohorts -- their CohortIndex, if return_cohorts'''
     start_time = time()
 
+    if context is None:
+        context = RunContext(south=south, session=session if session is not None else apogee_session(south),
+                             warm=False)
     if session is None:
-        if not south:
-            # Create database connection
-            if (os.path.dirname(os.path.realpath(__file__))).find('utah.edu') >= 0:
-                from autoscheduler.plateDBtools.database.connections.UtahLocalConnection import db
-            else:
-                from autoscheduler.plateDBtools.database.connections.APODatabaseUserLocalConnection import db
-        else:
-            from autoscheduler.plateDBtools.database.connections.LCODatabaseUserLocalConnection import db
-        session = db.Session()
+        session = context.session
     # currently, model classes should work equally well in north and south. this is desireable
     from autoscheduler.plateDBtools.database.apo.platedb import ModelClasses as pdb
     from autoscheduler.plateDBtools.database.apo.apogeeqldb import ModelClasses as qldb
 
     try:
-        acceptedStatus = session.query(pdb.PlateStatus).filter(pdb.PlateStatus.label == "Accepted").one()
+        acceptedStatus = context.label_pk(pdb.PlateStatus, "Accepted")
     except sqlalchemy.orm.exc.NoResultFound:
         raise Exception("Could not find 'Accepted' status in plate_status table")
 
@@ -254,27 +455,27 @@ def get_plates(errors=None, plan=False, loud=True, session=None, atapo=True, all
 
     if south:
         try:
-            survey = session.query(pdb.Survey).filter(pdb.Survey.label == "APOGEE-2S").one()
+            survey = context.label_pk(pdb.Survey, "APOGEE-2S")
         except sqlalchemy.orm.exc.NoResultFound:
             raise Exception("Could not find 'APOGEE-2' survey in survey table")
 
         try:
-            plateLoc = session.query(pdb.PlateLocation).filter(pdb.PlateLocation.label == "LCO").one()
+            plateLoc = context.label_pk(pdb.PlateLocation, "LCO")
         except sqlalchemy.orm.exc.NoResultFound:
             raise Exception("Could not find 'LCO' location in plate_location table")
 
         try:
-            plateLoc2 = session.query(pdb.PlateLocation).filter(pdb.PlateLocation.label == "du Pont").one()
+            plateLoc2 = context.label_pk(pdb.PlateLocation, "du Pont")
         except sqlalchemy.orm.exc.NoResultFound:
             raise Exception("Could not find 'du Pont' location in plate_location table")
     else:
         try:
-            survey = session.query(pdb.Survey).filter(pdb.Survey.label == "APOGEE-2").one()
+            survey = context.label_pk(pdb.Survey, "APOGEE-2")
         except sqlalchemy.orm.exc.NoResultFound:
             raise Exception("Could not find 'APOGEE-2' survey in survey table")
 
         try:
-            plateLoc = session.query(pdb.PlateLocation).filter(pdb.PlateLocation.label == "APO").one()
+            plateLoc = context.label_pk(pdb.PlateLocation, "APO")
         except sqlalchemy.orm.exc.NoResultFound:
             raise Exception("Could not find 'APO' location in plate_location table")
         # need this as a place holder for southern logic
@@ -287,12 +488,12 @@ def get_plates(errors=None, plan=False, loud=True, session=None, atapo=True, all
         if plateList is not None:
             # getting plates with same loc id as requested plates to determine hist & completion
             locIDS = session.query(pdb.Plate.location_id)\
-               .filter(pdb.Survey.pk == survey.pk)\
+               .filter(pdb.Survey.pk == survey)\
                .filter(pdb.Plate.plate_id.in_(plateList)).all()
 
             plates = session.query(pdb.Plate)\
                .join(pdb.PlateToSurvey, pdb.Survey)\
-               .filter(pdb.Survey.pk == survey.pk)\
+               .filter(pdb.Survey.pk == survey)\
                .filter(pdb.Plate.location_id.in_(locIDS)).all()
 
         elif plan:
@@ -300,51 +501,57 @@ def get_plates(errors=None, plan=False, loud=True, session=None, atapo=True, all
                     .join(pdb.PlateToSurvey, pdb.Survey)\
                     .join(pdb.PlateLocation)\
                     .join(pdb.PlateToPlateStatus, pdb.PlateStatus)\
-                    .filter(pdb.Survey.pk == survey.pk)\
-                    .filter(or_(pdb.Plate.location == plateLoc, pdb.Plate.location == plateLoc2))\
+                    .filter(pdb.Survey.pk == survey)\
+                    .filter(pdb.PlateLocation.pk.in_([pk for pk in (plateLoc, plateLoc2) if pk is not None]))\
                     .filter(sqlalchemy.func.platedb.lead_survey(pdb.Plate.plate_id) == 'apogeeLead')\
-                    .filter(pdb.PlateStatus.pk == acceptedStatus.pk).all()
+                    .filter(pdb.PlateStatus.pk == acceptedStatus).all()
             locIDS = session.query(pdb.Plate.location_id)\
-                   .filter(pdb.Survey.pk == survey.pk)\
+                   .filter(pdb.Survey.pk == survey)\
                    .filter(pdb.Plate.plate_id.in_(protoList)).all()
             plates = session.query(pdb.Plate)\
                    .join(pdb.PlateToSurvey, pdb.Survey)\
-                   .filter(pdb.Survey.pk == survey.pk)\
+                   .filter(pdb.Survey.pk == survey)\
                    .filter(pdb.Plate.location_id.in_(locIDS)).all()
 
         elif allPlates:
             plates = session.query(pdb.Plate)\
                .join(pdb.PlateToSurvey, pdb.Survey)\
-               .filter(pdb.Survey.pk == survey.pk).all()
+               .filter(pdb.Survey.pk == survey).all()
         else:
             protoList = session.query(pdb.Plate.plate_id)\
                    .join(pdb.PlateToSurvey, pdb.Survey)\
                    .join(pdb.Plugging, pdb.Cartridge)\
                    .join(pdb.ActivePlugging)\
-                   .filter(pdb.Survey.pk == survey.pk)\
+                   .filter(pdb.Survey.pk == survey)\
                    .filter(sqlalchemy.func.platedb.lead_survey(pdb.Plate.plate_id) == 'apogeeLead')\
                    .order_by(pdb.Cartridge.number).all()
             # .filter(sqlalchemy.func.platedb.lead_survey(pdb.Plate.plate_id) == 'apogeelead')\
 
             # getting plates with same loc id as PLUGGED plates to determine hist & completion
             locIDS = session.query(pdb.Plate.location_id)\
-               .filter(pdb.Survey.pk == survey.pk)\
+               .filter(pdb.Survey.pk == survey)\
                .filter(pdb.Plate.plate_id.in_(protoList)).all()
           # assert len(locIDS) > 0
             plates = session.query(pdb.Plate)\
                .join(pdb.PlateToSurvey, pdb.Survey)\
-               .filter(pdb.Survey.pk == survey.pk)\
+               .filter(pdb.Survey.pk == survey)\
                .filter(pdb.Plate.location_id.in_(locIDS)).all()
 
     q1Time = time()
     if loud:
         print('[SQL]: plate query completed in {} s'.format(q1Time-start_time))
 
+    if bulk:
+        plateInfo, nqueries = load_plate_info(session, plates, loud=loud)
+    else:
+        # attributes are loaded lazily, plate by plate
+        plateInfo, nqueries = dict(), None
+
     # create the list of apg plate objects
     apg = list()
     tmpPlateList = list()
     for plate in plates:
-        tmpPlate = ApogeePlate(plate)
+        tmpPlate = ApogeePlate(plate, info=plateInfo.get(plate.pk))
         if allPlates or plateList is not None:
             apg.append(tmpPlate)
         else:
@@ -357,113 +564,56 @@ def get_plates(errors=None, plan=False, loud=True, session=None, atapo=True, all
 
     assignmentTime = time()
     if loud:
-        print('[PY]: plate object created in {} s'.format(assignmentTime-q1Time))
+        if nqueries is None:
+            print('[PY]: plate object created in {} s'.format(assignmentTime-q1Time))
+        else:
+            print('[PY]: plate object created in {} s ({} attribute queries)'.format(assignmentTime-q1Time,
+                                                                                     nqueries))
 
     exposedPlates = [p.plateid for p in apg]
-    with session.begin():
-        # returns list of tuples (mjd,plateid,qrRed,fullRed,exp.time,exp.start_time,exp_num)
-        exposures = session.query(sqlalchemy.func.floor(pdb.Exposure.start_time/86400+.3), pdb.Plate.plate_id,\
-                    qldb.Quickred.snr_standard, qldb.Reduction.snr, pdb.Exposure.exposure_time, pdb.Exposure.start_time, pdb.Exposure.exposure_no)\
-                    .join(pdb.Survey).join(pdb.ExposureFlavor)\
-                    .join(pdb.Observation).join(pdb.PlatePointing).join(pdb.Plate)\
-                    .outerjoin(qldb.Quickred).outerjoin(qldb.Reduction)\
-                    .filter(pdb.ExposureFlavor.label == 'Object')\
-                    .filter(pdb.Plate.plate_id.in_(exposedPlates)).all()
-        # removed survey label filter to deal with mislabled exposures
-        # .filter(pdb.Survey.label == 'APOGEE-2' )
+    if cache:
+        from autoscheduler.plateDBtools.apogee.exposure_cache import exposure_cache
+        exposures = exposure_cache(south).exposures(session, exposedPlates, loud=loud)
+    else:
+        with session.begin():
+            # returns list of tuples (mjd,plateid,qrRed,fullRed,exp.time,exp.start_time,exp_num)
+            exposures = session.query(sqlalchemy.func.floor(pdb.Exposure.start_time/86400+.3), pdb.Plate.plate_id,\
+                        qldb.Quickred.snr_standard, qldb.Reduction.snr, pdb.Exposure.exposure_time, pdb.Exposure.start_time, pdb.Exposure.exposure_no)\
+                        .join(pdb.Survey).join(pdb.ExposureFlavor)\
+                        .join(pdb.Observation).join(pdb.PlatePointing).join(pdb.Plate)\
+                        .outerjoin(qldb.Quickred).outerjoin(qldb.Reduction)\
+                        .filter(pdb.ExposureFlavor.label == 'Object')\
+                        .filter(pdb.Plate.plate_id.in_(exposedPlates)).all()
+            # removed survey label filter to deal with mislabled exposures
+            # .filter(pdb.Survey.label == 'APOGEE-2' )
     q2Time = time()
 
     if loud:
         print('[SQL]: exposures query completed in {} s'.format(q2Time-assignmentTime))
 
-    plateidDict = dict()
-    for i, p in enumerate(apg):
-        plateidDict[p.plateid] = i
+    # Plates by plate id, and their cohorts, built once for add_history and the callers
+    apg = sorted(apg, key=getPlateid)
+    cohorts = CohortIndex(apg)
 
-    if len(exposures) == 0:
-        end_time = time()
-        if loud:
-            print('[PY]: get_plates complete in {} s'.format(end_time-start_time))
+    if len(exposures) > 0:
+        exposures_tab = np.array(exposures)
+        exposures_tab = np.array(exposures_tab, dtype=np.float)
+        add_history(apg, exposures_tab, mjd=mjd, cohorts=cohorts)
 
-        if plateList is not None:
-            plateList = list(plateList)
-            plateList = sorted(plateList)
-            return [apg[plateidDict[p]] for p in plateList]
-
-        return sorted(apg, key=getPlateid)
-
-    exposures_tab = np.array(exposures)
-    exposures_tab = np.array(exposures_tab, dtype=np.float)
-    proto_good_exp = np.nan_to_num(exposures_tab)
-
-    fullRedCheck = np.copy([exposures_tab[:, 0], exposures_tab[:, 1],\
-                            exposures_tab[:, 2],\
-                            exposures_tab[:, 3],\
-                            [x[3] if not np.isnan(x[3]) else x[2] for x in exposures_tab]]).swapaxes(0, 1)
-
-    # convert nones in SNR to zeros
-    proto_good_exp = np.nan_to_num(fullRedCheck)
-    good_exp = proto_good_exp[proto_good_exp[:, 4] > 10]
-
-    for p in apg:
-        exp_to_add = exposures_tab[exposures_tab[:, 1] == p.plateid]
-        for exp in exp_to_add:
-            p.exposureList.append({'exp_no': exp[6], 'mjd': exp[0],\
-                                   'quality': exp[2] > 10 or exp[3] > 10,\
-                                   'start_time': exp[5], 'exp_time': exp[4],\
-                                   'qr_sn2': exp[2]**2, 'apr_sn2': exp[3]**2})
-        if p.hist != '' and p.vdone != 0:
-            continue
-        repeat = []
-        # find plates that share location and cohort
-        for pl in apg:
-            if p.plateid == pl.plateid:
-                continue
-            if p.locationid == pl.locationid:
-                if p.apgver == pl.apgver:
-                    repeat.append(pl.plateid)
-        if repeat != []:
-            repeat.append(p.plateid)
-            plateExps = good_exp[np.in1d(good_exp[:, 1], repeat)]
-            dates = np.unique(plateExps[:, 0])
-            for d in dates:
-                if d != mjd:
-                    day = plateExps[plateExps[:, 0] == d]
-                    if day.shape[0] >= 2:
-                        for r in repeat:
-                            apg[plateidDict[r]].hist += '{},'.format(int(d)+2400000)
-                            apg[plateidDict[r]].vdone += 1
-                            apg[plateidDict[r]].sn += float(np.sum(day[:, 4]**2))
-                            apg[plateidDict[r]].snql += float(np.sum(day[:, 2]**2))
-                            apg[plateidDict[r]].snred += float(np.sum(day[:, 3]**2))
-                            if np.sum(day[:, 4]) == np.sum(day[:, 3]):
-                                apg[plateidDict[r]].reduction += '1,'
-                            else:
-                                apg[plateidDict[r]].reduction += '0,'
-        else:
-            plateExps = good_exp[good_exp[:, 1] == p.plateid]
-            dates = np.unique(plateExps[:, 0])
-            for d in dates:
-                if d != mjd:
-                    day = plateExps[plateExps[:, 0] == d]
-                    if day.shape[0] >= 2:
-                        p.hist += '{},'.format(int(d)+2400000)
-                        p.vdone += 1
-                        p.sn += float(np.sum(day[:, 4]**2))
-                        p.snql += float(np.sum(day[:, 2]**2))
-                        p.snred += float(np.sum(day[:, 3]**2))
-                        if np.sum(day[:, 4]) == np.sum(day[:, 3]):
-                            p.reduction += '1,'
-                        else:
-                            p.reduction += '0,'
+    if plateList is not None:
+        plateidDict = dict()
+        for i, p in enumerate(apg):
+            plateidDict[p.plateid] = i
+        plateList = list(plateList)
+        plateList = sorted(plateList)
+        if plateList != [p.plateid for p in apg]:
+            apg = [apg[plateidDict[p]] for p in plateList]
+            cohorts = CohortIndex(apg)
 
     end_time = time()
     if loud:
         print('[PY]: get_plates complete in {} s'.format(end_time-start_time))
 
-    if plateList is not None:
-        plateList = list(plateList)
-        plateList = sorted(plateList)
-        return [apg[plateidDict[p]] for p in plateList]
-
-    return sorted(apg, key=getPlateid)
+    if return_cohorts:
+        return _as_output(apg, columnar), cohorts
+    return _as_output(apg, columnar)
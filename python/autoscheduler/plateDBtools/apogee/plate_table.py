@@ -0,0 +1,146 @@
+from __future__ import print_function, division
+import numpy as np
+from autoscheduler.plateDBtools.apogee.get_apogee_plates import calculateSnCompletion
+
+
+# DESCRIPTION: Columnar (struct-of-arrays) form of a list of ApogeePlate objects.
+# Every plate value is one entry of a NumPy column, so stages that work on
+# whole columns avoid the per-plate attribute lookups.
+
+# column name, dtype
+FIELDS = [('plateid', np.int64), ('platepk', np.int64), ('locationid', np.int64),
+          ('apgver', np.int64), ('vplan', np.int64), ('vdone', np.int64),
+          ('ra', np.float64), ('dec', np.float64), ('ha', np.float64),
+          ('minha', np.float64), ('maxha', np.float64), ('manual_priority', np.float64),
+          ('plugged', np.int64), ('exp_time', np.float64), ('coobs', np.bool_),
+          ('sn', np.float64), ('snql', np.float64), ('snred', np.float64),
+          ('priority', np.float64), ('stack', np.int64),
+          ('name', object), ('cadence', object), ('driver', object), ('lead_survey', object),
+          ('apogee_survey_mode', object), ('plate_loc', object),
+          ('first_visit', np.float64), ('last_visit', np.float64),
+          ('visits', object), ('visit_sn', object), ('visit_reduced', object),
+          ('plate', object), ('ddict', object), ('exposureList', object)]
+
+
+class PlateRow(object):
+    """A view of one row of a `PlateTable` that reads and writes the table
+    columns, so code written for `ApogeePlate` objects keeps working.
+
+    """
+
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        object.__setattr__(self, '_table', table)
+        object.__setattr__(self, '_index', index)
+
+    def __getattr__(self, name):
+        try:
+            column = self._table.columns[name]
+        except KeyError:
+            raise AttributeError("PlateRow has no attribute '{}'".format(name))
+        value = column[self._index]
+        # return python scalars, as ApogeePlate does
+        return value.item() if isinstance(value, np.generic) else value
+
+    def __setattr__(self, name, value):
+        if name not in self._table.columns:
+            raise AttributeError("PlateRow has no column '{}'".format(name))
+        self._table.columns[name][self._index] = value
+
+    def __repr__(self):
+        return "<PlateRow: plateid={}>".format(self.plateid)
+
+    @property
+    def hist(self):
+        return ''.join(['{},'.format(int(d)) for d in self.visits])
+
+    @property
+    def reduction(self):
+        return ''.join(['1,' if r else '0,' for r in self.visit_reduced])
+
+    def maxhist(self):
+        return self.last_visit
+
+    def minhist(self):
+        return self.first_visit
+
+    def pct(self):
+        if self.vplan == 0:
+            return 1
+        return 0.9 * min([1, self.vdone / self.vplan]) + 0.1 * calculateSnCompletion(self.vplan, self.sn)
+
+
+class PlateTable(object):
+    """APOGEE plates stored as a dict of equal-length NumPy columns.
+
+    Indexing with an integer returns a `PlateRow` view and iterating yields
+    one view per plate, so the table can stand in for the list returned by
+    `get_plates`. Indexing with a column name returns the whole column.
+
+    The visit history is kept as per-plate arrays (visits, visit_sn,
+    visit_reduced) plus first_visit/last_visit columns, so cadence rules can
+    work on whole columns; hist and reduction strings are built on request.
+
+    Parameters
+    ----------
+    columns : dict
+        Column name -> array. Missing columns from `FIELDS` are zero-filled.
+
+    """
+
+    def __init__(self, columns):
+        n = len(columns['plateid']) if 'plateid' in columns else 0
+        self.columns = dict()
+        for name, dtype in FIELDS:
+            if name in columns:
+                self.columns[name] = np.asarray(columns[name], dtype=dtype)
+            else:
+                self.columns[name] = np.zeros(n, dtype=dtype)
+        for name in columns:
+            if name not in self.columns:
+                self.columns[name] = np.asarray(columns[name])
+
+    @classmethod
+    def from_plates(cls, apg):
+        '''Builds a table from a list of ApogeePlate objects (or row views)'''
+        columns = dict()
+        for name, dtype in FIELDS:
+            if name == 'coobs':
+                # missing instrument info means no co-observing, instead of a KeyError
+                values = ['MANGA' in p.ddict.get('instruments', '') for p in apg]
+            elif name == 'first_visit':
+                values = [p.minhist() for p in apg]
+            elif name == 'last_visit':
+                values = [p.maxhist() for p in apg]
+            else:
+                values = [getattr(p, name) for p in apg]
+            if dtype is object:
+                # filled one by one so list and array values stay single entries
+                column = np.empty(len(apg), dtype=object)
+                for i, value in enumerate(values):
+                    column[i] = value
+            else:
+                column = np.array(values, dtype=dtype)
+            columns[name] = column
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.columns['plateid'])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('plate index out of range')
+        return PlateRow(self, key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield PlateRow(self, i)
+
+    def take(self, index):
+        '''Returns a new table with the rows in index (an index or boolean array)'''
+        return PlateTable(dict((name, column[index]) for name, column in self.columns.items()))
@@ -0,0 +1,208 @@
+# ---- SDSS-IV AUTOSCHEDULER: MID-NIGHT RE-PLANNING ----
+# DESCRIPTION: Re-picks the APOGEE-II blocks that have not started yet, after weather
+# or a failed plate, from state kept since the first plan of the night: the plate
+# table, its cohort and sky indexes and the observability terms of every block.
+# Only exposures taken since the last run are read from the database.
+
+from __future__ import print_function, division
+from time import time
+import os
+import threading
+import numpy as np
+
+from autoscheduler import night_schedule
+from autoscheduler import observability_kernel as kernel
+from autoscheduler.ephemeris import night_ephemeris
+from autoscheduler.s4as import apogee_twilight, plan_output
+from autoscheduler.plateDBtools.apogee.get_apogee_plates import get_plates, add_history, apogee_session
+from autoscheduler.plateDBtools.apogee.exposure_cache import exposure_cache
+from autoscheduler.apogee.schedule_apogee import DEFAULT_PAR, apogee_slots
+from autoscheduler.apogee.set_apogee_priorities import set_priorities_array
+from autoscheduler.apogee.observability import observability, observability_terms
+from autoscheduler.apogee.pick_apogee_plates import pick_plates
+
+# Seconds of slack when comparing block times
+TIME_SLACK = 1 / 86400
+
+# State of the night being re-planned, by schedule JD
+_states = dict()
+_states_lock = threading.Lock()
+
+
+def _history_signature(apg, exposures):
+    # exposure count and summed S/N of every plate, to spot plates with new or updated exposures
+    plateids = apg.columns['plateid']
+    porder = np.argsort(plateids, kind='mergesort')
+    index = porder[np.searchsorted(plateids[porder], exposures[:, 1])]
+    count = np.bincount(index, minlength=len(apg))
+    snr = np.bincount(index, weights=np.nan_to_num(exposures[:, 2]) + np.nan_to_num(exposures[:, 3]),
+                      minlength=len(apg))
+    return count, snr
+
+
+class NightState(object):
+    """What a re-plan reuses from earlier runs of the same night.
+
+    refresh and the priorities update the plate table in place, so a re-plan
+    holds lock from the refresh to the picks.
+
+    Parameters
+    ----------
+    schedule : dict
+        Tonight's schedule line, as returned by read_schedule.
+    par : dict
+        APOGEE-II parameters.
+    errors : list
+        Error messages, appended to.
+    loud : bool
+        Print timing info to std out.
+
+    """
+
+    def __init__(self, schedule, par, errors, loud=True):
+        self.schedule = schedule
+        self.par = par
+        self.lock = threading.Lock()
+        self.twilight = apogee_twilight(schedule)
+        if self.twilight is None:
+            self.times, self.lengths = np.zeros(0), np.zeros(0)
+        else:
+            times, lengths = apogee_slots(schedule, par, twilight=self.twilight)
+            self.times, self.lengths = np.array(times, dtype=float), np.array(lengths, dtype=float)
+        # plugged plates (observing mode), with their exposures from the local cache
+        self.apg, self.cohorts = get_plates(errors, plan=False, loud=loud, columnar=True, cache=True,
+                                            return_cohorts=True)
+        self.index = kernel.SkyIndex(self.apg.columns['ra'], self.apg.columns['dec'])
+        self.exposures = exposure_cache().exposures(apogee_session(), self.apg.columns['plateid'], loud=loud)
+        self.signature = _history_signature(self.apg, self.exposures)
+        self.terms = None
+        if len(self.times) > 0 and len(self.apg) > 0:
+            ephem = night_ephemeris('apo', schedule['jd'])
+            self.terms = observability_terms(self.apg, par, self.times, self.lengths, ephem=ephem, index=self.index)
+
+    def refresh(self, loud=True):
+        '''
+        refresh: reads the exposures taken since the last run and rebuilds the history of
+                 the cohorts they belong to
+
+        OUTPUT: nplates -- number of plates whose history was rebuilt
+        '''
+        if len(self.apg) == 0:
+            return 0
+        exposures = exposure_cache().exposures(apogee_session(), self.apg.columns['plateid'], loud=loud)
+        signature = _history_signature(self.apg, exposures)
+        changed = (signature[0] != self.signature[0]) | (signature[1] != self.signature[1])
+        self.exposures, self.signature = exposures, signature
+        if not np.any(changed):
+            return 0
+
+        # the whole cohort of a changed plate shares its visits
+        cohorts = np.unique(self.cohorts.cohort[changed])
+        members = np.concatenate([self.cohorts.cohorts[c] for c in cohorts])
+        cols = self.apg.columns
+        for m in members:
+            cols['visits'][m] = np.zeros(0)
+            cols['visit_sn'][m] = np.zeros(0)
+            cols['visit_reduced'][m] = np.zeros(0, dtype=bool)
+            cols['exposureList'][m] = []
+        for name in ('vdone', 'sn', 'snql', 'snred'):
+            cols[name][members] = 0
+        sub = self.apg.take(members)
+        add_history(sub, exposures[np.in1d(exposures[:, 1], sub.columns['plateid'])])
+        for name in ('visits', 'visit_sn', 'visit_reduced', 'exposureList', 'vdone', 'sn', 'snql', 'snred'):
+            cols[name][members] = sub.columns[name]
+        for m in members:
+            visits = cols['visits'][m]
+            cols['first_visit'][m] = visits.min() if len(visits) > 0 else 0.0
+            cols['last_visit'][m] = visits.max() if len(visits) > 0 else 0.0
+        return len(members)
+
+
+def night_state(schedule, par, errors, loud=True, rebuild=False):
+    '''Returns the re-planning state of the night of schedule, built on first use'''
+    with _states_lock:
+        state = _states.get(schedule['jd'])
+    if state is None or rebuild:
+        state = NightState(schedule, par, errors, loud=loud)
+        with _states_lock:
+            # only tonight is kept
+            _states.clear()
+            _states[schedule['jd']] = state
+    return state
+
+
+def replan(now, last_plan, mjd=-1, surveys=['apogee', 'eboss', 'manga'], par=None, solver='greedy', rebuild=False,
+           loud=True):
+    '''
+    replan: re-picks the APOGEE-II blocks of tonight that start after now
+
+    Blocks of last_plan that have already started are kept as they are, and their plates
+    (their designs, unless stack-able) are not picked again. The remaining blocks are
+    picked as in schedule_apogee from the current priorities, with the observability
+    terms computed on the first run of the night. MaNGA and eBOSS picks are copied
+    from last_plan.
+
+    INPUT: now -- current time (JD)
+           last_plan -- plan returned by run_scheduler (or replan) for tonight
+           mjd, surveys -- as for run_scheduler (observing mode, north)
+           par -- APOGEE-II parameters (default DEFAULT_PAR)
+           solver -- APOGEE-II solver (see pick_apogee_plates.pick_plates)
+           rebuild -- drop the state kept for tonight and read everything again
+    OUTPUT: plan -- dictionary in run_scheduler format
+    '''
+    replan_start = time()
+    errors = []
+    if par is None:
+        par = dict(DEFAULT_PAR)
+    pwd = os.path.dirname(os.path.realpath(__file__))
+    schedule = night_schedule.read_schedule(pwd, errors, mjd=mjd, surveys=surveys, loud=loud)
+    state = night_state(schedule, par, errors, loud=loud, rebuild=rebuild)
+
+    # Blocks already started stay as planned
+    carts = dict()
+    for survey in ('apogee', 'manga', 'eboss'):
+        for pick in last_plan.get(survey, []):
+            if 'cart' in pick:
+                carts[pick['plate']] = pick['cart']
+    started = [pick for pick in last_plan.get('apogee', []) if pick['obsmjd'] + 2400000 < now + TIME_SLACK]
+    started_end = max([pick['obsmjd'] + 2400000 + pick['exposure_length'] / 24 for pick in started] + [now])
+    remaining = np.flatnonzero((state.times >= now) & (state.times + TIME_SLACK >= started_end))
+
+    picks = []
+    apg = state.apg
+    # one re-plan at a time updates the plate table of the night
+    with state.lock:
+        nrefresh = state.refresh(loud=loud)
+        refresh_end = time()
+        if loud:
+            print("[PY] Re-plan state ready, %d plate histories rebuilt (%.3f sec)"
+                  % (nrefresh, refresh_end - replan_start))
+
+        if len(remaining) > 0 and len(apg) > 0:
+            set_priorities_array(apg, par, schedule, plan=False, loud=False, twilight=state.twilight,
+                                 cohorts=state.cohorts)
+            transit, code = state.terms
+            obs = observability(apg, par, state.times[remaining], state.lengths[remaining], loud=False,
+                                index=state.index, terms=(transit[:, remaining], code[:, remaining]))
+            # plates of started blocks are not picked again; stack-able ones may follow themselves
+            plate_index = dict((int(p), i) for i, p in enumerate(apg.columns['plateid']))
+            for pick in started:
+                if pick['plate'] not in plate_index:
+                    continue
+                p = plate_index[pick['plate']]
+                designs = state.cohorts.same_cohort(p)
+                if apg.columns['stack'][p] == 0:
+                    obs[designs, :] = -10
+                elif pick is started[-1]:
+                    obs[designs, 0] = -10
+            picks = pick_plates(apg, obs, par, state.times[remaining], state.lengths[remaining], schedule,
+                                loud=False, cohorts=state.cohorts, solver=solver)
+            for pick in picks:
+                pick.pop('coobs', None)
+                pick['cart'] = carts.get(pick['plate'], -1)
+
+    plan = plan_output(schedule, started + picks, last_plan.get('manga', []), last_plan.get('eboss', []),
+                       errors + last_plan.get('errors', []))
+    if loud:
+        print("[PY] Re-planned %d APOGEE-II blocks after JD %.4f (%.3f sec)" % (len(picks), now, time() - replan_start))
+    return plan
@@ -0,0 +1,158 @@
+from __future__ import print_function, division
+import os
+import threading
+import weakref
+import importlib
+from sqlalchemy import event
+
+
+# DESCRIPTION: Database access shared by the survey modules during one scheduler run. The
+# connection module of the site is chosen once per process; a RunContext hands out the run's
+# session (one per thread, from the connection's scoped session), answers reference-table
+# lookups (status, survey and location pks, cartridges, active pluggings) once per run, and
+# counts the connections and queries the run makes on the platedb engine.
+
+_connections = dict()
+_lock = threading.Lock()
+
+# Live contexts, by engine, that the engine listeners count for
+_counting = dict()
+
+
+def site_connection(south=False, connection=None):
+    '''
+    site_connection: the database connection (module db) of the site, chosen once per process
+
+    INPUT: south -- LCO instead of APO
+           connection -- name of a module in database/connections to use instead, e.g.
+                         MyLocalConnection for a local stand-in database
+    OUTPUT: db -- DatabaseConnection. It is a process-wide singleton, so the first one made
+            is used from then on, whatever is asked for later.
+    '''
+    if connection is None:
+        if south:
+            connection = 'LCODatabaseUserLocalConnection'
+        elif (os.path.dirname(os.path.realpath(__file__))).find('utah.edu') >= 0:
+            connection = 'UtahLocalConnection'
+        else:
+            connection = 'APODatabaseUserLocalConnection'
+    with _lock:
+        if connection not in _connections:
+            module = importlib.import_module('autoscheduler.plateDBtools.database.connections.' + connection)
+            _connections[connection] = module.db
+        return _connections[connection]
+
+
+def _count(engine, name):
+    for context in list(_counting.get(engine, ())):
+        context._add(name)
+
+
+def _listen(engine):
+    # one set of listeners per engine, counting for every live context on it
+    with _lock:
+        if engine in _counting:
+            return
+        _counting[engine] = weakref.WeakSet()
+    event.listen(engine, 'before_cursor_execute', lambda *args: _count(engine, 'queries'))
+    event.listen(engine.pool, 'checkout', lambda *args: _count(engine, 'checkouts'))
+    event.listen(engine.pool, 'connect', lambda *args: _count(engine, 'connections'))
+
+
+class RunContext(object):
+    """Session, reference lookups and DB counters of one scheduler run.
+
+    Counting stops when the context is closed or garbage collected. Runs in
+    other threads of the process on the same engine are counted as well.
+
+    Parameters
+    ----------
+    south : bool
+        Use the LCO database instead of the APO one.
+    connection : str or None
+        Connections module to use instead of the site default (see
+        `site_connection`).
+    session : Session or None
+        An existing session to use for the whole run, from every thread.
+    warm : bool
+        Open a pooled connection up front, so the survey pipelines do not
+        each wait for one.
+    lookups : dict or None
+        Reference lookups already made by another run on the same database
+        (see `lookups`), answered from there instead of the database.
+
+    """
+
+    def __init__(self, south=False, connection=None, session=None, warm=True, lookups=None):
+        self.south = south
+        self._session = session
+        if session is None:
+            self.db = site_connection(south, connection)
+            self.engine = self.db.engine
+        else:
+            self.db = None
+            self.engine = session.get_bind()
+        self.counts = {'connections': 0, 'checkouts': 0, 'queries': 0, 'lookups': 0, 'lookup_hits': 0}
+        self._memo = dict(lookups or {})
+        self._lock = threading.Lock()
+        _listen(self.engine)
+        _counting[self.engine].add(self)
+        if warm:
+            self.engine.connect().close()
+
+    def _add(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    @property
+    def session(self):
+        '''The run's session (the same object for every call from one thread)'''
+        if self._session is not None:
+            return self._session
+        return self.db.Session()
+
+    def memo(self, key, func):
+        '''Returns func(session), computed once per run for key'''
+        with self._lock:
+            if key in self._memo:
+                self.counts['lookup_hits'] += 1
+                return self._memo[key]
+        value = func(self.session)
+        with self._lock:
+            self.counts['lookups'] += 1
+            self._memo.setdefault(key, value)
+            return self._memo[key]
+
+    def label_pk(self, model, label):
+        '''pk of the row of a reference table (PlateStatus, Survey, PlateLocation...) with label;
+        raises sqlalchemy.orm.exc.NoResultFound if there is none'''
+        return self.memo((model.__name__, label),
+                         lambda session: session.query(model.pk).filter(model.label == label).one()[0])
+
+    def cartridges(self):
+        '''Numbers of all cartridges, in order'''
+        from autoscheduler.plateDBtools.database.apo.platedb import ModelClasses as plateDB
+        return self.memo('cartridges', lambda session: [c for c, in session.query(plateDB.Cartridge.number)
+                                                        .order_by(plateDB.Cartridge.number).all()])
+
+    def plugged(self):
+        '''(cart number, plate id) of all active pluggings, by cart number'''
+        from autoscheduler.plateDBtools.database.apo.platedb import ModelClasses as plateDB
+        return self.memo('plugged', lambda session: [(c, p) for c, p in session.query(plateDB.Cartridge.number,
+                                                     plateDB.Plate.plate_id).join(plateDB.Plugging)
+                                                     .join(plateDB.Plate).join(plateDB.ActivePlugging)
+                                                     .order_by(plateDB.Cartridge.number).all()])
+
+    def lookups(self):
+        '''The reference lookups made so far, to start another run with'''
+        with self._lock:
+            return dict(self._memo)
+
+    def close(self):
+        '''Stops counting; returns the counts of the run'''
+        _counting[self.engine].discard(self)
+        return dict(self.counts)
+
+    def report(self):
+        return "{connections} new connections, {checkouts} checkouts, {queries} queries, "\
+               "{lookups} lookups ({lookup_hits} reused)".format(**self.counts)
@@ -5,10 +5,14 @@
 # Import necessary modules
 from __future__ import print_function, division
 from autoscheduler import night_schedule
+from autoscheduler.run_context import RunContext
 import autoscheduler.apogee as apg
 from time import time
 from astropy import time as atime
 import os
+import sys
+import threading
+import traceback
 
 try:
     import Totoro
@@ -39,7 +43,137 @@ class filter(object):
         return 1
 
 
-def run_scheduler(plan=False, mjd=-1, surveys=['apogee', 'eboss', 'manga'], loud=True):
+def apogee_twilight(schedule):
+    '''
+    apogee_twilight: whether APOGEE-II is scheduled tonight (north), and with a twilight block
+
+    INPUT: schedule -- dictionary defining important schedule times throughout the night
+    OUTPUT: None if APOGEE-II does not observe tonight, else the twilight flag for schedule_apogee
+    '''
+    # check date range
+    check_date = atime.Time(schedule['jd'], format='jd')
+    check_year = int(check_date.byear)  # get year of time in question, casting int floors in python 2.7
+    check_start = atime.Time('%d-3-16' % (check_year), format='iso')
+    check_end = atime.Time('%d-9-15' % (check_year), format='iso')
+    twilight_check = (check_start < check_date and check_end > check_date)
+
+    # if apogee observes tonight and in twilight time
+    if schedule['bright_start'] > 0 and twilight_check:
+        return schedule['manga_end'] > schedule['bright_end'] or schedule['eboss_end'] > schedule['bright_end']
+    # if apogee doesn't observe but its twilight time
+    elif twilight_check:
+        return True
+    # if apogee observes and not twilight time
+    elif schedule['bright_start'] > 0:
+        return False
+    return None
+
+
+def plan_output(schedule, apgcart, mancart, ebocart, errors):
+    '''
+    plan_output: the plan dictionary returned by run_scheduler for a northern night
+
+    INPUT: schedule -- dictionary defining important schedule times throughout the night
+           apgcart, mancart, ebocart -- picks of each survey
+           errors -- list of error messages
+    OUTPUT: plan -- dictionary with schedule, apogee, manga, eboss and errors
+    '''
+    plan = dict()
+    # Reformat schedule dict for output
+    plan['schedule'] = dict()
+    plan['schedule']['mjd'] = schedule['jd'] - 2400000
+    if schedule['bright_start'] > 0:
+        plan['schedule']['apg_start'] = schedule['bright_start'] - 2400000
+        plan['schedule']['apg_end'] = schedule['bright_end'] - 2400000
+    if schedule['manga_start'] > 0:
+        plan['schedule']['man_start'] = schedule['manga_start'] - 2400000
+        plan['schedule']['man_end'] = schedule['manga_end'] - 2400000
+    if schedule['eboss_start'] > 0:
+        plan['schedule']['ebo_start'] = schedule['eboss_start'] - 2400000
+        plan['schedule']['ebo_end'] = schedule['eboss_end'] - 2400000
+    # Return cart assignments for chosen plates
+    plan['apogee'] = apgcart
+    plan['manga'] = mancart
+    plan['eboss'] = ebocart
+    plan['errors'] = errors
+    return plan
+
+
+def run_pipelines(pipelines, errors, concurrent=False, loud=True):
+    '''
+    run_pipelines: runs the survey pipelines, one after the other or each in its own thread
+
+    Each pipeline is called with an errors list. In sequence, that is errors itself; in threads,
+    every pipeline gets its own list, added to errors in pipeline order once all have finished,
+    so their messages come out in the same order either way (Totoro warnings, caught by the log
+    filter, still go straight to errors). In threads, a pipeline that raises is re-raised once
+    the others have finished.
+
+    INPUT: pipelines -- list of (name, function) pairs; function(errors) returns the survey picks
+           errors -- shared list of error messages
+           concurrent -- run the pipelines in threads (their time is mostly DB I/O)
+    OUTPUT: results, timings -- dicts of the picks and the run time (sec) of every pipeline
+    '''
+    results, timings = dict(), dict()
+    if not concurrent:
+        for name, func in pipelines:
+            start = time()
+            results[name] = func(errors)
+            timings[name] = time() - start
+    else:
+        own_errors = dict((name, []) for name, func in pipelines)
+        failed = dict()
+
+        def run(name, func):
+            start = time()
+            try:
+                results[name] = func(own_errors[name])
+            except Exception:
+                failed[name] = sys.exc_info()
+            timings[name] = time() - start
+
+        threads = [threading.Thread(target=run, args=(name, func), name=name) for name, func in pipelines]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name, func in pipelines:
+            errors.extend(own_errors[name])
+        for name, func in pipelines:
+            if name in failed:
+                traceback.print_exception(*failed[name])
+                raise failed[name][1]
+    if loud:
+        for name, func in pipelines:
+            print("[PY] %s pipeline complete (%.3f sec)" % (name, timings[name]))
+    return results, timings
+
+
+def report_context(context, own, stats=None, loud=True):
+    '''Ends the run's RunContext if run_scheduler made it, and reports its connection and query counts'''
+    counts = context.close() if own else dict(context.counts)
+    if stats is not None:
+        stats['db'] = counts
+    if loud:
+        print("[SQL] run_scheduler used %s" % context.report())
+
+
+def run_scheduler(plan=False, mjd=-1, surveys=['apogee', 'eboss', 'manga'], loud=True, par=None, plates=None,
+                  concurrent=False, stats=None, context=None, eboss_plates=None):
+    '''
+    run_scheduler: schedules all surveys for the night of mjd (-1 for tonight)
+
+    INPUT: plan -- plan ahead (accepted plates) instead of observing (plugged plates)
+           surveys -- surveys running, or ['south'] / ['override'] for LCO
+           par -- APOGEE-II parameters (default schedule_apogee.DEFAULT_PAR)
+           plates -- APOGEE-II plates to schedule from, instead of reading them from the database
+           eboss_plates -- eBOSS plates to schedule from, likewise
+           concurrent -- run the APOGEE-II, MaNGA and eBOSS pipelines at the same time (see run_pipelines)
+           stats -- optional dict, filled with the run time (sec) of every survey pipeline, and with
+                    the connection and query counts of the run under 'db'
+           context -- RunContext to run with (default: one made for this run, see run_context.py)
+    OUTPUT: plan -- dictionary with schedule, apogee, manga, eboss and errors
+    '''
     as_start_time = time()
     errors = []
 
@@ -67,6 +201,11 @@ def run_scheduler(plan=False, mjd=-1, surveys=['apogee', 'eboss', 'manga'], loud
     if loud:
         print("[PY] Schedule read in complete (%.3f sec)" % (schedule_end_time - schedule_start_time))
 
+    # One session, connection and set of reference lookups for the whole run
+    own_context = context is None
+    if own_context:
+        context = RunContext(south=south)
+
     # if we're scheduling the south, its quick and easy, so ignore the rest of the logic
     if south:
         plan = dict()
@@ -82,73 +221,52 @@ def run_scheduler(plan=False, mjd=-1, surveys=['apogee', 'eboss', 'manga'], loud
         #         print("[PY] run_scheduler complete in (%.3f sec)" % ((as_end_time - as_start_time)))
         #     return plan
         # uncomment between to return to previous default
-        apgcart = assign_carts_south.assign_carts(schedule, errors, loud=loud)
+        apgcart = assign_carts_south.assign_carts(schedule, errors, loud=loud, context=context, plates=plates)
         # next 2 lines are artifacts of old code; may be unnecessary
         plan['schedule']['apg_start'] = schedule['bright_start'] - 2400000
         plan['schedule']['apg_end'] = schedule['bright_end'] - 2400000
         # Return cart assignments for chosen plates
         plan['apogee'] = apgcart
         plan['errors'] = errors
+        report_context(context, own_context, stats=stats, loud=loud)
         as_end_time = time()
         if loud:
             print("[PY] run_scheduler complete in (%.3f sec)" % ((as_end_time - as_start_time)))
         return plan
 
     # otherwise, schedule surveys for tonight
-    apogee_choices, manga_choices, eboss_choices = [], [], []
+    pipelines = []
     # Schedule APOGEE-II
 
-    # check date range
-    check_date = atime.Time(schedule['jd'], format='jd')
-    check_year = int(check_date.byear)  # get year of time in question, casting int floors in python 2.7
-    check_start = atime.Time('%d-3-16' % (check_year), format='iso')
-    check_end = atime.Time('%d-9-15' % (check_year), format='iso')
-    twilight_check = (check_start < check_date and check_end > check_date)
-
-    # if apogee observes tonight and in twilight time
-    if schedule['bright_start'] > 0 and twilight_check:
-                if schedule['manga_end'] > schedule['bright_end'] or schedule['eboss_end'] > schedule['bright_end']:
-                        apogee_choices = apg.schedule_apogee(schedule, errors, plan=plan, loud=loud, twilight=True)
-                else:
-                        apogee_choices = apg.schedule_apogee(schedule, errors, plan=plan, loud=loud, twilight=False)
-
-    # if apogee doesn't observe but its twilight time
-    elif twilight_check:
-                apogee_choices = apg.schedule_apogee(schedule, errors, plan=plan, loud=loud, twilight=True)
-
-    # if apogee observes and not twilight time
-    elif schedule['bright_start'] > 0:
-            apogee_choices = apg.schedule_apogee(schedule, errors, plan=plan, loud=loud, twilight=False)
+    # APOGEE-II observes tonight and/or in twilight
+    twilight = apogee_twilight(schedule)
+    if twilight is not None:
+        pipelines.append(('apogee', lambda errs: apg.schedule_apogee(dict(schedule), errs, par=par, plan=plan,
+                                                                     loud=loud, twilight=twilight, plates=plates,
+                                                                     context=context)))
 
     # Schedule MaNGA
-    (manga_choices, manga_cart_order) = man.schedule_manga(schedule, errors, plan=plan, loud=loud)
+    pipelines.append(('manga', lambda errs: man.schedule_manga(dict(schedule), errs, plan=plan, loud=loud)))
     # Schedule eBOSS
     if schedule['eboss'] > 0:
-        eboss_choices = ebo.schedule_eboss(schedule, errors, plan=plan, loud=loud)
+        pipelines.append(('eboss', lambda errs: ebo.schedule_eboss(dict(schedule), errs, plan=plan, loud=loud,
+                                                                   context=context, plates=eboss_plates)))
+
+    results, timings = run_pipelines(pipelines, errors, concurrent=concurrent, loud=loud)
+    if stats is not None:
+        stats.update(timings)
+    apogee_choices = results.get('apogee', [])
+    (manga_choices, manga_cart_order) = results['manga']
+    eboss_choices = results.get('eboss', [])
 
     # Take results and assign to carts
-    apgcart, mancart, ebocart = assign_carts.assign_carts(apogee_choices, manga_choices, eboss_choices, errors, manga_cart_order, loud=loud)
+    apgcart, mancart, ebocart = assign_carts.assign_carts(apogee_choices, manga_choices, eboss_choices, errors, manga_cart_order, loud=loud,
+                                                          context=context)
+    report_context(context, own_context, stats=stats, loud=loud)
 
     as_end_time = time()
     if loud:
         print("[PY] run_scheduler complete in (%.3f sec)" % ((as_end_time - as_start_time)))
 
-    plan = dict()
-    # Reformat schedule dict for output
-    plan['schedule'] = dict()
-    plan['schedule']['mjd'] = schedule['jd'] - 2400000
-    if schedule['bright_start'] > 0:
-        plan['schedule']['apg_start'] = schedule['bright_start'] - 2400000
-        plan['schedule']['apg_end'] = schedule['bright_end'] - 2400000
-    if schedule['manga_start'] > 0:
-        plan['schedule']['man_start'] = schedule['manga_start'] - 2400000
-        plan['schedule']['man_end'] = schedule['manga_end'] - 2400000
-    if schedule['eboss_start'] > 0:
-        plan['schedule']['ebo_start'] = schedule['eboss_start'] - 2400000
-        plan['schedule']['ebo_end'] = schedule['eboss_end'] - 2400000
-    # Return cart assignments for chosen plates
-    plan['apogee'] = apgcart
-    plan['manga'] = mancart
-    plan['eboss'] = ebocart
-    plan['errors'] = errors
+    plan = plan_output(schedule, apgcart, mancart, ebocart, errors)
     return plan
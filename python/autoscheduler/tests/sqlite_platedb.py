@@ -0,0 +1,160 @@
+from __future__ import print_function, division
+import sys
+import math
+import types
+import importlib
+from sqlalchemy import create_engine, event, Column, Integer, Float, String, ForeignKey
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+# DESCRIPTION: Stand-in platedb, apogeeqldb and mangadb on sqlite, with the tables and columns
+# that the exposure cache and the plan cache fingerprint read. install() puts the model
+# classes in place of the ModelClasses modules, which otherwise reflect the Postgres schema.
+
+Base = declarative_base()
+
+
+class Survey(Base):
+    __tablename__ = 'survey'
+    pk = Column(Integer, primary_key=True)
+    label = Column(String)
+
+
+class ExposureFlavor(Base):
+    __tablename__ = 'exposure_flavor'
+    pk = Column(Integer, primary_key=True)
+    label = Column(String)
+
+
+class Plate(Base):
+    __tablename__ = 'plate'
+    pk = Column(Integer, primary_key=True)
+    plate_id = Column(Integer)
+    plate_location_pk = Column(Integer)
+    current_survey_mode_pk = Column(Integer)
+
+
+class PlateToSurvey(Base):
+    __tablename__ = 'plate_to_survey'
+    plate_pk = Column(Integer, ForeignKey('plate.pk'), primary_key=True)
+    survey_pk = Column(Integer, ForeignKey('survey.pk'), primary_key=True)
+
+
+class PlateToPlateStatus(Base):
+    __tablename__ = 'plate_to_plate_status'
+    plate_pk = Column(Integer, ForeignKey('plate.pk'), primary_key=True)
+    plate_status_pk = Column(Integer, primary_key=True)
+
+
+class PlatePointing(Base):
+    __tablename__ = 'plate_pointing'
+    pk = Column(Integer, primary_key=True)
+    plate_pk = Column(Integer, ForeignKey('plate.pk'))
+    priority = Column(Integer)
+
+
+class Observation(Base):
+    __tablename__ = 'observation'
+    pk = Column(Integer, primary_key=True)
+    plate_pointing_pk = Column(Integer, ForeignKey('plate_pointing.pk'))
+
+
+class Exposure(Base):
+    __tablename__ = 'exposure'
+    pk = Column(Integer, primary_key=True)
+    observation_pk = Column(Integer, ForeignKey('observation.pk'))
+    survey_pk = Column(Integer, ForeignKey('survey.pk'))
+    exposure_flavor_pk = Column(Integer, ForeignKey('exposure_flavor.pk'))
+    start_time = Column(Float)
+    exposure_time = Column(Float)
+    exposure_no = Column(Integer)
+
+
+class Plugging(Base):
+    __tablename__ = 'plugging'
+    pk = Column(Integer, primary_key=True)
+    plate_pk = Column(Integer, ForeignKey('plate.pk'))
+
+
+class ActivePlugging(Base):
+    __tablename__ = 'active_plugging'
+    pk = Column(Integer, primary_key=True)
+    plugging_pk = Column(Integer, ForeignKey('plugging.pk'))
+
+
+class Quickred(Base):
+    __tablename__ = 'quickred'
+    pk = Column(Integer, primary_key=True)
+    exposure_pk = Column(Integer, ForeignKey('exposure.pk'))
+    snr_standard = Column(Float)
+
+
+class Reduction(Base):
+    __tablename__ = 'reduction'
+    pk = Column(Integer, primary_key=True)
+    exposure_pk = Column(Integer, ForeignKey('exposure.pk'))
+    snr = Column(Float)
+
+
+class SN2Values(Base):
+    __tablename__ = 'sn2values'
+    pk = Column(Integer, primary_key=True)
+
+
+_models = {'platedb': [Survey, ExposureFlavor, Plate, PlateToSurvey, PlateToPlateStatus, PlatePointing,
+                       Observation, Exposure, Plugging, ActivePlugging],
+           'apogeeqldb': [Quickred, Reduction],
+           'mangadb': [SN2Values]}
+
+
+class PlateDB(object):
+    """A fresh in-memory database, with helpers to add plates and exposures.
+
+    Sessions are in autocommit mode, as those of DatabaseConnection.
+    """
+
+    def __init__(self):
+        self.engine = create_engine('sqlite://')
+        # sqlite has no floor(); the exposure query takes the MJD with it
+        event.listen(self.engine, 'connect', lambda conn, record: conn.create_function('floor', 1, math.floor))
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine, autocommit=True)
+        self.session = self.Session()
+        with self.session.begin():
+            self.session.add_all([Survey(pk=1, label='APOGEE-2'), ExposureFlavor(pk=1, label='Object')])
+
+    def add_plate(self, plateid):
+        with self.session.begin():
+            self.session.add_all([Plate(pk=plateid, plate_id=plateid, plate_location_pk=1, current_survey_mode_pk=1),
+                                  PlateToSurvey(plate_pk=plateid, survey_pk=1),
+                                  PlatePointing(pk=plateid, plate_pk=plateid, priority=5),
+                                  Observation(pk=plateid, plate_pointing_pk=plateid)])
+
+    def add_exposure(self, plateid, mjd, snr=10.0):
+        '''Adds an object exposure of plateid with its reductions; returns its pk'''
+        with self.session.begin():
+            exposure = Exposure(observation_pk=plateid, survey_pk=1, exposure_flavor_pk=1,
+                                start_time=(mjd - 0.3 + 0.5) * 86400, exposure_time=500.0, exposure_no=1)
+            self.session.add(exposure)
+            self.session.flush()
+            self.session.add_all([Quickred(exposure_pk=exposure.pk, snr_standard=snr),
+                                  Reduction(exposure_pk=exposure.pk, snr=snr)])
+        return exposure.pk
+
+    def add_plugging(self, plateid):
+        with self.session.begin():
+            plugging = Plugging(plate_pk=plateid)
+            self.session.add(plugging)
+            self.session.flush()
+            self.session.add(ActivePlugging(plugging_pk=plugging.pk))
+
+
+def install(monkeypatch):
+    '''Makes the ModelClasses modules of platedb, apogeeqldb and mangadb the stand-in models'''
+    for name, models in _models.items():
+        package = importlib.import_module('autoscheduler.plateDBtools.database.apo.' + name)
+        module = types.ModuleType(package.__name__ + '.ModelClasses')
+        for model in models:
+            setattr(module, model.__name__, model)
+        monkeypatch.setitem(sys.modules, module.__name__, module)
+        monkeypatch.setattr(package, 'ModelClasses', module, raising=False)
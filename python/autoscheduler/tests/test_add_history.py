@@ -0,0 +1,119 @@
+from __future__ import print_function, division
+import os
+import numpy as np
+import pytest
+
+from autoscheduler.plateDBtools.apogee.get_apogee_plates import ApogeePlate, add_history
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+class LoopPlate(object):
+    # the plate attributes the loop version reads and writes
+    def __init__(self, plateid, locationid, apgver):
+        self.plateid = plateid
+        self.locationid = locationid
+        self.apgver = apgver
+        self.vdone = 0
+        self.sn = 0.0
+        self.snql = 0.0
+        self.snred = 0.0
+        self.hist = ''
+        self.reduction = ''
+        self.exposureList = []
+
+
+def add_history_loop(apg, exposures_tab, mjd=None):
+    # the history loop of get_plates before it was vectorized
+    plateidDict = dict()
+    for i, p in enumerate(apg):
+        plateidDict[p.plateid] = i
+
+    fullRedCheck = np.copy([exposures_tab[:, 0], exposures_tab[:, 1],
+                            exposures_tab[:, 2],
+                            exposures_tab[:, 3],
+                            [x[3] if not np.isnan(x[3]) else x[2] for x in exposures_tab]]).swapaxes(0, 1)
+    proto_good_exp = np.nan_to_num(fullRedCheck)
+    good_exp = proto_good_exp[proto_good_exp[:, 4] > 10]
+
+    for p in apg:
+        exp_to_add = exposures_tab[exposures_tab[:, 1] == p.plateid]
+        for exp in exp_to_add:
+            p.exposureList.append({'exp_no': exp[6], 'mjd': exp[0],
+                                   'quality': exp[2] > 10 or exp[3] > 10,
+                                   'start_time': exp[5], 'exp_time': exp[4],
+                                   'qr_sn2': exp[2]**2, 'apr_sn2': exp[3]**2})
+        if p.hist != '' and p.vdone != 0:
+            continue
+        repeat = []
+        for pl in apg:
+            if p.plateid == pl.plateid:
+                continue
+            if p.locationid == pl.locationid:
+                if p.apgver == pl.apgver:
+                    repeat.append(pl.plateid)
+        if repeat != []:
+            repeat.append(p.plateid)
+            plateExps = good_exp[np.in1d(good_exp[:, 1], repeat)]
+            targets = [apg[plateidDict[r]] for r in repeat]
+        else:
+            plateExps = good_exp[good_exp[:, 1] == p.plateid]
+            targets = [p]
+        for d in np.unique(plateExps[:, 0]):
+            if d != mjd:
+                day = plateExps[plateExps[:, 0] == d]
+                if day.shape[0] >= 2:
+                    for t in targets:
+                        t.hist += '{},'.format(int(d)+2400000)
+                        t.vdone += 1
+                        t.sn += float(np.sum(day[:, 4]**2))
+                        t.snql += float(np.sum(day[:, 2]**2))
+                        t.snred += float(np.sum(day[:, 3]**2))
+                        if np.sum(day[:, 4]) == np.sum(day[:, 3]):
+                            t.reduction += '1,'
+                        else:
+                            t.reduction += '0,'
+
+
+class FixturePlate(object):
+    # the plate row ApogeePlate is made from
+    def __init__(self, plateid, locationid):
+        self.name = 'field{}'.format(locationid)
+        self.location_id = locationid
+        self.plate_id = plateid
+        self.pk = plateid
+
+
+def fixture():
+    plates = np.loadtxt(os.path.join(DATA, 'apogee_plates.txt'), dtype=int, ndmin=2)
+    exposures = np.loadtxt(os.path.join(DATA, 'apogee_exposures.txt'), ndmin=2)
+    loop = [LoopPlate(*row) for row in plates]
+    apg = []
+    for plateid, locationid, apgver in plates:
+        design = {'apogee_design_type': 'default', 'apogee_design_driver': 'default', 'apogee_n_design_visits': 3,
+                  'apogee_short_version': apgver // 100, 'apogee_med_version': apgver // 10 % 10,
+                  'apogee_long_version': apgver % 10}
+        info = {'ddict': design, 'plate_loc': 'APO', 'ra': 0.0, 'dec': 0.0, 'ha': 0.0, 'maxha': 0.0, 'minha': 0.0,
+                'manual_priority': 0, 'plugged': 0, 'lead_survey': 'apogee'}
+        apg.append(ApogeePlate(FixturePlate(plateid, locationid), info=info))
+    return loop, apg, exposures
+
+
+@pytest.mark.parametrize('mjd', [None, 57504, 57602])
+def test_add_history_matches_loop(mjd):
+    loop, apg, exposures = fixture()
+    add_history_loop(loop, exposures, mjd=mjd)
+    add_history(apg, exposures, mjd=mjd)
+
+    assert sum([p.vdone for p in apg]) > 0
+    for old, new in zip(loop, apg):
+        assert new.plateid == old.plateid
+        assert new.vdone == old.vdone
+        assert new.visits.tolist() == [float(v) for v in old.hist.split(',')[:-1]]
+        assert new.visit_reduced.tolist() == [r == '1' for r in old.reduction.split(',')[:-1]]
+        # per-day sums are accumulated in exposure order, hence the tolerance
+        for name in ('sn', 'snql', 'snred'):
+            assert np.isclose(getattr(new, name), getattr(old, name), rtol=1e-12, atol=0), name
+        assert len(new.visit_sn) == new.vdone
+        assert np.isclose(new.visit_sn.sum(), old.sn, rtol=1e-12, atol=0)
+        assert str(new.exposureList) == str(old.exposureList)
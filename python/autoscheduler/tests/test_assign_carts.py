@@ -0,0 +1,210 @@
+from __future__ import print_function, division
+import copy
+import numpy as np
+import pytest
+
+# assign_carts reads the plate database and Totoro at import
+pytest.importorskip('psycopg2')
+pytest.importorskip('Totoro')
+from autoscheduler import assign_carts
+
+
+def avoid(plateid):
+    # stand-in for Totoro's avoid_cart_2
+    return plateid % 7 == 0
+
+
+def sequential_carts(apogee_choices, manga_choices, eboss_choices, carts, plugged, errors, avoid=avoid):
+    # the cart assignment loops of assign_carts before the matching, on the same inputs as match_carts
+    plugplan = [{'cart': c, 'cartsurveys': 1 if c < 10 else 2, 'oldplate': plugged.get(c, 0), 'm_picked': 0}
+                for c in carts]
+    manpicks = list(manga_choices)
+    for c in manpicks:
+        wcart = [x for x in range(len(plugplan)) if plugplan[x]['cart'] == c['cart']]
+        if len(wcart) > 0:
+            plugplan[wcart[0]]['m_picked'] = 1
+
+    apgsaved = np.zeros(len(apogee_choices))
+    apgpicks = []
+    for i in range(len(apogee_choices)):
+        wplate = [x for x in range(len(plugplan)) if apogee_choices[i]['plate'] == plugplan[x]['oldplate']]
+        if len(wplate) == 0 or plugplan[wplate[0]]['m_picked'] == 1:
+            continue
+        thispick = apogee_choices[i]
+        thispick['cart'] = plugplan[wplate[0]]['cart']
+        plugplan[wplate[0]]['cart'] = -1
+        apgsaved[i] = 1
+        thispick.pop('coobs', None)
+        apgpicks.append(thispick)
+
+    manga_removed_plates = []
+    for i in range(len(apogee_choices)):
+        if apgsaved[i] == 1:
+            continue
+        if apogee_choices[i]['coobs']:
+            carts_avail = [x for x in range(len(plugplan)) if 0 <= plugplan[x]['cart'] <= 6
+                           and plugplan[x]['m_picked'] == 0]
+            if len(carts_avail) == 0:
+                carts_avail = [x for x in range(len(plugplan)) if plugplan[x]['cart'] >= 0
+                               and plugplan[x]['cartsurveys'] == 1]
+        else:
+            carts_avail = [x for x in range(len(plugplan)) if plugplan[x]['cart'] >= 0
+                           and plugplan[x]['cartsurveys'] == 1]
+        if len(carts_avail) == 0:
+            continue
+        thispick = apogee_choices[i]
+        thispick.pop('coobs', None)
+        plate_id = thispick['plate']
+        if plate_id == -1 or not avoid(plate_id):
+            selected_cart = carts_avail[0]
+        else:
+            for cart in carts_avail:
+                if plugplan[cart]['cart'] != 2 or cart == carts_avail[-1]:
+                    selected_cart = cart
+                    break
+        if plugplan[selected_cart]['m_picked'] == 1:
+            wcart = [x for x in range(len(manpicks)) if plugplan[selected_cart]['cart'] == manpicks[x]['cart']]
+            manga_removed_plates.append(manpicks[wcart[0]]['plateid'])
+            manpicks.pop(wcart[0])
+        thispick['cart'] = plugplan[selected_cart]['cart']
+        plugplan[selected_cart]['cart'] = -1
+        apgpicks.append(thispick)
+
+    ebosaved = np.zeros(len(eboss_choices))
+    ebopicks = []
+    for i in range(len(eboss_choices)):
+        wplate = [x for x in range(len(plugplan)) if eboss_choices[i]['plate'] == plugplan[x]['oldplate']
+                  and plugplan[x]['cart'] >= 0 and plugplan[x]['m_picked'] == 0]
+        if len(wplate) == 0:
+            continue
+        thispick = eboss_choices[i]
+        thispick['cart'] = plugplan[wplate[0]]['cart']
+        plugplan[wplate[0]]['cart'] = -1
+        ebosaved[i] = 1
+        ebopicks.append(thispick)
+    for i in range(len(eboss_choices)):
+        if ebosaved[i] == 1:
+            continue
+        carts_avail = [x for x in range(len(plugplan)) if plugplan[x]['cart'] >= 0
+                       and plugplan[x]['cartsurveys'] == 2]
+        if len(carts_avail) == 0:
+            continue
+        thispick = eboss_choices[i]
+        thispick['cart'] = plugplan[carts_avail[0]]['cart']
+        plugplan[carts_avail[0]]['cart'] = -1
+        ebopicks.append(thispick)
+    return apgpicks, manpicks, ebopicks
+
+
+def inventory(rs, manga=True, coobs=True, mixed=True):
+    # random carts (in cart order), pluggings and picks; APOGEE-II plates are 100-159 and eBOSS
+    # plates 200-259, and unless mixed, carts only hold plates of their own survey
+    carts = [c for c in [17, 16, 15, 14, 13, 12, 11, 10] + list(rs.permutation(range(1, 10))) if rs.rand() < 0.8]
+    pool = {True: list(rs.permutation(range(100, 160))), False: list(rs.permutation(range(200, 260)))}
+    plugged = dict()
+    for c in carts:
+        if rs.rand() < 0.6:
+            plugged[c] = int(pool[(c < 10) != (mixed and rs.rand() < 0.2)].pop())
+    man = [{'cart': c, 'plateid': 9000 + c} for c in carts if c < 10 and manga and rs.rand() < 0.4]
+    apg = [{'plate': int(p), 'coobs': bool(coobs and rs.rand() < 0.5)}
+           for p in rs.choice(range(100, 160), rs.randint(0, 9), replace=False)]
+    # co-observing plates after the others, as assign_carts sorts them
+    apg = sorted(apg, key=lambda c: c['coobs'])
+    ebo = [{'plate': int(p)} for p in rs.choice(range(200, 260), rs.randint(0, 9), replace=False)]
+    return apg, man, ebo, carts, plugged
+
+
+def both(apg, man, ebo, carts, plugged):
+    old = sequential_carts(copy.deepcopy(apg), copy.deepcopy(man), copy.deepcopy(ebo), carts, plugged, [])
+    new = assign_carts.match_carts(copy.deepcopy(apg), copy.deepcopy(man), copy.deepcopy(ebo), carts, plugged, [],
+                                   avoid=avoid)
+    return old, new
+
+
+def stay(picks, plugged, man):
+    # plates kept in their cart, which MaNGA did not pick
+    manga_carts = [m['cart'] for m in man]
+    return sum([plugged.get(p['cart']) == p['plate'] and p['cart'] not in manga_carts for p in picks[0] + picks[2]])
+
+
+def cart_of(picks):
+    return dict((p['plate'], p['cart']) for p in picks)
+
+
+@pytest.fixture(params=['matching', 'greedy'])
+def solver(request, monkeypatch):
+    if request.param == 'greedy':
+        monkeypatch.setattr(assign_carts, 'linear_sum_assignment', None)
+    elif assign_carts.linear_sum_assignment is None:
+        pytest.skip('scipy is not installed')
+    return request.param
+
+
+def test_same_carts_without_manga_or_coobs(solver):
+    # with no MaNGA carts to bump, no co-observing plates and every plate plugged in a cart of
+    # its survey, the old order is kept
+    rs = np.random.RandomState(1)
+    for trial in range(300):
+        apg, man, ebo, carts, plugged = inventory(rs, manga=False, coobs=False, mixed=False)
+        apg = [c for c in apg if not avoid(c['plate'])]
+        old, new = both(apg, man, ebo, carts, plugged)
+        assert cart_of(new[0]) == cart_of(old[0])
+        assert cart_of(new[2]) == cart_of(old[2])
+
+
+def test_plugged_plate_moves_for_another_pick(solver):
+    # an APOGEE-II plate left in an eBOSS cart used to keep it even if an eBOSS plate then got no cart
+    old, new = both([{'plate': 141, 'coobs': False}], [], [{'plate': 245}], [16, 5], {16: 141})
+    assert cart_of(old[0]) == {141: 16} and old[2] == []
+    if solver == 'greedy':
+        # picks take their carts in turn, as in the old loops
+        assert cart_of(new[0]) == {141: 16} and new[2] == []
+    else:
+        assert cart_of(new[0]) == {141: 5} and cart_of(new[2]) == {245: 16}
+
+
+def test_bump_keeps_plates_off_manga_carts(solver):
+    # carts 3 and 5 free, MaNGA on 4; the old loops took 4 for the second plate
+    apg = [{'plate': 101, 'coobs': False}, {'plate': 102, 'coobs': False}]
+    man = [{'cart': 4, 'plateid': 9004}]
+    old, new = both(apg, man, [], [3, 4, 5], {})
+    assert cart_of(old[0]) == {101: 3, 102: 4}
+    assert old[1] == []
+    assert cart_of(new[0]) == {101: 3, 102: 5}
+    assert new[1] == man
+    # with no cart left, a MaNGA cart is still taken
+    old, new = both(apg, man, [], [3, 4], {})
+    assert cart_of(new[0]) == cart_of(old[0]) == {101: 3, 102: 4}
+    assert new[1] == old[1] == []
+
+
+def test_coobs_plates_get_carts_1_to_6_first(solver):
+    # the APOGEE-only plate no longer takes the only cart 1-6 ahead of the co-observing one
+    apg = [{'plate': 101, 'coobs': False}, {'plate': 102, 'coobs': True}]
+    old, new = both(apg, [], [], [3, 8], {})
+    assert cart_of(old[0]) == {101: 3, 102: 8}
+    if solver == 'greedy':
+        assert cart_of(new[0]) == {101: 3, 102: 8}
+    else:
+        assert cart_of(new[0]) == {101: 8, 102: 3}
+
+
+def test_against_sequential_carts(solver):
+    rs = np.random.RandomState(2)
+    for trial in range(500):
+        apg, man, ebo, carts, plugged = inventory(rs)
+        old, new = both(apg, man, ebo, carts, plugged)
+        used = [p['cart'] for p in new[0] + new[2]]
+        assert len(used) == len(set(used))
+        assert all([p['cart'] < 10 or plugged.get(p['cart']) == p['plate'] for p in new[0]])
+        assert all([p['cart'] >= 10 or plugged.get(p['cart']) == p['plate'] for p in new[2]])
+        assert not set(used) & set([m['cart'] for m in new[1]])
+        if solver == 'greedy':
+            continue
+        # at least as many plates get a cart; when as many do, at least as many stay in their
+        # cart and no more MaNGA plates go (taking carts in turn guarantees none of that)
+        placed = len(new[0]) + len(new[2])
+        assert placed >= len(old[0]) + len(old[2])
+        if placed == len(old[0]) + len(old[2]):
+            assert stay(new, plugged, man) >= stay(old, plugged, man)
+            assert len(new[1]) >= len(old[1])
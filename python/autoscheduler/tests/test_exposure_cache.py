@@ -0,0 +1,51 @@
+from __future__ import print_function, division
+import numpy as np
+import pytest
+
+from autoscheduler.plateDBtools.apogee.exposure_cache import ExposureCache
+from autoscheduler.tests import sqlite_platedb
+
+
+@pytest.fixture
+def db(monkeypatch):
+    sqlite_platedb.install(monkeypatch)
+    db = sqlite_platedb.PlateDB()
+    for plateid in (1001, 1002):
+        db.add_plate(plateid)
+    return db
+
+
+def mjds(rows, plateid):
+    return sorted(rows[rows[:, 1] == plateid, 0].tolist())
+
+
+def test_plate_left_out_of_a_call_keeps_its_new_exposures(db, tmpdir):
+    cache = ExposureCache(str(tmpdir.join('exposures.npz')))
+    db.add_exposure(1001, 57500)
+    db.add_exposure(1002, 57500)
+    rows = cache.exposures(db.session, [1001, 1002], loud=False)
+    assert len(rows) == 2
+
+    # 1001 is observed, then only 1002 is asked for (and observed after it)
+    db.add_exposure(1001, 57501)
+    db.add_exposure(1002, 57502)
+    rows = cache.exposures(db.session, [1002], loud=False)
+    assert mjds(rows, 1002) == [57500, 57502]
+    assert mjds(rows, 1001) == []
+
+    rows = cache.exposures(db.session, [1001, 1002], loud=False)
+    assert mjds(rows, 1001) == [57500, 57501]
+    assert mjds(rows, 1002) == [57500, 57502]
+
+
+def test_cache_file_matches_a_fresh_read(db, tmpdir):
+    path = str(tmpdir.join('exposures.npz'))
+    cache = ExposureCache(path)
+    for k, plateid in enumerate([1001, 1002, 1001, 1002, 1001]):
+        db.add_exposure(plateid, 57500 + k)
+        cache.exposures(db.session, [plateid], loud=False)
+    rows = ExposureCache(path).exposures(db.session, [1001, 1002], loud=False)
+    fresh = ExposureCache(str(tmpdir.join('fresh.npz'))).exposures(db.session, [1001, 1002], loud=False)
+    order = np.lexsort((rows[:, 0], rows[:, 1]))
+    fresh_order = np.lexsort((fresh[:, 0], fresh[:, 1]))
+    assert np.array_equal(rows[order], fresh[fresh_order])
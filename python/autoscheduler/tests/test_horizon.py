@@ -0,0 +1,29 @@
+from __future__ import print_function, division
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+from autoscheduler.horizon import reserve_later
+from autoscheduler.plateDBtools.apogee.cohorts import CohortIndex
+
+
+class Plate(object):
+    def __init__(self, locationid, apgver):
+        self.locationid = locationid
+        self.apgver = apgver
+
+
+def test_reserve_later_discounts_by_night_offset():
+    # one cohort, better two nights ahead than tonight; the night in between has no slots
+    cohorts = CohortIndex([Plate(4100, 1), Plate(4100, 1)])
+    tonight = np.array([[0.85], [0.5]])
+    later = np.array([[1.0], [0.2]])
+    # 1.0 * 0.9**2 < 0.85: tonight wins
+    assert len(reserve_later([(0, tonight), (2, later)], cohorts, discount=0.9)) == 0
+    # 1.0 * 0.9 > 0.85: the cohort is kept for the next night
+    assert reserve_later([(0, tonight), (1, later)], cohorts, discount=0.9).tolist() == [0, 1]
+
+
+def test_reserve_later_tonight_only():
+    cohorts = CohortIndex([Plate(4100, 1)])
+    assert len(reserve_later([(0, np.array([[1.0]]))], cohorts)) == 0
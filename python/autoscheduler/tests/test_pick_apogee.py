@@ -0,0 +1,51 @@
+from __future__ import print_function, division
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+from autoscheduler.apogee.pick_apogee_plates import greedy_slots, assignment_slots
+from autoscheduler.plateDBtools.apogee.cohorts import CohortIndex
+
+
+class Plate(object):
+    def __init__(self, locationid, apgver, stack=0):
+        self.locationid = locationid
+        self.apgver = apgver
+        self.stack = stack
+
+
+def objective(obs, chosen):
+    return sum([obs[c, t] for t, c in enumerate(chosen[:, 0]) if c >= 0])
+
+
+def stacked_pool(seed):
+    # small pools, so stack-able designs compete for the same slots
+    rs = np.random.RandomState(seed)
+    n, nslot = rs.randint(3, 40), rs.randint(2, 10)
+    apg = [Plate(rs.randint(0, max(2, n // 2)), rs.randint(1, 3)) for i in range(n)]
+    cohorts = CohortIndex(apg)
+    for members in cohorts.cohorts:
+        stack = int(rs.rand() < 0.5)
+        for x in members:
+            apg[x].stack = stack
+    obs = rs.uniform(-3, 100, (n, nslot))
+    obs[rs.rand(n, nslot) < 0.4] = -1
+    return apg, obs, cohorts
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_assignment_not_below_greedy_with_stacked_designs(seed):
+    apg, obs, cohorts = stacked_pool(seed)
+    greedy = greedy_slots(apg, obs.copy(), np.arange(obs.shape[1]), cohorts, loud=False)
+    chosen = assignment_slots(apg, obs.copy(), cohorts)
+    assert objective(obs, chosen) >= objective(obs, greedy) - 1e-9
+    for t, c in enumerate(chosen[:, 0]):
+        assert c < 0 or obs[c, t] > 0
+
+
+def test_stacked_design_takes_every_other_slot():
+    # one stack-able design, best everywhere; a plain design fills in between
+    apg = [Plate(1, 1, stack=1), Plate(2, 1)]
+    obs = np.array([[10.0, 10.0, 10.0], [0.0, 1.0, 1.0]])
+    chosen = assignment_slots(apg, obs, CohortIndex(apg))
+    assert chosen[:, 0].tolist() == [0, 1, 0]
@@ -0,0 +1,38 @@
+from __future__ import print_function, division
+import numpy as np
+import pytest
+
+# the eboss package reads the plate database at import
+pytest.importorskip('psycopg2')
+pytest.importorskip('pytz')
+from autoscheduler.eboss.pick_eboss_plates import place_plates, pick_plates
+
+
+class Plate(object):
+    def __init__(self, plateid, nleft, plugged=0):
+        self.plateid = plateid
+        self.nleft = nleft
+        self.plugged = plugged
+
+    def visleft(self, par):
+        return self.nleft
+
+
+@pytest.mark.parametrize('solver', ['greedy', 'dp'])
+def test_complete_plates_are_not_placed(solver):
+    ebo = [Plate(0, 0), Plate(1, 0)]
+    obs = np.ones([2, 4])
+    assert pick_plates(ebo, {'ncarts': 4}, np.arange(4), obs, loud=False, solver=solver) == []
+
+
+def test_place_plates_without_visits_left():
+    obs = np.ones([2, 2])
+    assert place_plates([Plate(0, 0), Plate(1, 0)], {'ncarts': 4}, obs, [-1, -1]) == [-1, -1]
+    assert place_plates([], {'ncarts': 4}, np.zeros([0, 2]), [-1, -1]) == [-1, -1]
+
+
+def test_place_plates_fills_free_slots():
+    # plate 7 needs two slots and is only observable in the last two
+    obs = np.array([[-1.0, -1.0, 1.0, 1.0], [0.5, 0.5, 0.5, 0.5]])
+    chosen = place_plates([Plate(7, 2), Plate(8, 2)], {'ncarts': 4}, obs, [-1, -1, -1, -1])
+    assert chosen == [8, 8, 7, 7]
@@ -0,0 +1,90 @@
+from __future__ import print_function, division
+import os
+from time import time
+import pytest
+
+from autoscheduler import plan_cache
+from autoscheduler.plan_cache import PlanCache, db_fingerprint, cached_run_scheduler
+from autoscheduler.tests import sqlite_platedb
+
+
+def plan_files(directory):
+    return sorted([name for name in os.listdir(str(directory)) if name.endswith('.json')])
+
+
+def test_put_get(tmpdir):
+    cache = PlanCache(directory=str(tmpdir))
+    cache.put('a', {'apogee': [{'plate': 1}], 'errors': []})
+    plan = cache.get('a')
+    plan['errors'].append('changed')
+    # a copy is returned, from memory or from disk
+    assert cache.get('a') == {'apogee': [{'plate': 1}], 'errors': []}
+    assert PlanCache(directory=str(tmpdir)).get('a') == {'apogee': [{'plate': 1}], 'errors': []}
+    assert cache.get('b') is None
+
+
+def test_disk_keeps_newest_files(tmpdir):
+    cache = PlanCache(directory=str(tmpdir), maxfiles=3)
+    for n, key in enumerate('abcd'):
+        cache.put(key, {'n': n})
+        os.utime(str(tmpdir.join(key + '.json')), (time() - 100 + n, time() - 100 + n))
+    cache.put('e', {'n': 4})
+    assert plan_files(tmpdir) == ['c.json', 'd.json', 'e.json']
+    # still in memory
+    assert cache.get('a') == {'n': 0}
+
+
+def test_disk_drops_old_files(tmpdir):
+    cache = PlanCache(directory=str(tmpdir), maxage=3600)
+    cache.put('a', {'n': 0})
+    os.utime(str(tmpdir.join('a.json')), (time() - 7200, time() - 7200))
+    tmpdir.join('notes.txt').write('kept')
+    cache.put('b', {'n': 1})
+    assert plan_files(tmpdir) == ['b.json']
+    assert tmpdir.join('notes.txt').check()
+    assert PlanCache(directory=str(tmpdir)).get('a') is None
+
+
+@pytest.fixture
+def db(monkeypatch):
+    sqlite_platedb.install(monkeypatch)
+    db = sqlite_platedb.PlateDB()
+    db.add_plate(1001)
+    db.add_plate(1002)
+    monkeypatch.setattr(plan_cache, 'apogee_session', lambda south=False: db.session)
+    return db
+
+
+@pytest.mark.parametrize('south', [False, True])
+def test_fingerprint_follows_exposures_and_pluggings(db, south):
+    prints = [db_fingerprint(db.session, south=south)]
+    assert db_fingerprint(db.session, south=south) == prints[0]
+    db.add_exposure(1001, 57500)
+    prints.append(db_fingerprint(db.session, south=south))
+    db.add_plugging(1002)
+    prints.append(db_fingerprint(db.session, south=south))
+    db.add_plate(1003)
+    prints.append(db_fingerprint(db.session, south=south))
+    assert len(set(prints)) == len(prints)
+
+
+def test_cached_run_scheduler_reruns_after_database_changes(db, monkeypatch):
+    runs = []
+
+    def run_scheduler(plan=False, mjd=-1, surveys=None, loud=True):
+        runs.append(mjd)
+        return {'apogee': [{'plate': 1001}], 'run': len(runs)}
+
+    monkeypatch.setattr(plan_cache.s4as, 'run_scheduler', run_scheduler)
+    cache = PlanCache()
+
+    def plan():
+        return cached_run_scheduler(mjd=57500, surveys=['apogee'], loud=False, cache=cache)['run']
+
+    assert plan() == 1
+    assert plan() == 1
+    db.add_exposure(1001, 57500)
+    assert plan() == 2
+    db.add_plugging(1001)
+    assert plan() == 3
+    assert plan() == 3
@@ -0,0 +1,59 @@
+from __future__ import print_function, division
+import numpy as np
+import pytest
+
+from autoscheduler.sdssUtilities.Site import Site
+
+obstools = pytest.importorskip('astropysics.obstools')
+coords = pytest.importorskip('astropysics.coords')
+
+# APO and LCO (latitude, longitude), as in observability_kernel
+SITES = [(32.789278, -105.820278), (-29.0182, -70.6915)]
+
+
+def reference(site, ra, dec, jd, refraction):
+    # astropysics, one target at a time; every time is precessed to the epoch of jd[0]
+    alt = np.zeros((len(ra), len(jd)))
+    az = np.zeros((len(ra), len(jd)))
+    for i in range(len(ra)):
+        horz = site.apparentCoordinates(coords.ICRSCoordinates(ra[i], dec[i]), datetime=list(jd),
+                                        refraction=refraction)
+        alt[i] = [h.alt.d for h in horz]
+        az[i] = [h.az.d for h in horz]
+    return alt, az
+
+
+def grid():
+    # RA and Dec every 30 and 10 degrees, LST every hour over a sidereal day
+    ra, dec = np.meshgrid(np.arange(0., 360., 30.), np.arange(-80., 90., 10.))
+    jd = 2457800.7 + np.arange(24) / 24 * 0.99727
+    return ra.ravel(), dec.ravel(), jd
+
+
+@pytest.mark.parametrize('latitude, longitude', SITES)
+def test_get_horizontal(latitude, longitude):
+    site = obstools.Site(latitude, longitude)
+    ra, dec, jd = grid()
+    lst = np.array([site.localSiderialTime(x) for x in jd])
+    alt, az = Site(longitude=longitude % 360, latitude=latitude).getHorizontal(
+        jd, ra, dec, lst=lst, epoch=obstools.jd_to_epoch(jd[0]))
+    ref_alt, ref_az = reference(site, ra, dec, jd, refraction=False)
+    assert alt.shape == (len(ra), len(jd))
+    assert np.abs(alt - ref_alt).max() < 1e-2
+    # as an angle on the sky, since the azimuth is undefined at the zenith
+    daz = ((az - ref_az + 180) % 360 - 180) * np.cos(np.deg2rad(ref_alt))
+    assert np.abs(daz).max() < 1e-2
+
+
+@pytest.mark.parametrize('latitude, longitude', SITES)
+def test_get_airmass(latitude, longitude):
+    site = obstools.Site(latitude, longitude)
+    ra, dec, jd = grid()
+    lst = np.array([site.localSiderialTime(x) for x in jd])
+    airmass = Site(longitude=longitude % 360, latitude=latitude).getAirmass(
+        jd, ra, dec, lst=lst, epoch=obstools.jd_to_epoch(jd[0]), refraction=True)
+    ref_alt, __ = reference(site, ra, dec, jd, refraction=True)
+    ref = 1 / np.sin(np.deg2rad(ref_alt))
+    low = (ref_alt > 0) & (ref < 3)
+    assert low.sum() > 100
+    assert np.abs(airmass - ref)[low].max() < 2e-3
@@ -0,0 +1,148 @@
+from __future__ import print_function, division
+import os
+import pytest
+import numpy as np
+
+from autoscheduler import whatif
+from autoscheduler.run_context import site_connection
+from autoscheduler.plateDBtools.apogee.get_apogee_plates import ApogeePlate, add_history
+from autoscheduler.plateDBtools.apogee.plate_table import PlateTable
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+class RecordingContext(object):
+    # stands in for RunContext, remembering what it was made with; the cart inventory
+    # is read once, or taken from the lookups it was given
+    made = []
+    carts = [1, 2, 3, 4]
+
+    def __init__(self, south=False, connection=None, lookups=None, **kwargs):
+        self.south = south
+        self.connection = connection
+        self.given = lookups
+        self.memo = dict(lookups or {})
+        self.closed = False
+        self.counts = {}
+        self.queries = 0
+        RecordingContext.made.append(self)
+
+    def _lookup(self, key, value):
+        if key not in self.memo:
+            self.queries += 1
+            self.memo[key] = value
+        return self.memo[key]
+
+    def cartridges(self):
+        return self._lookup('cartridges', list(self.carts))
+
+    def plugged(self):
+        return self._lookup('plugged', [(1, 8100)])
+
+    def lookups(self):
+        return dict(self.memo)
+
+    def report(self):
+        return 'no database'
+
+    def close(self):
+        self.closed = True
+        return {}
+
+
+class FixturePlate(object):
+    # the plate row ApogeePlate is made from
+    def __init__(self, plateid, locationid):
+        self.name = 'field{}'.format(locationid)
+        self.location_id = locationid
+        self.plate_id = plateid
+        self.pk = plateid
+
+
+def lco_table():
+    # the add_history fixture plates, spread over the sky of LCO in March
+    plates = np.loadtxt(os.path.join(DATA, 'apogee_plates.txt'), dtype=int, ndmin=2)
+    exposures = np.loadtxt(os.path.join(DATA, 'apogee_exposures.txt'), ndmin=2)
+    apg = []
+    for k, (plateid, locationid, apgver) in enumerate(plates):
+        design = {'apogee_design_type': 'default', 'apogee_design_driver': 'default', 'apogee_n_design_visits': 6,
+                  'apogee_short_version': apgver // 100, 'apogee_med_version': apgver // 10 % 10,
+                  'apogee_long_version': apgver % 10}
+        info = {'ddict': design, 'plate_loc': 'LCO', 'ra': 90.0 + 7.5 * k % 180, 'dec': -30.0, 'ha': 0.0,
+                'maxha': 60.0, 'minha': -60.0, 'manual_priority': 5, 'plugged': 0, 'lead_survey': 'apogee'}
+        apg.append(ApogeePlate(FixturePlate(plateid, locationid), info=info))
+    add_history(apg, exposures)
+    return PlateTable.from_plates(apg)
+
+
+def test_run_batch_threads_connection(monkeypatch):
+    RecordingContext.made = []
+    calls = []
+
+    def run_scheduler(plan=False, mjd=-1, surveys=None, loud=True, par=None, plates=None, context=None, **kwargs):
+        calls.append((mjd, surveys, context))
+        return {'apogee': [], 'manga': [], 'eboss': [], 'errors': []}
+
+    monkeypatch.setattr(whatif, 'RunContext', RecordingContext)
+    monkeypatch.setattr(whatif.s4as, 'run_scheduler', run_scheduler)
+    monkeypatch.setattr(whatif, 'get_plates', lambda errors, **kwargs: np.zeros(0))
+    scenarios = [whatif.scenario(mjd=59235, surveys=['south']),
+                 whatif.scenario(mjd=58004, surveys=['apogee', 'manga'], plan=True)]
+    results, timing = whatif.run_batch(scenarios, processes=1, connection='MyLocalConnection', loud=False)
+
+    assert [r['error'] for r in results] == [None, None]
+    assert [c[0] for c in calls] == [59235, 58004]
+    # one context for the shared state of each site, one per scenario, all on the batch's connection
+    assert len(RecordingContext.made) == 4
+    assert all(c.connection == 'MyLocalConnection' and c.closed for c in RecordingContext.made)
+    assert [c[2].south for c in calls] == [True, False]
+    # the scenarios start from the cart inventory read for their site
+    assert all(c[2].given is not None for c in calls)
+
+
+def test_run_batch_lco_scenarios_on_shared_table(monkeypatch):
+    # real LCO runs of run_scheduler, on one shared plate table and cart inventory
+    RecordingContext.made = []
+    table = lco_table()
+    reads = []
+
+    def get_plates(errors, south=False, mjd=None, **kwargs):
+        reads.append((south, mjd))
+        return table
+
+    monkeypatch.setattr(whatif, 'RunContext', RecordingContext)
+    monkeypatch.setattr(whatif, 'get_plates', get_plates)
+    scenarios = [whatif.scenario(mjd=57830, surveys=['south']), whatif.scenario(mjd=57830, surveys=['override']),
+                 whatif.scenario(mjd=57831, surveys=['south'])]
+    results, timing = whatif.run_batch(scenarios, processes=1, loud=False)
+
+    assert [r['error'] for r in results] == [None, None, None], results[0]['error']
+    # plates once per night, carts once for the site
+    assert reads == [(True, 57830), (True, 57831)]
+    assert sum([c.queries for c in RecordingContext.made]) == 2
+    plateids = set(table.columns['plateid'].tolist())
+    for r in results:
+        picks = r['plan']['apogee']
+        assert len(picks) > len(RecordingContext.carts)
+        assert all(p['plate'] in plateids for p in picks)
+        # the first plates of the night go in the carts, the rest wait
+        assert sorted([p['cart'] for p in picks if p['cart'] > 0]) == RecordingContext.carts
+    assert results[0]['plan']['apogee'] == results[1]['plan']['apogee']
+    # the shared table is left as read
+    assert np.all(table.columns['priority'] == 0)
+
+
+def local_database():
+    try:
+        site_connection(connection='MyLocalConnection').engine.connect().close()
+    except Exception as e:
+        pytest.skip('no local plate database (MyLocalConnection): {}'.format(e))
+
+
+def test_run_batch_local_database():
+    local_database()
+    results, timing = whatif.run_batch([whatif.scenario(mjd=59235, surveys=['south'])], processes=1,
+                                       connection='MyLocalConnection', loud=False)
+    assert results[0]['error'] is None, results[0]['error']
+    assert results[0]['plan']['schedule']['mjd'] == 59235
+    assert timing['total'] >= timing['setup']
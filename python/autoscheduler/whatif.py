@@ -0,0 +1,185 @@
+# ---- SDSS-IV AUTOSCHEDULER: WHAT-IF BATCHES ----
+# DESCRIPTION: Runs the scheduler for a list of scenarios (MJD, surveys, plan flag and
+# APOGEE-II parameter overrides) in a process pool. The database state the scenarios have
+# in common is read once in the parent and inherited by the workers: APOGEE-II plates with
+# their exposure history, eBOSS plates, and the cartridges and active pluggings of each
+# site. MaNGA is scheduled by Totoro on its own database, once per scenario. Every
+# scenario runs with its own RunContext on the batch's database connection.
+
+from __future__ import print_function, division
+from time import time
+import os
+import traceback
+import multiprocessing
+import numpy as np
+
+from autoscheduler import s4as, night_schedule
+from autoscheduler.run_context import RunContext
+from autoscheduler.plateDBtools.apogee.get_apogee_plates import get_plates
+from autoscheduler.apogee.schedule_apogee import DEFAULT_PAR
+
+# State shared with the worker processes (set before the pool forks): APOGEE-II plates by
+# plates_key, the errors from reading them, eBOSS plates by plan flag, and the reference
+# lookups (cartridges, pluggings...) by site
+_shared = dict()
+_shared_errors = dict()
+_shared_eboss = dict()
+_shared_lookups = dict()
+
+
+def scenario(mjd=-1, surveys=['apogee', 'eboss', 'manga'], plan=False, par=None):
+    '''Returns a scenario for run_batch; par holds APOGEE-II parameters that differ from DEFAULT_PAR'''
+    return {'mjd': mjd, 'surveys': list(surveys), 'plan': plan, 'par': dict(par or {})}
+
+
+def _south(surveys):
+    return surveys == ['south'] or surveys == ['override']
+
+
+def plates_key(sc):
+    '''
+    plates_key: which shared APOGEE-II plates a scenario is scheduled from
+
+    LCO histories leave out the night being scheduled (see get_plates), so LCO plates are
+    read per night; northern ones per plan flag.
+
+    INPUT: sc -- scenario (see scenario)
+    OUTPUT: key -- (south, plan, MJD of the night or None)
+    '''
+    if not _south(sc['surveys']):
+        return (False, sc['plan'], None)
+    # the schedule line run_scheduler will use (the closest one if mjd is not in the file)
+    pwd = os.path.dirname(os.path.realpath(__file__))
+    schedule = night_schedule.read_schedule(pwd, [], mjd=sc['mjd'], surveys=sc['surveys'], loud=False, plan=True,
+                                            south=True)
+    return (True, True, int(schedule['jd'] - 2400000))
+
+
+def _clear():
+    for shared in (_shared, _shared_errors, _shared_eboss, _shared_lookups):
+        shared.clear()
+
+
+def _init_worker():
+    # connections inherited from the parent must not be shared with it
+    from autoscheduler.plateDBtools.database.DatabaseConnection import DatabaseConnection
+    for db in DatabaseConnection._singletons.values():
+        db.engine.dispose()
+
+
+def run_scenario(case):
+    '''
+    run_scenario: runs the scheduler for one scenario, with the shared plates if loaded
+
+    INPUT: case -- (index, scenario, connection) triple; connection as for run_batch
+    OUTPUT: result -- dict with the index, scenario, plan (None if it failed), error
+                      (traceback or None), time (sec) and pid of the worker
+    '''
+    index, sc, connection = case
+    start = time()
+    par = dict(DEFAULT_PAR)
+    par.update(sc['par'])
+    south = _south(sc['surveys'])
+    context = None
+    try:
+        key = plates_key(sc)
+        plates = _shared.get(key)
+        if plates is not None:
+            # priorities are set in place, so every scenario works on its own copy
+            plates = plates.take(np.arange(len(plates)))
+        # made here, as sessions do not cross to the workers
+        context = RunContext(south=south, connection=connection, lookups=_shared_lookups.get(south))
+        plan = s4as.run_scheduler(plan=sc['plan'], mjd=sc['mjd'], surveys=sc['surveys'], loud=False, par=par,
+                                  plates=plates, eboss_plates=None if south else _shared_eboss.get(sc['plan']),
+                                  context=context)
+        if plates is not None:
+            plan['errors'] = _shared_errors[key] + plan['errors']
+        error = None
+    except Exception:
+        plan, error = None, traceback.format_exc()
+    finally:
+        if context is not None:
+            context.close()
+    return {'index': index, 'scenario': sc, 'plan': plan, 'error': error, 'time': time() - start,
+            'pid': os.getpid()}
+
+
+def run_batch(scenarios, processes=None, connection=None, loud=True):
+    '''
+    run_batch: runs the scheduler for every scenario, in a process pool
+
+    The APOGEE-II plates are read once for each plan flag (LCO: each night) used, with the
+    exposure cache, the eBOSS plates once for each plan flag, and the cartridges and active
+    pluggings once for each site; the forked workers inherit them. A scenario that raises
+    gets its traceback in error instead of stopping the batch.
+
+    All database reads of the scheduler (plates, eBOSS, cart assignment) go through the
+    connection given. MaNGA is scheduled by Totoro on its own database, in every scenario,
+    and northern scenarios fail without Totoro, as run_scheduler does; LCO scenarios do not
+    need it.
+
+    INPUT: scenarios -- list of dicts with mjd, surveys, plan and par (see scenario)
+           processes -- number of worker processes (default: number of CPUs; 1 runs in process)
+           connection -- connections module to run with, e.g. 'MyLocalConnection' to run against a
+                         local stand-in database (see run_context.site_connection)
+           loud -- print timing info to std out
+    OUTPUT: results -- one dict per scenario, in order (see run_scenario), and
+            timing -- dict with the setup, scenario (summed) and total time (sec)
+    '''
+    batch_start = time()
+    scenarios = [scenario(**sc) for sc in scenarios]
+
+    # Shared state, once per plate set and site
+    _clear()
+    keys, eboss_flags = set(), set()
+    for sc in scenarios:
+        if _south(sc['surveys']) or 'apogee' in sc['surveys']:
+            keys.add(plates_key(sc))
+        if not _south(sc['surveys']) and 'eboss' in sc['surveys']:
+            eboss_flags.add(sc['plan'])
+    for south in sorted(set([_south(sc['surveys']) for sc in scenarios])):
+        context = RunContext(south=south, connection=connection)
+        try:
+            for key in sorted([k for k in keys if k[0] == south]):
+                _shared_errors[key] = []
+                _shared[key] = get_plates(_shared_errors[key], plan=key[1], loud=loud, south=south, mjd=key[2],
+                                          columnar=True, cache=True, context=context)
+            if len(eboss_flags) > 0 and not south:
+                from autoscheduler.eboss.get_eboss_plates import get_plates as get_eboss_plates
+                for flag in sorted(eboss_flags):
+                    _shared_eboss[flag] = get_eboss_plates(plan=flag, loud=loud, context=context)
+            # for the cart assignment of every scenario
+            context.cartridges()
+            context.plugged()
+            _shared_lookups[south] = context.lookups()
+        finally:
+            context.close()
+    setup_end = time()
+    if loud:
+        print("[PY] What-if setup: %d scenarios, APOGEE-II plates for %s, eBOSS plates for plan flags %s (%.3f sec)"
+              % (len(scenarios), sorted(keys), sorted(eboss_flags), setup_end - batch_start))
+
+    cases = [(index, sc, connection) for index, sc in enumerate(scenarios)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1 or len(cases) < 2:
+        results = [run_scenario(case) for case in cases]
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker)
+        try:
+            results = pool.map(run_scenario, cases, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    _clear()
+
+    batch_end = time()
+    timing = {'setup': setup_end - batch_start, 'scenarios': sum([r['time'] for r in results]),
+              'total': batch_end - batch_start}
+    if loud:
+        for r in results:
+            print("[PY] Scenario %2d: MJD %s %s plan=%s %s (%.3f sec)"
+                  % (r['index'], r['scenario']['mjd'], ','.join(r['scenario']['surveys']), r['scenario']['plan'],
+                     'ok' if r['error'] is None else 'FAILED', r['time']))
+        print("[PY] What-if batch complete (%.3f sec)" % (batch_end - batch_start))
+    return results, timing
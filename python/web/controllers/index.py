@@ -5,6 +5,7 @@ from flask import request, render_template, send_from_directory, current_app
 #from ..model.database import db
 
 from autoscheduler import s4as
+from autoscheduler.plan_cache import cached_run_scheduler
 
 index_page = flask.Blueprint("index_page", __name__)
 
@@ -17,11 +18,15 @@ def func_name():
     mode = request.args.get("mode", 'observing')
     verbose = bool(request.args.get("v", False))
     ascii = bool(request.args.get("ascii",False))
+    cache = request.args.get("cache", "0") == "1"
     
     if mode == 'planning': plan = True
     else: plan = False
 
-    plugresults = s4as.run_scheduler(plan=plan, mjd=mjd, surveys=surveys, loud=verbose)
+    # cache=1 reuses plans until the database or schedule changes (see plan_cache.py); the
+    # fingerprint does not cover Totoro's MaNGA state, so plans are recomputed by default
+    if cache: plugresults = cached_run_scheduler(plan=plan, mjd=mjd, surveys=surveys, loud=verbose)
+    else: plugresults = s4as.run_scheduler(plan=plan, mjd=mjd, surveys=surveys, loud=verbose)
     
 
     if ascii:
@@ -0,0 +1,15 @@
+from __future__ import print_function, division
+import sys
+from autoscheduler.ephemeris import build_table
+
+# Precompute the ephemeris for every night of a schedule file, e.g.
+#   python build_ephemeris.py Sch_APO_base.dat apo
+#   python build_ephemeris.py Sch_LCO_base.dat lco
+# The table is written next to the schedule files, where night_ephemeris memory-maps it.
+
+if len(sys.argv) < 3:
+	print("usage: build_ephemeris.py <schedule file> <apo|lco> [output]")
+	sys.exit(1)
+
+output = sys.argv[3] if len(sys.argv) > 3 else None
+build_table(sys.argv[2], sys.argv[1], output=output)
@@ -0,0 +1,15 @@
+from __future__ import print_function, division
+import sys
+from autoscheduler.night_schedule import compile_schedule
+
+# Compile a schedule file into the binary table read_schedule prefers, e.g.
+#   python compile_schedule.py Sch_APO_base.dat apo
+#   python compile_schedule.py Sch_LCO_base.dat lco
+# The table is written next to the schedule file and is ignored once the text changes.
+
+if len(sys.argv) < 3:
+	print("usage: compile_schedule.py <schedule file> <apo|lco> [output]")
+	sys.exit(1)
+
+output = sys.argv[3] if len(sys.argv) > 3 else None
+compile_schedule(sys.argv[1], output=output, south=(sys.argv[2] == 'lco'))
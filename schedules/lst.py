@@ -1,9 +1,9 @@
 from __future__ import print_function, division
-import astropysics.obstools as obs
 import numpy as np
 import sys
 import matplotlib.pyplot as plt
 import json
+from autoscheduler.ephemeris import night_ephemeris
 
 weather = 0.50
 south_frac = 0.75
@@ -11,18 +11,19 @@ apg_frac = 1
 man_frac = 12.6
 ebo_frac = 5.3
 
-apo = obs.Site(32.789278, -105.820278)
 schedule = np.loadtxt(sys.argv[1])
 apg_lst, man_lst, ebo_lst = np.zeros(24), np.zeros(24), np.zeros(24)
 apg_met, man_met, ebo_met = [], [], []
 
 for d in range(schedule.shape[0]):
+	# LSTs are interpolated from the cached ephemeris for this night
+	ephem = night_ephemeris('apo', schedule[d,0])
 	# APOGEE-II LST Calculations
 	apg_start, apg_end = schedule[d,4], schedule[d,5]
 	if apg_start > 1:
 		apg_length = int((apg_end - apg_start) * 24 * 60 / 87 + 0.4)
 		midpts = apg_start + np.arange(apg_length)*(87/60/24) + 0.5/24
-		apg_nightlst = [apo.localSiderialTime(x) for x in midpts]
+		apg_nightlst = ephem.lst(midpts)
 		for l in apg_nightlst: apg_lst[int(l)] += 87/60
 		if len(apg_met) == 0: apg_met.append([int(schedule[d,0]-2400000), len(apg_nightlst)])
 		else: apg_met.append([int(schedule[d,0]-2400000), len(apg_nightlst) + apg_met[-1][1]])
@@ -36,7 +37,7 @@ for d in range(schedule.shape[0]):
 	if ebo_start > 1:
 		ebo_length = int((ebo_end - ebo_start) * 24 * 60 / 16.5 + 0.4)
 		midpts = ebo_start + np.arange(ebo_length)*(16.5/60/24) + 8.25/60/24
-		ebo_nightlst = [apo.localSiderialTime(x) for x in midpts]
+		ebo_nightlst = ephem.lst(midpts)
 		ebo_nightlen = 0.0
 		for l in ebo_nightlst:
 			if int(l) > 6 and int(l) <= 18:
@@ -57,7 +58,7 @@ for d in range(schedule.shape[0]):
 	if man_start > 1:
 		man_length = int((man_end - man_start) * 24 * 60 / 16.5 + 0.4)
 		midpts = man_start + np.arange(man_length)*(16.5/60/24) + 8.25/60/24
-		man_nightlst = [apo.localSiderialTime(x) for x in midpts]
+		man_nightlst = ephem.lst(midpts)
 		man_nightlen = 0.0
 		for l in man_nightlst:
 			if int(l) > 6 and int(l) <= 18: